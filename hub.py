@@ -17,25 +17,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import argparse
 import time
 import datetime
 import sys
 import os
 import traceback
-import pytradfri
-import RPi.GPIO as GPIO
 import signal
 
-import huefri
-from huefri.common import Config
-from huefri.common import HuefriException
-from huefri.common import log
-from huefri.hue import Hue
-from huefri.tradfri import Tradfri
-
-from src.controller import Controller
-from src.alarm import Alarm
+# Only the web stack is imported here, the gateway, GPIO and sound bindings
+# are imported in main(). A web server started in the "spawn" mode imports
+# this file again and shouldn't load them.
 from src.webgui import WebGUI
+from src.timer import AlarmTimer
+from src.diagnostics import Diagnostics
+from src import clock
+from src import logger
+from src import telemetry
 
 CFG_EXAMPLE = """{
 "alarm": {
@@ -49,108 +47,286 @@ CFG_EXAMPLE = """{
     "brightening": {
         "duration": 1,
         "step": 1,
+        "lights": {
+            "tradfri:0": {"delay": 0, "curve": 1, "ct": [454, 250]},
+            "tradfri:1": {"delay": 0.3, "curve": 2, "max": 200}
+        }
+    },
+    "polling": {
+        "fast": 1,
+        "slow": 30,
+        "standby": 300,
+        "cooldown": 300,
+        "idle": 300
     },
 },
-"tradfri":{
+"logging": {
+    "level": "info",
+    "modules": {"Controller": "debug"}
+},
+"webgui": {
+    "mode": "thread",
+    "port": 8001
+},
+"telemetry": {
+    "snapshot": 60
+},
+"gateways": {
+    "reboot_hour": 4,
+    "reboot_stagger": 15
+},
+"tradfri":[{
     "addr": "tradfri",
     "secret": "XXXXXXXXX",
     "controlled": [0],
+    "main": 0,
+    "rate": 10
+    }, {
+    "name": "upstairs",
+    "addr": "tradfri-upstairs",
+    "secret": "XXXXXXXXX",
+    "controlled": [0, 1],
     "main": 0
-    }
+    }]
 }
 """
 
-def _log(msg):
-    log("MAIN", msg)
+# how often the last known light state is written to the state store, in seconds
+LIGHTS_PERSIST_INTERVAL = 60
+TELEMETRY_FILE = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "telemetry.json")
+DIAGNOSTICS_DIR = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "diagnostics")
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("MAIN", msg, *args, level=level)
 
-class USR1Exception(Exception):
-    pass
+def backends_health(c):
+    """ Describe the gateways for a diagnostics report """
+    if c is None:
+        return "not initialized"
+    return {
+        'gateways': c.gateways.health(),
+        'errors': telemetry.TELEMETRY.summary('errors.'),
+        'latency': telemetry.TELEMETRY.summary('latency.'),
+    }
 
-def onsig1(a, b):
-    raise USR1Exception()
+# GPIO pins of the buttons and their events
+BUTTONS = [
+    (12, 'onoff'),
+    (13, 'alarm'),
+    (19, 'down'),
+    (5,  'right'),
+    (6,  'left'),
+    (26, 'off'),
+    (20, 'on'),
+    (21, 'alarm'),
+    ]
 
-def main():
+def run(config, webgui, timer, diag, reload=None, controller_class=None, alarm_class=None):
+    """ The main loop. Runs until interrupted, or until a simulation ends.
+        config: huefri's Config or anything with the same get()
+        controller_class, alarm_class: replacements of Controller and Alarm
+    """
+    import pytradfri
+    import huefri
+    from src.controller import Controller
+    from src.alarm import Alarm
+    from src.scenes import SceneEngine
+
+    controller_class = controller_class or Controller
+    alarm_class = alarm_class or Alarm
     initialized = False
-    signal.signal(signal.SIGUSR1,onsig1)
-    Config.path = os.path.join(
-        os.path.dirname(os.path.realpath(__file__)),
-        "config.json")
     c = None
     alarm = None
-    last_reboot = datetime.datetime.now()
-    # start the web server
-    webgui = WebGUI(Alarm.ALARM_FILE)
+    # seconds between telemetry snapshots, 0 to disable
+    snapshot_interval = 0
+    # the last light state written to the state store, and when
+    persisted_lights = None
+    persisted_at = 0
+
+    diag.add_source('queues', lambda: dict(webgui.queue_depths(),
+                                           **{'log buffer': len(logger.LOGGER.buffer)}))
+    diag.add_source('backends', lambda: backends_health(c))
+    diag.add_source('alarm', lambda: alarm.status() if alarm else None)
+    # reports come from a thread of their own, also when the loop hangs
+    diag.start()
+
+    def urgent(command, argument):
+        """ Commands of the web UI which can't wait for the next tick """
+        if command == 'diagnostics':
+            diag.request()
+        elif command == 'stop' and alarm is not None:
+            alarm.interrupt('web')
+    webgui.interrupt = urgent
     webgui.run()
 
+    # outside of the loop: a failure there would set up GPIO again every tick
+    if reload is not None:
+        try:
+            reload.start()
+        except (OSError, ValueError) as ex:
+            _log("Changes of the config won't be applied, it can't be read: %s", ex,
+                 level=logger.ERROR)
+            reload = None
+
     # main loop
     try:
         while True:
             try:
-                time.sleep(1)
+                clock.sleep(1)
+                tick_start = time.monotonic()
                 if not initialized:
                     # bind GPIO pins
-                    c = Controller(Config, [
-                        (12, 'onoff'),
-                        (13, 'alarm'),
-                        (19, 'down'),
-                        (5,  'right'),
-                        (6,  'left'),
-                        (26, 'off'),
-                        (20, 'on'),
-                        (21, 'alarm'),
-                        ])
-                    alarm = Alarm(Config, c)
+                    c = controller_class(config, BUTTONS)
+                    alarm = alarm_class(config, c, timer)
+                    alarm.listener = webgui.event
+                    c.scenes = SceneEngine(c, alarm.timer.store)
+                    logger.configure(config.get().get('logging', {}))
+                    snapshot_interval = config.get().get('telemetry', {}).get('snapshot', 60)
                     initialized = True
                 else:
+                    if reload is not None and reload.check(c, alarm):
+                        snapshot_interval = reload.current.get('telemetry', {}).get('snapshot', 60)
                     c.update()
+                    for (command, argument) in webgui.pending_commands():
+                        if command == 'diagnostics':
+                            diag.request()
+                        elif command == 'reload' and reload is not None:
+                            reload.request()
+                        elif command == 'stop':
+                            alarm.interrupt('web')
+                        else:
+                            c.command(command, argument)
                     alarm.alarm()
+                    lights = c.light_states()
+                    webgui.publish({
+                        'lights': lights,
+                        'progress': alarm.status(),
+                        'gateways': c.gateways.status(),
+                        'colors': [color for (color, _) in c.scenes.palette],
+                    })
+                    if lights != persisted_lights and \
+                            clock.time() - persisted_at > LIGHTS_PERSIST_INTERVAL:
+                        alarm.timer.store.update(lights=lights)
+                        persisted_lights = lights
+                        persisted_at = clock.time()
+                    telemetry.TELEMETRY.save_every(TELEMETRY_FILE, snapshot_interval)
+
+                # reboot the tradfri gateways every day, to get around some issues
+                # with long-running gateway; one at a time, the others keep working
+                if initialized:
+                    gateway = c.gateways.reboot_due(clock.now())
+                    if gateway is not None:
+                        c.gateways.reboot(gateway)
 
-                # reboot at 4 am every day, to get around some issues with long-running
-                # gateway
-                now = datetime.datetime.now()
-                if now.hour == 4 and ((now - last_reboot).seconds/3600) > 5:
-                    _log("Time for reboot of Tradfri gateway...")
-                    c.tradfri.reboot()
-                    c.cleanup()
-                    initialized = False
-                    time.sleep(10)
-                    last_reboot = now
+                diag.tick(time.monotonic() - tick_start)
 
             except pytradfri.error.ClientError as ex:
-                _log("An error occured with Tradfri: %s" % str(ex))
+                telemetry.record('errors.tradfri.client', 1)
+                _log("An error occured with Tradfri: %s", ex, level=logger.WARNING)
 
             except pytradfri.error.RequestTimeout:
                 """ This exception is raised here and there and doesn't cause anything.
                     So _log just a short notice, not a full stacktrace.
                 """
-                _log("Tradfri request timeout, retrying...")
+                telemetry.record('errors.tradfri.timeout', 1)
+                _log("Tradfri request timeout, retrying...", level=logger.WARNING)
 
             except pytradfri.error.RequestError as ex:
-                _log(ex)
+                telemetry.record('errors.tradfri.request', 1)
+                _log(ex, level=logger.WARNING)
 
             except (KeyError, huefri.common.BadConfigPathError) as ex:
-                _log("An error occured with configuration: %s" % str(ex))
-                _log("The config file should look like:\n%s" % CFG_EXAMPLE)
+                _log("An error occured with configuration: %s", ex, level=logger.ERROR)
+                _log("The config file should look like:\n%s", CFG_EXAMPLE, level=logger.ERROR)
                 sys.exit(1)
 
-            #except USR1Exception:
-            #    _log("USR1 captured")
-            #    last_reboot = datetime.datetime(year=2006, month=5, day=15)
-
             except IndexError as err:
-                _log(err)
+                _log(err, level=logger.WARNING)
                 _log("reinitializing")
                 c.cleanup()
                 initialized = False
 
             except Exception as err:
-                traceback.print_exc()
-                _log(err)
+                telemetry.record('errors.other', 1)
+                _log(traceback.format_exc(), level=logger.ERROR)
 
     except KeyboardInterrupt:
         print("Exiting on ^c.")
         c.cleanup()
         sys.exit(0)
 
+    except clock.SimulationEnd:
+        if c is not None:
+            c.cleanup()
+
+def simulate(args, Config):
+    """ Run the main loop in virtual time against fake gateways, print a report """
+    from src.simulation import Simulation
+
+    try:
+        cnf = Config.get()
+    except Exception:
+        _log("No usable config.json, simulating the default one", level=logger.WARNING)
+        cnf = None
+    sim = Simulation(args.simulate,
+                     alarm=datetime.datetime.strptime(args.alarm, '%H:%M').time(),
+                     start=datetime.datetime.strptime(args.start, '%Y-%m-%d %H:%M')
+                         if args.start else None,
+                     speed=args.speed, config=cnf, base=Config)
+    sim.install()
+    logger.set_level(args.log_level)
+    real_start = time.monotonic()
+    try:
+        run(sim.config, sim.gui, sim.timer, Diagnostics(sim.directory.name),
+            controller_class=sim.controller_class(), alarm_class=sim.alarm_class())
+        print(sim.report(), end='')
+        print("Took {:.1f} s".format(time.monotonic() - real_start))
+    finally:
+        sim.cleanup()
+
+def main(argv=None):
+    from huefri.common import Config
+    from src.alarm import Alarm
+    from src.reload import HotReload
+
+    parser = argparse.ArgumentParser(description="Alarm and light control hub")
+    parser.add_argument('--simulate', metavar='DAYS', type=float,
+                        help="run in virtual time against fake gateways and print a report")
+    parser.add_argument('--alarm', default='06:30', help="the simulated alarm time, HH:MM")
+    parser.add_argument('--start', help="the simulated start, YYYY-MM-DD HH:MM, the next midnight by default")
+    parser.add_argument('--speed', type=float,
+                        help="simulated seconds per real second, as fast as possible by default")
+    parser.add_argument('--log-level', default='warning', help="log level of the simulation")
+    args = parser.parse_args(argv)
+
+    Config.path = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "config.json")
+    if args.simulate is not None:
+        simulate(args, Config)
+        return
+
+    # SIGUSR1 writes a diagnostics report and starts profiling
+    diag = Diagnostics(DIAGNOSTICS_DIR)
+    signal.signal(signal.SIGUSR1, diag.signal)
+    # start the web server
+    try:
+        web_cnf = Config.get().get('webgui', {})
+    except Exception:
+        # a broken config is reported by the main loop below
+        web_cnf = {}
+    # shared by the alarm and the web server when it runs in a thread
+    timer = AlarmTimer(Alarm.STATE_FILE, Alarm.ALARM_FILE)
+    webgui = WebGUI(Alarm.STATE_FILE, TELEMETRY_FILE,
+                    mode=web_cnf.get('mode', 'thread'),
+                    port=web_cnf.get('port', 8001),
+                    timer=timer, telemetry=telemetry.TELEMETRY)
+    # HotReload applies changes of config.json without a restart
+    run(Config, webgui, timer, diag, reload=HotReload(Config.path, Config))
+
 if __name__ == '__main__':
     main()
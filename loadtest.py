@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import sys
+
+from src import logger
+from src.loadtest import LoadTest, WRITE_MIX, parse_duration
+from src.webgui import WebGUI
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load and soak test of the hub's web server")
+    parser.add_argument('--duration', default='60', help="how long to load it: 90, 30m, 4h")
+    parser.add_argument('--sample', default='10', help="time between progress lines")
+    parser.add_argument('--baseline', default='10',
+                        help="time of measuring the main loop ticks before the load")
+    parser.add_argument('--clients', type=int, default=8, help="threads sending requests")
+    parser.add_argument('--rate', type=float,
+                        help="requests a second of all clients, as fast as possible by default")
+    parser.add_argument('--subscribers', type=int, default=2, help="open /api/events streams")
+    parser.add_argument('--slow', type=int, default=10, help="slowloris-like clients")
+    parser.add_argument('--slow-interval', type=float, default=10,
+                        help="seconds between header lines of a slow client")
+    parser.add_argument('--mode', default='thread', choices=WebGUI.MODES,
+                        help="the mode of the tested server")
+    parser.add_argument('--host', default='localhost', help="the host of a running hub")
+    parser.add_argument('--port', type=int, help="test a running hub on this port")
+    parser.add_argument('--pid', type=int, help="the process of the running hub")
+    parser.add_argument('--writes', action='store_true',
+                        help="send POST requests to a running hub too (changes its alarm and lights!)")
+    parser.add_argument('--max-tick-late', type=float, default=100,
+                        help="fail if the loaded p99 tick lateness exceeds this, in ms")
+    parser.add_argument('--json', metavar='FILE', help="write the report and samples here")
+    args = parser.parse_args(argv)
+
+    logger.LOGGER.sink = logger.print_sink
+    logger.set_level('warning')
+    test = LoadTest(host=args.host, port=args.port, pid=args.pid, mode=args.mode,
+                    clients=args.clients, rate=args.rate, subscribers=args.subscribers,
+                    slow=args.slow, slow_interval=args.slow_interval,
+                    mix=WRITE_MIX if args.writes else None)
+    report = test.run(parse_duration(args.duration), sample=parse_duration(args.sample),
+                      baseline=parse_duration(args.baseline), out=print)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'report': report, 'samples': test.samples}, f, indent=2)
+
+    failed = bool(report['errors'])
+    loaded = report['tick_late_ms']['loaded']['p99']
+    if loaded is not None and loaded > args.max_tick_late:
+        print("The main loop ticks were late by up to {} ms".format(loaded))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,38 +18,65 @@
 from datetime import datetime, timedelta, time
 import pytradfri
 import sys
-import vlc
 import re
 import os
+import threading
+import time as _time
 
 import huefri
 from huefri.common import Config
 from huefri.common import HuefriException
-from huefri.common import log
 from huefri.common import COLORS_MAP
 from huefri.hue import Hue
 from huefri.tradfri import Tradfri
 
+from src import clock
+from src import logger
+from src import telemetry
+from src.timer import AlarmTimer, read_legacy_file
+from src.sunrise import Sunrise
+from src.governor import PollingGovernor
+
 SOUND = None # do not set
 
-def _log(msg):
-    log("Alarm", msg)
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Alarm", msg, *args, level=level)
 
 
 class Sound(object):
     def __init__(self, cnf):
+        # imported here, so a simulation with another player doesn't need libvlc
+        import vlc
+
         self.path = cnf['path']
         self.volume_increment = cnf['volume_increment']
+        self.force_alsa = cnf['force_alsa']
         if cnf['force_alsa']:
-            vlc_inst = vlc.Instance('--input-repeat=-1', '--aout=alsa')
+            self.vlc_inst = vlc.Instance('--input-repeat=-1', '--aout=alsa')
         else:
-            vlc_inst = vlc.Instance('--input-repeat=-1')
-        vlc_med = vlc_inst.media_new(self.path)
-        self.player = vlc_inst.media_player_new()
+            self.vlc_inst = vlc.Instance('--input-repeat=-1')
+        vlc_med = self.vlc_inst.media_new(self.path)
+        self.player = self.vlc_inst.media_player_new()
         self.player.set_media(vlc_med)
         self._volume = cnf['volume_initial']
         self._volume_starting = cnf['volume_initial']
 
+    def reconfigure(self, cnf):
+        """ Apply a changed sound config. Return False if it needs a new Sound
+            (a different audio output), which can't be done in place.
+        """
+        if cnf['force_alsa'] != self.force_alsa:
+            return False
+        self.volume_increment = cnf['volume_increment']
+        self._volume_starting = cnf['volume_initial']
+        if cnf['path'] != self.path:
+            playing = self.is_playing()
+            self.path = cnf['path']
+            self.player.set_media(self.vlc_inst.media_new(self.path))
+            if playing:
+                self.player.play()
+        return True
+
     def volume_reset(self):
         self.volume = self._volume_starting
 
@@ -69,7 +96,7 @@ class Sound(object):
             value = 0
 
         self._volume = value
-        _log("set volume to %d" % value)
+        _log("set volume to %d", value, level=logger.DEBUG)
         self.player.audio_set_volume(value)
 
     def is_playing(self):
@@ -122,24 +149,65 @@ class Queue(object):
 
 class Alarm(object):
     br_max = 254 # max brightness value
+    # plays the sound at the end of the alarm
+    sound_class = Sound
+    STATE_FILE = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), '..',
+            "hub_state.json")
+    # the old plain text alarm file, imported into STATE_FILE
     ALARM_FILE = os.path.join(
             os.path.dirname(os.path.realpath(__file__)), '..',
             "alarm_time")
 
-    def __init__(self, config, controller):
+    def __init__(self, config, controller, timer=None):
+        """ timer: an AlarmTimer to use, a new one is created if None """
         global SOUND
 
         cnf = config.get()['alarm']
         self.controller = controller
+        self.alarm_started = None
+        SOUND = self.sound_class(cnf['sound'])
+        self.sound = SOUND
+        self.timer = timer if timer is not None else AlarmTimer(self.STATE_FILE, self.ALARM_FILE)
+        self.prev_brightness = Queue(max_size=5)
+        # the last step sent by the sunrise, and {"backend:light": Queue} of sent values
+        self.sunrise_step = None
+        self.sunrise_sent = {}
+        # If set to a callable, it is called as listener(event name, data dict)
+        # on alarm progress: started, step, aborted, ended and sound.
+        self.listener = None
+        # guards the start and end of the ramp against interrupt() from other threads
+        self.lock = threading.Lock()
+        controller.callback_condition = self._button_condition
+        controller.change_listener = self._light_changed
+        self.configure(cnf)
+
+    def configure(self, cnf):
+        """ Apply the alarm part of the config. Can be called again with
+            a changed config, even while the alarm runs.
+        """
+        global SOUND
+
         self.gpio = cnf['gpio']
         self.step = cnf['brightening']['step']
         self.duration_sec = cnf['brightening']['duration']
         self.duration = round(self.duration_sec / self.step)
-        self.alarm_started = None
-        SOUND = Sound(cnf['sound'])
-        self.sound = SOUND
-        self.timer = AlarmTimer(self.ALARM_FILE)
-        self.prev_brightness = Queue(max_size=5)
+        # per-light ramp, if configured
+        self.sunrise = None
+        if cnf['brightening'].get('lights'):
+            self.sunrise = Sunrise(cnf['brightening']['lights'], self.duration, self.br_max)
+        # decides when to poll the lights for manual changes
+        self.governor = PollingGovernor.from_config(cnf.get('polling', {}))
+        if not self.sound.reconfigure(cnf['sound']):
+            if self.sound.is_playing():
+                self.sound.stop()
+            SOUND = self.sound_class(cnf['sound'])
+            self.sound = SOUND
+
+    def _emit(self, name, **data):
+        """ Tell the listener (if any) about an alarm event """
+        if callable(self.listener):
+            self.listener(name, data)
 
     def compute_brightness(self, delta):
         """ Compute what should be the brightness at any given time """
@@ -156,8 +224,45 @@ class Alarm(object):
 
         return brightness
 
+    def sunrise_changed(self):
+        """ Return True if any light driven by the sunrise differs from the sent values """
+        self.controller.get_brigtnesses()
+        for (backend, light, br) in self.controller.last_brightnesses:
+            sent = self.sunrise_sent.get('{}:{}'.format(backend, light))
+            if sent is not None and br not in sent:
+                return True
+        return False
+
+    def sunrise_update(self, step, started):
+        """ Send the lights which changed since the last sent sunrise step,
+            unless the alarm started at started was interrupted meanwhile
+        """
+        with self.lock:
+            if self.alarm_started is not started:
+                return
+            commands = self.sunrise.commands(self.sunrise_step, step)
+            self.sunrise_step = step
+            if not commands:
+                return
+            for (backend, changes) in commands.items():
+                for (light, br, _, _) in changes:
+                    key = '{}:{}'.format(backend, light)
+                    self.sunrise_sent.setdefault(key, Queue(max_size=5)).put(br)
+            _log("sunrise step %d: %s", step, commands, level=logger.DEBUG)
+            self.controller.apply_states(commands, flush=False, skip_known=True)
+        self.controller.flush()
+        peak = self.sunrise.peak(step)
+        self.controller.prev_brightness = peak
+        self._emit('step', brightness=peak,
+                   progress=round(min(1.0, step / self.duration), 3),
+                   lights=dict(('{}:{}'.format(backend, light), br)
+                               for (backend, changes) in commands.items()
+                               for (light, br, _, _) in changes))
+
     def brightness_changed(self):
         """ Return True if any light is different from expected value """
+        if self.sunrise is not None and self.alarm_started is not None:
+            return self.sunrise_changed()
         # first check if there was a change
         brs = self.controller.get_brigtnesses()
         potential_change = False
@@ -173,117 +278,137 @@ class Alarm(object):
                     return True
         return False
 
+    def status(self):
+        """ Return a dict describing the alarm progress """
+        progress = 0.0
+        if self.alarm_started is not None:
+            delta = (clock.now() - self.alarm_started).total_seconds() / self.step
+            progress = min(1.0, max(0.0, delta / self.duration))
+        return {
+            'polling': self.governor.phase,
+            'running': self.alarm_started is not None,
+            'started': self.alarm_started.isoformat() if self.alarm_started else None,
+            'progress': round(progress, 3),
+            'brightness': self.controller.prev_brightness,
+            'sound': bool(self.sound.is_playing()),
+            'volume': self.sound.volume,
+        }
+
+    def should_poll(self):
+        """ Ask the governor if the lights should be polled in this tick """
+        return self.governor.should_poll(
+            clock.monotonic(),
+            ramping=self.alarm_started is not None,
+            sound=self.sound.is_playing(),
+            next_alarm=self.timer.seconds_to_next())
+
     def check_time(self):
         """ Return True if the alarm should start now """
         return self.timer.check_now()
 
+    def interrupt(self, source):
+        """ Stop the ramp and the sound right away, return True if any of
+            them was running. Can be called from any thread: the queued ramp
+            commands are dropped and no other step is sent.
+            source: what stopped the alarm, for the log and the listener
+        """
+        start = _time.monotonic()
+        with self.lock:
+            ramp = self.alarm_started is not None
+            if ramp:
+                self.alarm_started = None
+                self.controller.alarm_start = False
+                cancelled = self.controller.cancel_pending()
+        sound = self.sound.is_playing()
+        if sound:
+            self.sound.stop()
+        if not (ramp or sound):
+            return False
+        telemetry.record('latency.interrupt', _time.monotonic() - start)
+        if ramp:
+            _log("Alarm aborted by %s, %d queued commands dropped", source, cancelled)
+            self._emit('aborted', source=source, cancelled=cancelled)
+        if sound:
+            self._emit('sound', playing=False)
+        return True
+
+    def _button_condition(self):
+        """ Controller's callback_condition: a button stops the alarm. A press
+            stopping the ramp or the sound does nothing else; the alarm
+            button would start the ramp again right away.
+        """
+        return not self.interrupt('button')
+
+    def _light_changed(self, gateway, light, brightness):
+        """ Controller's change_listener: stop the ramp if a light has a value
+            the ramp didn't send lately
+        """
+        if self.alarm_started is None:
+            return
+        if self.sunrise is not None:
+            sent = self.sunrise_sent.get('{}:{}'.format(gateway, light))
+            if sent is None or brightness in sent:
+                return
+        elif brightness in self.prev_brightness:
+            return
+        _log("Unexpected brightness %d of %s:%s", brightness, gateway, light)
+        self.interrupt('lights')
+
     def alarm(self):
         """ Main alarm function. Do one step, watch for interrupts. """
-        def callback_condition():
-            global SOUND
-            if SOUND.is_playing():
-                SOUND.stop()
-                return False
-            return True
-
         self.sound.volume_update()
         if (self.gpio and self.controller.alarm_start or self.check_time()) and \
             self.alarm_started is None and self.timer.enabled:
             # this block will run just once, when the alarm is starting
-            self.alarm_started = datetime.now()
-            self.controller.prev_brightness = 0
-            self.prev_brightness.flush()
+            with self.lock:
+                self.alarm_started = clock.now()
+                self.controller.prev_brightness = 0
+                self.prev_brightness.flush()
+                self.sunrise_step = None
+                self.sunrise_sent = {}
             _log("Should run alarm")
+            self._emit('started', duration=self.duration_sec)
 
-        if not self.alarm_started:
-            if self.brightness_changed():
-                callback_condition()
+        started = self.alarm_started
+        if not started:
+            if self.should_poll() and self.brightness_changed():
+                self.interrupt('lights')
             return
 
-        delta = round((datetime.now() - self.alarm_started).total_seconds() / self.step)
+        delta = round((clock.now() - started).total_seconds() / self.step)
         if delta > self.duration + 1:
             # alarm ended
-            self.controller.callback_condition = callback_condition
-            self.controller.alarm_start = False
-            self.alarm_started = None
+            with self.lock:
+                if self.alarm_started is not started:
+                    return
+                self.controller.alarm_start = False
+                self.alarm_started = None
             self.sound.play()
             _log("Alarm ending")
+            self._emit('ended')
+            self._emit('sound', playing=True, volume=self.sound.volume)
             return
 
-        if self.brightness_changed():
+        if self.should_poll() and self.brightness_changed():
             _log("Unexpected brightness value. Current {}, prev {}".format(
-                self.controller.get_brigtnesses(), self.controller.prev_brightness
+                [br for (_, _, br) in self.controller.last_brightnesses],
+                self.controller.prev_brightness
             ))
-            self.controller.alarm_start = False
-            self.alarm_started = None
-            _log("Alarm aborted")
+            self.interrupt('lights')
+            return
+
+        if self.sunrise is not None:
+            self.sunrise_update(delta, started)
             return
 
         brightness = self.compute_brightness(delta)
         if brightness != self.controller.prev_brightness:
-            _log("setting up brightness: %d" % brightness)
-            self.prev_brightness.put(brightness)
-            self.controller.set_brightness(brightness)
-
-
-class AlarmTimer(object):
-    """ An object encapsulating the set up alarm time operations. """
-    check_delta = timedelta(seconds=30)
-
-    def __init__(self, path : str):
-        """ Argument path: path to the file with set up time """
-        self.path = path
-        self.enabled = False
-        self.load_file()
-        self.last_check = datetime.now()
-        if self.time is None:
-            _log("No file with time exists. ({})".format(self.path))
-
-    def get_time(self):
-        """ Get the time the alarm is set to """
-        return self.time
-
-    def load_file(self):
-        """ Load the set up time form a file (path given to __init__) """
-        def syntax_error(reason):
-            return SyntaxError("Alarm file {} could not be parsed: {}".format(self.path, reason))
-
-        try:
-            with open(self.path, 'r') as f:
-                # read time
-                line = f.readline().strip()
-                if not re.match('[0-9][0-9]:[0-9][0-9]', line):
-                    raise syntax_error("Can't parse the time on line 0: '{}'".format(line))
-                self.time = datetime.strptime(line, '%H:%M').time()
-
-                # try to read enabled/disabled
-                line = f.readline().strip()
-                if line == "disabled":
-                    self.enabled = False
-                elif line == "enabled" or line == '':
-                    self.enabled = True
-                else:
-                    raise syntax_error("There is a garbage on line 1: '{}'".format(line))
-
-        except FileNotFoundError:
-            self.time = None
-        except ValueError as ex:
-            raise SyntaxError("Alarm file {} could not be parsed. Error: '{}'\nFile content: '{}'".format(self.path, ex, line))
-
-    def check_now(self):
-        """ Check if now is the set up time. Check the configured time once in a time. """
-        if self.last_check + self.check_delta < datetime.now() or not self.time:
-            self.load_file()
-
-        if self.time is None:
-            return False
-        return self.time == datetime.now().time().replace(second=0, microsecond=0)
-
-    def set_time(self, when:time, enabled:bool=True):
-        """ Write new time to the file """
-        self.time = when
-        with open(self.path, 'w') as f:
-            f.write('{time}\n{enabled}\n'.format(
-                time = self.time.strftime('%H:%M'),
-                enabled = 'enabled' if enabled else 'disabled'
-            ))
\ No newline at end of file
+            _log("setting up brightness: %d", brightness, level=logger.DEBUG)
+            with self.lock:
+                if self.alarm_started is not started:
+                    return
+                self.prev_brightness.put(brightness)
+                self.controller.set_brightness(brightness, flush=False, skip_known=True)
+            self.controller.flush()
+            self._emit('step', brightness=brightness,
+                       progress=round(min(1.0, delta / self.duration), 3))
@@ -0,0 +1,289 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Button debounce and gestures.
+#
+# Every pin is debounced and tracked on its own, so several buttons can be
+# pressed at once. Recognized gestures:
+#   press   - a short press, sent on release
+#   double  - two short presses within "double_press" seconds; a pin with
+#             a double event sends its press only after that time
+#   long    - held for "long_press" seconds, sent while still held
+#   repeat  - held longer than "repeat_delay", sent every "repeat_interval"
+#             seconds, the interval shrinking by "repeat_accel" down to
+#             "repeat_min"
+#
+# Events and state live in lists indexed by the pin number, times are
+# integer nanoseconds of the monotonic clock, so handling an edge is only
+# a few comparisons and assignments. The timed gestures are sent from a
+# background thread, started only if any of them is bound.
+#
+# An edge to the level the pin already has is a bounce, and so is a press
+# within "debounce" of a release which ended a press. An edge to the same level
+# coming later than "debounce" means the one in between was lost, so the
+# pin is read again; it is also read before a long or repeat event, as a
+# lost release would otherwise keep the button held forever.
+#
+# Configured in the "buttons" part of the config:
+#   "buttons": {
+#       "pins": {"19": {"repeat": "down"}, "12": {"long": "off", "double": "scene:evening"}},
+#       "long_press": 0.8, "double_press": 0.3,
+#       "repeat_delay": 0.5, "repeat_interval": 0.25, "repeat_min": 0.05, "repeat_accel": 0.8
+#   }
+
+import threading
+
+from src import clock
+from src import logger
+
+__all__ = ["ButtonEngine", "PRESS", "DOUBLE", "LONG", "REPEAT", "GESTURES", "TIMINGS"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Buttons", msg, *args, level=level)
+
+PRESS = 'press'
+DOUBLE = 'double'
+LONG = 'long'
+REPEAT = 'repeat'
+GESTURES = (PRESS, DOUBLE, LONG, REPEAT)
+# the timing options and their defaults, in seconds
+TIMINGS = {
+    'debounce': 0.02,
+    'filter': 0.005,
+    'long_press': 0.8,
+    'double_press': 0.3,
+    'repeat_delay': 0.5,
+    'repeat_interval': 0.25,
+    'repeat_min': 0.05,
+    'repeat_accel': 0.8,
+}
+# no deadline
+NEVER = None
+
+def _ns(seconds):
+    return int(seconds * 1e9)
+
+
+class ButtonEngine(object):
+    """ Debounce buttons and turn their edges into gesture events """
+
+    def __init__(self, binding, dispatch, read=None, **timings):
+        """
+            binding: [(pin, event)] or [(pin, {gesture: event})], an event
+                alone is bound to the press gesture
+            dispatch: callable(event, pin) run for every recognized gesture
+            read: callable(pin) returning True if the button is pressed now,
+                None if the pins can't be read
+            timings: TIMINGS to change, in seconds
+        """
+        unknown = set(timings) - set(TIMINGS)
+        if unknown:
+            raise ValueError("Unknown button options {}".format(', '.join(sorted(unknown))))
+        t = dict(TIMINGS, **timings)
+        self.debounce = _ns(t['debounce'])
+        self.filter = _ns(t['filter'])
+        self.long_press = _ns(t['long_press'])
+        self.double_press = _ns(t['double_press'])
+        self.repeat_delay = _ns(t['repeat_delay'])
+        self.repeat_interval = _ns(t['repeat_interval'])
+        self.repeat_min = _ns(t['repeat_min'])
+        self.repeat_accel = t['repeat_accel']
+        self.dispatch = dispatch
+        self.read = read
+
+        self.pins = sorted(set(pin for (pin, _) in binding))
+        size = self.pins[-1] + 1 if self.pins else 0
+        self.size = size
+        # gesture -> [event or None per pin]
+        self.events = dict((gesture, [None] * size) for gesture in GESTURES)
+        for (pin, gestures) in binding:
+            if not isinstance(gestures, dict):
+                gestures = {PRESS: gestures}
+            for (gesture, event) in gestures.items():
+                if gesture not in GESTURES:
+                    raise ValueError("Unknown gesture '{}' of pin {}".format(gesture, pin))
+                self.events[gesture][pin] = event
+        self.bound = [any(self.events[g][pin] is not None for g in GESTURES) for pin in range(size)]
+        self.timed = any(event is not None for gesture in (DOUBLE, LONG, REPEAT)
+                         for event in self.events[gesture])
+
+        # per pin state
+        self.last_edge = [-self.debounce] * size
+        self.held = [False] * size
+        self.down_at = [0] * size
+        # when the last press longer than filter was released
+        self.up_at = [-self.debounce] * size
+        # a gesture was already sent for this press, ignore the release
+        self.consumed = [False] * size
+        # deadlines of the timed gestures
+        self.pending = [NEVER] * size
+        self.long_at = [NEVER] * size
+        self.repeat_at = [NEVER] * size
+        self.repeat_step = [0] * size
+
+        self.ignored = 0
+        self.cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """ Start sending the timed gestures, if there are any """
+        if not self.timed or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="buttons", daemon=True)
+        self._thread.start()
+
+    def _send(self, event, pin):
+        try:
+            self.dispatch(event, pin)
+        except Exception as ex:
+            _log("event %s of pin %d failed: %r", event, pin, ex, level=logger.ERROR)
+
+    def edge(self, pin, pressed, now=None):
+        """ Handle an edge on a pin, pressed is the new level """
+        if now is None:
+            now = clock.monotonic_ns()
+        if pin >= self.size or not self.bound[pin]:
+            _log("edge on an unknown pin %d", pin, level=logger.DEBUG)
+            return
+        event = None
+        with self.cond:
+            if pressed == self.held[pin]:
+                # a bounce, or the edge in between was lost
+                self.ignored += 1
+                if now - self.last_edge[pin] < self.debounce or self.read is None:
+                    return
+                pressed = bool(self.read(pin))
+                if pressed == self.held[pin]:
+                    return
+            if pressed and now - self.up_at[pin] < self.debounce:
+                # the contacts bouncing after a release
+                self.ignored += 1
+                return
+            self.last_edge[pin] = now
+            if pressed:
+                self.held[pin] = True
+                self.down_at[pin] = now
+                self.consumed[pin] = False
+                if self.events[LONG][pin] is not None:
+                    self.long_at[pin] = now + self.long_press
+                    self.cond.notify()
+                if self.events[REPEAT][pin] is not None:
+                    self.repeat_at[pin] = now + self.repeat_delay
+                    self.repeat_step[pin] = self.repeat_interval
+                    self.cond.notify()
+                return
+
+            self._release(pin)
+            duration = now - self.down_at[pin]
+            if duration < self.filter:
+                self.ignored += 1
+                return
+            self.up_at[pin] = now
+            if self.consumed[pin]:
+                return
+            if duration >= self.long_press and self.events[LONG][pin] is not None:
+                event = self.events[LONG][pin]
+            elif self.events[DOUBLE][pin] is not None:
+                if self.pending[pin] is not NEVER:
+                    self.pending[pin] = NEVER
+                    event = self.events[DOUBLE][pin]
+                else:
+                    self.pending[pin] = now + self.double_press
+                    self.cond.notify()
+            else:
+                event = self.events[PRESS][pin]
+        if event is not None:
+            self._send(event, pin)
+
+    def _release(self, pin):
+        self.held[pin] = False
+        self.long_at[pin] = NEVER
+        self.repeat_at[pin] = NEVER
+
+    def _still_held(self, pin):
+        """ Read the pin before a long or repeat event, forget a button
+            released without us seeing it
+        """
+        if self.read is None or self.read(pin):
+            return True
+        _log("lost release on pin %d", pin, level=logger.DEBUG)
+        self._release(pin)
+        self.consumed[pin] = True
+        return False
+
+    def _due(self, now):
+        """ Collect the timed gestures due at now, return [(event, pin)]
+            and the nearest future deadline. Called with the lock held.
+        """
+        due = []
+        deadline = NEVER
+        for pin in self.pins:
+            at = self.pending[pin]
+            if at is not NEVER:
+                if at <= now:
+                    self.pending[pin] = NEVER
+                    if self.events[PRESS][pin] is not None:
+                        due.append((self.events[PRESS][pin], pin))
+                elif deadline is NEVER or at < deadline:
+                    deadline = at
+            if (self.long_at[pin] is not NEVER and self.long_at[pin] <= now or
+                    self.repeat_at[pin] is not NEVER and self.repeat_at[pin] <= now) and \
+                    not self._still_held(pin):
+                continue
+            at = self.long_at[pin]
+            if at is not NEVER:
+                if at <= now:
+                    self.long_at[pin] = NEVER
+                    self.repeat_at[pin] = NEVER
+                    self.consumed[pin] = True
+                    due.append((self.events[LONG][pin], pin))
+                elif deadline is NEVER or at < deadline:
+                    deadline = at
+            at = self.repeat_at[pin]
+            if at is not NEVER:
+                if at <= now:
+                    self.long_at[pin] = NEVER
+                    self.consumed[pin] = True
+                    due.append((self.events[REPEAT][pin], pin))
+                    self.repeat_step[pin] = max(self.repeat_min,
+                                                int(self.repeat_step[pin] * self.repeat_accel))
+                    at = self.repeat_at[pin] = max(at + self.repeat_step[pin], now)
+                if deadline is NEVER or at < deadline:
+                    deadline = at
+        return due, deadline
+
+    def check(self, now=None):
+        """ Send the timed gestures due now, return the nearest deadline """
+        if now is None:
+            now = clock.monotonic_ns()
+        with self.cond:
+            due, deadline = self._due(now)
+        for (event, pin) in due:
+            self._send(event, pin)
+        return deadline
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = clock.monotonic_ns()
+                due, deadline = self._due(now)
+                if not due:
+                    # edge() notifies when it sets a new deadline
+                    self.cond.wait(None if deadline is NEVER else (deadline - now) / 1e9)
+                    continue
+            for (event, pin) in due:
+                self._send(event, pin)
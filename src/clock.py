@@ -0,0 +1,125 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The time as seen by the hub.
+#
+# Everything deciding *when* something happens (alarm schedule, the ramp,
+# polling, debounce, reboots) asks this module instead of datetime and time
+# directly, so a simulation can install a VirtualClock and run days of
+# schedules in seconds. Measurements of real work (latencies, loop ticks,
+# log timestamps) keep using the real time.
+#
+# Usage:
+#   from src import clock
+#   started = clock.now()
+#   clock.sleep(1)
+
+from datetime import datetime
+import threading
+import time as _time
+
+__all__ = ["Clock", "VirtualClock", "SimulationEnd", "CLOCK", "install",
+           "now", "time", "monotonic", "monotonic_ns", "sleep"]
+
+
+class SimulationEnd(BaseException):
+    """ Raised by a VirtualClock reaching its end. It is a BaseException so
+        the main loop's catch-all error handling doesn't swallow it.
+    """
+
+
+class Clock(object):
+    """ The real time """
+
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return _time.time()
+
+    def monotonic(self):
+        return _time.monotonic()
+
+    def monotonic_ns(self):
+        return _time.monotonic_ns()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """ Simulated time, moving only by sleep() """
+
+    def __init__(self, start, speed=None, end=None):
+        """
+            start: the datetime the simulation starts at
+            speed: how many virtual seconds pass in a real second,
+                None to not wait at all
+            end: the datetime at which sleep() raises SimulationEnd
+        """
+        self._time = start.timestamp()
+        self._monotonic = 0.0
+        self.speed = speed
+        self.end = end.timestamp() if end is not None else None
+        self.lock = threading.Lock()
+
+    def now(self):
+        return datetime.fromtimestamp(self._time)
+
+    def time(self):
+        return self._time
+
+    def monotonic(self):
+        return self._monotonic
+
+    def monotonic_ns(self):
+        return int(self._monotonic * 1e9)
+
+    def advance(self, seconds):
+        with self.lock:
+            self._time += seconds
+            self._monotonic += seconds
+        if self.end is not None and self._time >= self.end:
+            raise SimulationEnd()
+
+    def sleep(self, seconds):
+        if self.speed:
+            _time.sleep(seconds / self.speed)
+        self.advance(seconds)
+
+
+CLOCK = Clock()
+
+def install(new):
+    """ Replace the shared clock, to be done before anything else is set up """
+    global CLOCK
+    CLOCK = new
+
+def now():
+    return CLOCK.now()
+
+def time():
+    return CLOCK.time()
+
+def monotonic():
+    return CLOCK.monotonic()
+
+def monotonic_ns():
+    return CLOCK.monotonic_ns()
+
+def sleep(seconds):
+    CLOCK.sleep(seconds)
@@ -15,22 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from datetime import datetime, timedelta
-import RPi.GPIO as GPIO
+import time
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # not a Raspberry Pi, only usable with another gpio (see the simulation)
+    GPIO = None
 
 from huefri.hue import Hue
 from huefri.tradfri import Tradfri
-from huefri.common import log
+from pytradfri.const import ATTR_LIGHT_STATE, ATTR_LIGHT_DIMMER, \
+        ATTR_LIGHT_COLOR_HEX, ATTR_LIGHT_MIREDS
+from src import logger
+from src import telemetry
+from src.buttons import ButtonEngine, PRESS
+from src.gateways import Gateway, GatewayPool, ParsedConfig, gateway_sections
+from src.sender import CommandSender
 
-def _log(msg):
-    log("Controller", msg)
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Controller", msg, *args, level=level)
 
 class Controller(object):
 
-    # delay between two consecutive events on one button, in milliseconds
-    bouncetime = 100
-    # delay before another button is accepted, in milliseconds
-    sequncetime = 200
     # the minimum time a button has to be pressed to register the event, in ms
     filtertime = 5
 
@@ -39,191 +45,361 @@ class Controller(object):
     # function returns true
     callback_condition = None
 
-    def __init__(self, config, binding):
-        """ binding is a list of tuples (pin number, event) """
-        try:
-            self.hue = Hue.autoinit(config)
-        except KeyError:
-            # missing hue config part, try to continue without it
-            self.hue = None
-        try:
-            self.tradfri = Tradfri.autoinit(config, self.hue)
-        except KeyError:
-            # missing tradfri config part, try to continue without it
-            self.tradfri = None
-
-        if self.hue is not None:
-            self.hue.set_tradfri(self.tradfri)
-        elif self.tradfri is not None:
-            self.tradfri.set_hue(None)
-        else:
-            raise ValueError("You have to have at least one hub configured in your configuration file.")
+    # A SceneEngine used for 'scene:<name>' button events and web commands
+    scenes = None
 
-        self._last_event_time = datetime.now() - timedelta(hours=1)
-        self._binding = binding
-        self._last_event = None
-        self._pressed_time = None
-        self._pressed = None
+    # If set to a callable, it is called as change_listener(gateway name, light,
+    # brightness) when a light is seen in another state than we set it to.
+    # It can be called from any thread.
+    change_listener = None
+
+    # The GPIO module the buttons are read with
+    gpio = GPIO
+
+    def __init__(self, config, binding):
+        """ binding is a list of tuples (pin number, event), more gestures
+            can be bound in the "buttons" part of the config
+        """
+        self.config = config
+        cnf = config.get()
+        self.gateways = GatewayPool(connect=self._reconnect)
+        self.gateways.configure(cnf.get('gateways', {}))
+        for (kind, name, section) in gateway_sections(cnf):
+            try:
+                backend = self._autoinit(kind, name, section, config)
+            except KeyError as ex:
+                # incomplete config part, try to continue without this gateway
+                _log("%s: missing %s in the config, skipped", name, ex, level=logger.WARNING)
+                continue
+            self._add_gateway(kind, name, backend, section)
+
+        self._link()
+
+        buttons = dict(cnf.get('buttons', {}))
+        gestures = dict((pin, {PRESS: event}) for (pin, event) in binding)
+        for (pin, extra) in buttons.pop('pins', {}).items():
+            gestures.setdefault(int(pin), {}).update(extra)
+        buttons.setdefault('filter', self.filtertime / 1000)
+        self.buttons = ButtonEngine(sorted(gestures.items()), self.dispatch,
+                                    read=self._pressed, **buttons)
         self.alarm_start = False
         self.prev_brightness = 0
-
-        GPIO.setmode(GPIO.BCM)
-        for (pin, event) in binding:
+        # (backend, light, brightness) seen by the last get_brigtnesses()
+        self.last_brightnesses = []
+
+        if self.gpio is None:
+            raise RuntimeError("RPi.GPIO is not available")
+        gpio = self.gpio
+        gpio.setmode(gpio.BCM)
+        for pin in self.buttons.pins:
             _log("setting up pin %d" % pin)
-            GPIO.setup(pin, GPIO.IN)
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.callback, bouncetime=self.bouncetime)
+            gpio.setup(pin, gpio.IN)
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+            # no bouncetime, GPIO would drop releases too; the ButtonEngine debounces
+            gpio.add_event_detect(pin, gpio.BOTH, callback=self.callback)
+        self.buttons.start()
+
+    @property
+    def hue(self):
+        """ The first Hue bridge, paired with the first Tradfri gateway """
+        return self.gateways.primary('hue')
+
+    @property
+    def tradfri(self):
+        """ The first Tradfri gateway """
+        return self.gateways.primary('tradfri')
+
+    def _autoinit(self, kind, name, section, config):
+        """ Connect to a gateway described by a config section """
+        cfg = ParsedConfig(dict(config.get(), **{kind: section}), config)
+        if kind == 'hue':
+            return Hue.autoinit(cfg)
+        # only the first tradfri gateway is paired with hue
+        first = next((gw for gw in self.gateways if gw.kind == kind), None)
+        paired = first is None or first.name == name
+        return Tradfri.autoinit(cfg, self.hue if paired else None)
+
+    def _add_gateway(self, kind, name, backend, section):
+        gw = Gateway(kind, name, backend, section)
+        gw.sender = CommandSender(gw, self._apply, section.get('state_ttl', 30))
+        self.gateways.add(gw)
+
+    def _reconnect(self, gateway):
+        """ Connect again to a rebooted gateway """
+        backend = self._autoinit(gateway.kind, gateway.name, gateway.section, self.config)
+        gateway.backend = backend
+        gateway.sender.forget()
+        self._link()
+        return backend
+
+    def _link(self):
+        """ Let the hue and tradfri backends know about each other """
+        if not len(self.gateways):
+            raise ValueError("You have to have at least one hub configured in your configuration file.")
+        hue = self.hue
+        tradfri = self.tradfri
+        for gw in self.gateways:
+            if gw.kind == 'hue':
+                gw.backend.set_tradfri(tradfri if gw.backend is hue else None)
+            elif hue is None or gw.backend is not tradfri:
+                gw.backend.set_hue(None)
+
+    def reconfigure(self, kind, old, new, config):
+        """ Apply a changed 'hue' or 'tradfri' config section without touching GPIO.
+            A gateway whose only change are the controlled lights keeps its
+            session, only added or otherwise changed gateways are connected;
+            a replaced gateway is closed. A gateway already running its new
+            section is left alone, so applying a section again after a
+            failure connects only the rest.
+            config: a config object with the new content, for autoinit
+        """
+        old = dict((name, section) for (_, name, section) in
+                   gateway_sections({kind: old}, (kind,)))
+        new = gateway_sections({kind: new}, (kind,))
+        names = set(name for (_, name, _) in new)
+        for name in old:
+            if name not in names:
+                _log("%s: removed", name)
+                self.gateways.remove(name)
+        self.config = config
+        for (_, name, section) in new:
+            gw = self.gateways.get(name)
+            previous = old.get(name)
+            if gw is not None and (previous == section or gw.section == section):
+                continue
+            if gw is not None and previous is not None and \
+                    dict(previous, controlled=None) == dict(section, controlled=None):
+                _log("%s: controlled lights changed to %s", name, section['controlled'])
+                gw.backend.lights_selected = list(section['controlled'])
+                gw.section = section
+                continue
+            _log("%s: connecting with the new configuration", name)
+            self._add_gateway(kind, name, self._autoinit(kind, name, section, config), section)
+        self._link()
 
     def cleanup(self):
-        GPIO.cleanup()
+        self.gpio.cleanup()
+        self.gateways.shutdown()
 
 
-    def pin2event(self, activated_pin):
-        for (pin, event) in self._binding:
-            if activated_pin == pin:
-                return event
-        raise ValueError("Unknown pin %d" % activated_pin)
+    def _pressed(self, pin):
+        return bool(self.gpio.input(pin))
 
     def callback(self, activated_pin):
-        if GPIO.input(activated_pin):
-            # rising edge detected
-            self.callback_rising(activated_pin)
-        else:
-            # falling edge detected
-            self.callback_falling(activated_pin)
-
-    def callback_rising(self, activated_pin):
-        """ Callback called after a button was pressed. """
-        _log("RISING %d" % activated_pin)
-        event = self.pin2event(activated_pin)
-        now = datetime.now()
-
-        if (event == self._last_event and
-                timedelta(milliseconds=self.bouncetime) > (now - self._last_event_time)):
-            # same event, less than bounce time, ignore
-            _log("event %s bounced" % event)
-            return
-        if (event != self._last_event and
-                timedelta(milliseconds=self.sequncetime) > (now - self._last_event_time)):
-            # different event, but less than sequence time, ignore
-            _log("event %s came too soon after the previous one, ignored" % event)
-            return
-
-        self._pressed = activated_pin
-        self._pressed_time = now
-
-
-    def callback_falling(self, activated_pin):
-        """ Callback called after button release. """
-
-        _log("FALLING %d" % activated_pin)
-        if self._pressed is None:
-            _log("release without press? wtf? pin %d" % activated_pin)
-            return
-
-        event = self.pin2event(activated_pin)
-        now = datetime.now()
-
-        if self._pressed != activated_pin:
-            _log("pressed (%d)/released (%d) pin mismatch? o_O"%(self._pressed, activated_pin))
-            return
-        if timedelta(milliseconds=self.filtertime) > (now - self._pressed_time):
-            _log("event %s was too short" % event)
-            return
-
-        self._last_event_time = now
-        self._pressed = None
-        self._last_event = event
-        # GET MILLISECONDS AND COMPARE... skip event if within 300 ms or so
-        # Then add a delta between up/down events and detect those events and require some holding time
+        """ GPIO edge callback """
+        self.buttons.edge(activated_pin, self._pressed(activated_pin))
 
+    def dispatch(self, event, pin):
+        """ Run the event of a recognized button gesture """
+        _log("pin %d: %s", pin, event, level=logger.DEBUG)
         if callable(self.callback_condition):
             if not self.callback_condition():
                 _log("Callback interrupted by condition.")
                 return
 
-        try:
+        if callable(event):
             event(self)
-        except TypeError:
-            if event == 'up':
-                self.up()
-            elif event == 'down':
-                self.down()
-            elif event == 'left':
-                self.left()
-            elif event == 'right':
-                self.right()
-            elif event == 'on':
-                self.on()
-            elif event == 'off':
-                self.off()
-            elif event == 'onoff':
-                self.onoff()
-            elif event == 'alarm':
-                _log("Alarm signal")
-                self.alarm_start = True
-            else:
-                raise ValueError("Unknown event '%s' for known pin %d" % (event, activated_pin))
-
+        elif event == 'up':
+            self.up()
+        elif event == 'down':
+            self.down()
+        elif event == 'left':
+            self.left()
+        elif event == 'right':
+            self.right()
+        elif event == 'on':
+            self.on()
+        elif event == 'off':
+            self.off()
+        elif event == 'onoff':
+            self.onoff()
+        elif event == 'alarm':
+            _log("Alarm signal")
+            self.alarm_start = True
+        elif event.startswith('scene:'):
+            self.scene(event[len('scene:'):])
+        else:
+            raise ValueError("Unknown event '%s' for known pin %d" % (event, pin))
 
     def update(self):
         """ Get updated info from tradfri and hue """
-        if self.tradfri:
-            self.tradfri.changed()
-        if self.hue:
-            self.hue.changed()
-
-    def set_brightness(self, brightness):
+        self.gateways.maintain()
+        self.gateways.fan_out(lambda gw: gw.call(gw.backend.changed))
+        self.flush()
+
+    def _each(self, method, *args):
+        """ Call a backend method on all gateways, in parallel. The result
+            can't be predicted, so the known light states are dropped.
+        """
+        def call(gw):
+            gw.sender.forget()
+            gw.call(getattr(gw.backend, method), *args, cost=max(1, len(gw.lights)))
+        self.gateways.fan_out(call)
+
+    def set_brightness(self, brightness, flush=True, skip_known=False):
         """ Set all connected bulbs to given brightness """
-        if self.hue is not None:
-            self.hue.set_brightness(brightness)
-        if self.tradfri is not None:
-            self.tradfri.set_brightness(brightness)
+        start = time.monotonic()
+        self._set_all(brightness, flush, skip_known)
         self.prev_brightness = brightness
+        telemetry.record('brightness.set', brightness)
+        telemetry.record('latency.set', time.monotonic() - start)
+
+    def _set_all(self, brightness, flush=True, skip_known=False):
+        br = max(0, min(254, brightness))
+        self.apply_states(dict((gw.name, [(light, br, None, None) for light in gw.lights])
+                               for gw in self.gateways), flush, skip_known)
+
+    def apply_states(self, commands, flush=True, skip_known=False):
+        """ Set lights to individual states, one command per light,
+            sent to every gateway as one batch.
+            commands: {gateway name: [(light, brightness, color, ct)]}, where
+            color is a (hex, xy) tuple or None and ct is in mireds or None.
+            What doesn't fit in a gateway's rate budget is sent by the next
+            update().
+            flush: send right away, otherwise only queue them for flush()
+            skip_known: skip lights already known to be in the requested
+                state, for the alarm ramp repeating its steps
+        """
+        start = time.monotonic()
+        for gw in self.gateways:
+            if commands.get(gw.name):
+                gw.sender.queue(commands[gw.name], skip_known)
+        if flush:
+            self.flush()
+        telemetry.record('latency.apply', time.monotonic() - start)
+
+    def cancel_pending(self):
+        """ Drop the queued light commands of all gateways, return how many """
+        return sum(gw.sender.cancel() for gw in self.gateways)
+
+    def flush(self):
+        """ Send the queued light commands of all gateways """
+        targets = [gw for gw in self.gateways.available() if gw.sender.pending]
+        self.gateways.fan_out(lambda gw: gw.sender.flush(), targets)
+
+    def _apply(self, gw, commands):
+        """ Send light states, used by the gateway's CommandSender which
+            already took them from the rate budget
+        """
+        if gw.kind == 'hue':
+            self._apply_hue(gw, commands)
+        else:
+            self._apply_tradfri(gw, commands)
+
+    def _apply_hue(self, gw, commands):
+        """ The Hue bridge can't set different states on several lights in
+            one call, so send one complete state per light.
+        """
+        for (light, brightness, color, ct) in commands:
+            if brightness == 0:
+                gw.call(gw.backend.bridge.lights[light].state, on=False, cost=0)
+                continue
+            state = {'on': True, 'bri': brightness}
+            if color is not None:
+                state['xy'] = color[1]
+            if ct is not None:
+                state['ct'] = ct
+            gw.call(gw.backend.bridge.lights[light].state, cost=0, **state)
+
+    def _apply_tradfri(self, gw, commands):
+        """ Send one command per light, with all its values. The api runs
+            them one after another, a request each, as many as the
+            CommandSender took from the rate budget.
+        """
+        batch = []
+        for (light, brightness, color, ct) in commands:
+            control = gw.backend._lights[light].light_control
+            if brightness == 0:
+                batch.append(control.set_values({ATTR_LIGHT_STATE: 0}))
+                continue
+            values = {ATTR_LIGHT_STATE: 1, ATTR_LIGHT_DIMMER: brightness}
+            if color is not None:
+                values[ATTR_LIGHT_COLOR_HEX] = color[0]
+            if ct is not None:
+                values[ATTR_LIGHT_MIREDS] = ct
+            batch.append(control.set_values(values))
+        if batch:
+            gw.call(gw.backend.api, batch, cost=0)
+
+    def _read(self, gw):
+        """ Return [(light, brightness)] of the lights controlled by a gateway """
+        result = []
+        for light in gw.lights:
+            if gw.kind == 'hue':
+                br = gw.call(gw.backend.bridge.lights[light])['state']['bri']
+            else:
+                bulb = gw.backend._lights[light].light_control.lights[0]
+                br = bulb.dimmer if bulb.state else 0
+            result.append((light, br))
+        return result
 
     def get_brigtnesses(self):
         """ Return a list of current brigthnesses on all connected lights """
-        brightnesses = list()
-        if self.hue is not None:
-            for light in self.hue.lights_selected:
-                brightnesses.append(self.hue.bridge.lights[light]()['state']['bri'])
-
-        if self.tradfri is not None:
-            for light in self.tradfri.lights_selected:
-                br = self.tradfri._lights[light].light_control.lights[0].dimmer
-                if not self.tradfri._lights[light].light_control.lights[0].state:
-                    br = 0
-                brightnesses.append(br)
-
-        return brightnesses
+        start = time.monotonic()
+        results = self.gateways.fan_out(self._read)
+        seen = []
+        changed = []
+        for gw in self.gateways:
+            for (light, br) in results.get(gw.name, []):
+                if gw.sender.observe(light, br):
+                    changed.append((gw.name, light, br))
+                seen.append((gw.name, light, br))
+
+        telemetry.record('latency.get', time.monotonic() - start)
+        for (backend, light, br) in seen:
+            telemetry.record('brightness.{}.{}'.format(backend, light), br)
+        self.last_brightnesses = seen
+        for (backend, light, br) in changed:
+            self.light_changed(backend, light, br)
+        return [br for (_, _, br) in seen]
+
+    def light_changed(self, gateway, light, brightness):
+        """ A light was changed from elsewhere. Called for readings differing
+            from what was sent, and can be called by a gateway notifying about
+            changes, from any thread.
+        """
+        _log("%s:%s changed to %d", gateway, light, brightness, level=logger.DEBUG)
+        if callable(self.change_listener):
+            self.change_listener(gateway, light, brightness)
+
+    def light_states(self):
+        """ Return the lights as seen by the last get_brigtnesses(), without polling """
+        return [{'backend': backend, 'light': light, 'brightness': br}
+                for (backend, light, br) in self.last_brightnesses]
+
+    def command(self, name, argument=None):
+        """ Run a command received from the web interface """
+        if name == 'brightness':
+            _log("brightness %d", argument)
+            self.set_brightness(argument)
+        elif name == 'scene':
+            self.scene(argument)
+        elif name in ('up', 'down', 'left', 'right', 'on', 'off', 'onoff'):
+            getattr(self, name)()
+        else:
+            raise ValueError("Unknown command '%s'" % name)
 
     def up(self):
         _log("up")
-        if self.hue:
-            self.hue.brightness_inc()
-        if self.tradfri:
-            self.tradfri.brightness_inc()
+        self._each('brightness_inc')
 
     def down(self):
         _log("down")
-        if self.hue:
-            self.hue.brightness_dec()
-        if self.tradfri:
-            self.tradfri.brightness_dec()
+        self._each('brightness_dec')
 
     def left(self):
         _log("left")
-        if self.hue:
-            self.hue.color_prev()
-        if self.tradfri:
-            self.tradfri.color_prev()
+        self._each('color_prev')
 
     def right(self):
         _log("right")
-        if self.hue:
-            self.hue.color_next()
-        if self.tradfri:
-            self.tradfri.color_next()
+        self._each('color_next')
+
+    def scene(self, name):
+        _log("scene %s", name)
+        if self.scenes is None:
+            raise ValueError("Scenes are not set up")
+        self.scenes.recall(name)
 
     def onoff(self):
         _log("onoff")
@@ -234,14 +410,8 @@ class Controller(object):
 
     def on(self):
         _log("on")
-        if self.hue:
-            self.hue.set_brightness(255)
-        if self.tradfri:
-            self.tradfri.set_brightness(255)
+        self._set_all(255)
 
     def off(self):
         _log("off")
-        if self.hue:
-            self.hue.set_brightness(0)
-        if self.tradfri:
-            self.tradfri.set_brightness(0)
+        self._set_all(0)
@@ -0,0 +1,231 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# On-demand diagnostics of a running hub.
+#
+# A request (SIGUSR1 or the web API) only sets a flag, a watcher thread
+# picks it up and writes a report with stacks of all threads (the main
+# thread first), loop tick timing and whatever the registered sources
+# return (queue depths, backend health, ...). The signal handler doesn't
+# even take a lock, as it can interrupt the main thread anywhere; the
+# watcher looks at its flag every SIGNAL_POLL seconds. Not depending on the main
+# loop, the report also comes when it hangs, showing where it is stuck.
+# It also starts a sampling profiler for a while;
+# another request during that window stops it early. The profile is
+# written as collapsed stacks ("a;b;c count"), ready for flamegraph.pl.
+
+from collections import deque, Counter
+import datetime
+import os
+import sys
+import threading
+import time
+import traceback
+
+from src import logger
+
+__all__ = ["Diagnostics", "SamplingProfiler"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Diagnostics", msg, *args, level=level)
+
+
+class SamplingProfiler(object):
+    """ Periodically sample stacks of all threads from a background thread """
+
+    def __init__(self, interval=0.01, depth=30):
+        self.interval = interval
+        self.depth = depth
+        self.samples = Counter()
+        self.count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, on_finish=None):
+        """ Sample for duration seconds, then call on_finish(self) """
+        self.samples = Counter()
+        self.count = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(duration, on_finish),
+                                         name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, duration, on_finish):
+        me = threading.get_ident()
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        end = time.monotonic() + duration
+        while not self._stop.wait(self.interval) and time.monotonic() < end:
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.count += 1
+        if on_finish is not None:
+            on_finish(self)
+
+    def collapsed(self):
+        """ Return the samples in the collapsed stack format """
+        return ''.join('{} {}\n'.format(stack, n) for (stack, n) in self.samples.most_common())
+
+
+class Diagnostics(object):
+    """ Collect and write diagnostic reports on request """
+
+    # how often the watcher looks for a signal, in seconds
+    SIGNAL_POLL = 0.5
+
+    def __init__(self, directory, profile_time=30, ticks=600):
+        """
+            directory: where the reports are written
+            profile_time: how long the profiler runs after a request, in seconds
+            ticks: how many loop tick durations are kept
+        """
+        self.directory = directory
+        self.profile_time = profile_time
+        self.ticks = deque(maxlen=ticks)
+        self.sources = {}
+        self.profiler = SamplingProfiler()
+        self._requested = threading.Event()
+        # set by the signal handler, which can't take the event's lock
+        self._signalled = False
+        self._thread = None
+        # monotonic time of the end of the last tick
+        self.last_tick = None
+
+    def request(self):
+        """ Ask for a report """
+        self._requested.set()
+
+    def signal(self, signum, frame):
+        """ A signal handler asking for a report; only sets a flag, as the
+            interrupted thread might be inside request()
+        """
+        self._signalled = True
+
+    def add_source(self, name, source):
+        """ Register a callable returning something printable for the report """
+        self.sources[name] = source
+
+    def tick(self, duration):
+        """ Record how long one main loop iteration took, in seconds """
+        self.ticks.append(duration)
+        self.last_tick = time.monotonic()
+
+    def start(self):
+        """ Serve the requests from a thread of its own """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._watch, name="diagnostics", daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            self._requested.wait(self.SIGNAL_POLL)
+            if self._signalled:
+                self._signalled = False
+                self._requested.set()
+            try:
+                self.check()
+            except Exception as ex:
+                _log("diagnostics failed: %r", ex, level=logger.ERROR)
+
+    def check(self):
+        """ Write a report if one was requested """
+        if not self._requested.is_set():
+            return None
+        self._requested.clear()
+        if self.profiler.running():
+            _log("stopping the profiler early")
+            self.profiler.stop()
+            return None
+        path = self.dump()
+        self.profiler.start(self.profile_time, self._write_profile)
+        _log("profiling for %d seconds", self.profile_time)
+        return path
+
+    def _path(self, kind):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '{}-{}.txt'.format(
+            kind, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+    def _write_profile(self, profiler):
+        path = self._path('profile')
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+        _log("profile with %d samples written to %s", profiler.count, path)
+
+    def tick_stats(self):
+        """ Return min/mean/p95/max of the recorded loop ticks, in milliseconds """
+        ticks = sorted(self.ticks)
+        if not ticks:
+            return {}
+        return {
+            'count': len(ticks),
+            'min': round(ticks[0] * 1000, 2),
+            'mean': round(sum(ticks) / len(ticks) * 1000, 2),
+            'p95': round(ticks[min(len(ticks) - 1, int(len(ticks) * 0.95))] * 1000, 2),
+            'max': round(ticks[-1] * 1000, 2),
+        }
+
+    def report(self):
+        """ Return the report as a string """
+        lines = ['Diagnostics of pid {} at {}'.format(os.getpid(), datetime.datetime.now()), '']
+        lines.append('== Loop ticks (ms) ==')
+        lines.append(str(self.tick_stats()))
+        if self.last_tick is not None:
+            lines.append('the last tick ended {:.1f} s ago'.format(time.monotonic() - self.last_tick))
+        for (name, source) in sorted(self.sources.items()):
+            lines.append('')
+            lines.append('== {} =='.format(name))
+            try:
+                lines.append(str(source()))
+            except Exception as ex:
+                lines.append('failed: {!r}'.format(ex))
+        lines.append('')
+        lines.append('== Threads ==')
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        main = threading.main_thread().ident
+        frames = sorted(sys._current_frames().items(), key=lambda item: item[0] != main)
+        for (ident, frame) in frames:
+            lines.append('-- {} ({}) --'.format(names.get(ident, '?'), ident))
+            lines.append(''.join(traceback.format_stack(frame)).rstrip())
+        lines.append('')
+        lines.append('== Recent log ==')
+        for (stamp, module, _, text) in logger.recent(100):
+            lines.append('{} [{}] {}'.format(
+                datetime.datetime.fromtimestamp(stamp).strftime('%H:%M:%S.%f'), module, text))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        """ Write the report to a file, return its path """
+        path = self._path('diagnostics')
+        with open(path, 'w') as f:
+            f.write(self.report())
+        _log("diagnostics written to %s", path)
+        return path
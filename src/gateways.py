@@ -0,0 +1,411 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Several Hue bridges and Tradfri gateways.
+#
+# The "hue" and "tradfri" config sections can be a single object, as
+# before, or a list of them. Every gateway controls its own lights, so the
+# lights are sharded by the config, and the gateway name is the backend
+# part of "backend:light" keys used by scenes and the sunrise. The first
+# gateway of a kind is named after it ("tradfri"), the others take their
+# "name", or get a number ("tradfri2").
+#
+# Commands for several gateways are sent in parallel, one thread per
+# gateway. A failing gateway is paused for a while (with a growing backoff)
+# and doesn't stop the others; only when all of them fail is the error
+# raised to the caller. Every gateway can have a rate budget:
+#   "tradfri": [{"addr": ..., "rate": 10, "burst": 20}, ...]
+# and the Tradfri gateways are rebooted one after another:
+#   "gateways": {"reboot_hour": 4, "reboot_stagger": 15}
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import time
+
+from src import clock
+from src import logger
+from src import telemetry
+
+__all__ = ["KINDS", "Gateway", "GatewayPool", "ParsedConfig", "RateBudget", "gateway_sections"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Gateways", msg, *args, level=level)
+
+KINDS = ('hue', 'tradfri')
+# gateways of these kinds are rebooted every day
+REBOOT_KINDS = ('tradfri',)
+
+
+class ParsedConfig(object):
+    """ huefri's Config interface over an already loaded dict """
+
+    def __init__(self, data, base):
+        """ data: the config content, base: the Config used for everything else """
+        self.data = data
+        self.base = base
+
+    def get(self):
+        return self.data
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+
+def gateway_sections(cnf, kinds=KINDS):
+    """ Return [(kind, name, section)] of all gateways in the config """
+    result = []
+    names = set()
+    for kind in kinds:
+        sections = cnf.get(kind)
+        if sections is None:
+            continue
+        if isinstance(sections, dict):
+            sections = [sections]
+        for (i, section) in enumerate(sections):
+            name = section.get('name', kind if i == 0 else '{}{}'.format(kind, i + 1))
+            if ':' in name:
+                raise ValueError("Gateway name '{}' can't contain ':'".format(name))
+            if name in names:
+                raise ValueError("Gateway name '{}' is used twice".format(name))
+            names.add(name)
+            result.append((kind, name, section))
+    return result
+
+
+class RateBudget(object):
+    """ A token bucket allowing rate commands a second on average,
+        and up to burst of them at once.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=clock.monotonic):
+        """ rate: commands a second, None for no limit """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 0)
+        self.tokens = self.burst
+        self.clock = clock
+        self.stamp = clock()
+        self.lock = threading.Lock()
+        # seconds spent waiting for the budget
+        self.waited = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, cost=1):
+        """ Take cost tokens, return how many seconds to wait before sending """
+        if not self.rate:
+            return 0
+        with self.lock:
+            self._refill()
+            self.tokens -= cost
+            return max(0, -self.tokens / self.rate)
+
+    def take(self, most):
+        """ Take up to most tokens without waiting, return how many were taken """
+        if not self.rate:
+            return most
+        with self.lock:
+            self._refill()
+            count = max(0, min(most, int(self.tokens)))
+            self.tokens -= count
+            return count
+
+    def acquire(self, cost=1):
+        """ Wait until cost commands can be sent """
+        wait = self.delay(cost)
+        if wait:
+            self.waited += wait
+            clock.sleep(wait)
+
+
+class Gateway(object):
+    """ One Hue bridge or Tradfri gateway, its health and rate budget """
+
+    # seconds a rebooted gateway is left alone before connecting again
+    REBOOT_TIME = 60
+    # the longest pause after failures, in seconds
+    MAX_BACKOFF = 60
+
+    def __init__(self, kind, name, backend, section=None):
+        """ backend: the huefri Hue or Tradfri object
+            section: the config of this gateway
+        """
+        self.kind = kind
+        self.name = name
+        self.backend = backend
+        self.section = section or {}
+        self.budget = RateBudget(self.section.get('rate'), self.section.get('burst'))
+        self.calls = 0
+        self.failures = 0
+        self.consecutive = 0
+        self.last_error = None
+        self.latency = None
+        self.rebooting = False
+        self.last_reboot = None
+        # monotonic time until which the gateway is not used
+        self.down_until = None
+        # a CommandSender for light states, if any
+        self.sender = None
+
+    @property
+    def lights(self):
+        return self.backend.lights_selected
+
+    def call(self, func, *args, cost=1, **kwargs):
+        """ Call func within the rate budget, cost is the number of commands """
+        self.budget.acquire(cost)
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        self.latency = time.monotonic() - start
+        self.calls += 1
+        telemetry.record('latency.gateway.{}'.format(self.name), self.latency)
+        return result
+
+    def succeeded(self):
+        self.consecutive = 0
+        self.down_until = None
+
+    def failed(self, ex):
+        """ Count a failure and pause the gateway for a while """
+        self.failures += 1
+        self.consecutive += 1
+        self.last_error = repr(ex)
+        self.down_until = clock.monotonic() + min(2 ** self.consecutive, self.MAX_BACKOFF)
+        telemetry.record('errors.gateway.{}'.format(self.name), 1)
+
+    def available(self, now):
+        return self.down_until is None or now >= self.down_until
+
+    def state(self):
+        if self.rebooting:
+            return 'rebooting'
+        if self.consecutive:
+            return 'failing'
+        return 'ok'
+
+    def status(self):
+        """ A short description, changing only when something happens """
+        return {
+            'kind': self.kind,
+            'state': self.state(),
+            'lights': list(self.lights),
+            'failures': self.failures,
+        }
+
+    def close(self):
+        """ Drop the queued commands and let the backend go, for a gateway
+            which was removed or replaced
+        """
+        if self.sender is not None:
+            self.sender.cancel()
+        for name in ('shutdown', 'close'):
+            func = getattr(self.backend, name, None)
+            if callable(func):
+                try:
+                    func()
+                except Exception as ex:
+                    _log("Closing %s failed: %r", self.name, ex, level=logger.WARNING)
+                return
+
+    def health(self):
+        """ A detailed description for diagnostics """
+        return dict(self.status(),
+                    commands=self.sender.counters() if self.sender is not None else None,
+                    calls=self.calls,
+                    consecutive=self.consecutive,
+                    last_error=self.last_error,
+                    latency_ms=None if self.latency is None else round(self.latency * 1000, 1),
+                    last_reboot=None if self.last_reboot is None else str(self.last_reboot),
+                    rate=self.budget.rate,
+                    waited=round(self.budget.waited, 3))
+
+
+class GatewayPool(object):
+    """ All gateways, sending commands to them in parallel """
+
+    def __init__(self, connect=None, reboot_hour=4, reboot_stagger=15):
+        """
+            connect: callable(gateway) returning a new backend, used after a reboot
+            reboot_hour: when the first gateway is rebooted every day
+            reboot_stagger: minutes between reboots of two gateways
+        """
+        self.gateways = []
+        self.connect = connect
+        self.reboot_hour = reboot_hour
+        self.reboot_stagger = reboot_stagger
+        self.created = clock.now()
+        self._executor = None
+        self._workers = 0
+        # fan_out() runs from the main loop, the buttons and the web server
+        self._pool_lock = threading.Lock()
+
+    def configure(self, cnf):
+        """ Apply the "gateways" config section """
+        self.reboot_hour = cnf.get('reboot_hour', 4)
+        self.reboot_stagger = cnf.get('reboot_stagger', 15)
+
+    def __iter__(self):
+        return iter(list(self.gateways))
+
+    def __len__(self):
+        return len(self.gateways)
+
+    def get(self, name):
+        for gw in self.gateways:
+            if gw.name == name:
+                return gw
+        return None
+
+    def add(self, gateway):
+        """ Add a gateway, or replace the one with the same name in place """
+        for (i, gw) in enumerate(self.gateways):
+            if gw.name == gateway.name:
+                self.gateways[i] = gateway
+                if gw is not gateway:
+                    gw.close()
+                return
+        self.gateways.append(gateway)
+
+    def remove(self, name):
+        removed = [gw for gw in self.gateways if gw.name == name]
+        self.gateways = [gw for gw in self.gateways if gw.name != name]
+        for gw in removed:
+            gw.close()
+
+    def primary(self, kind):
+        """ Return the backend of the first gateway of a kind, or None """
+        for gw in self.gateways:
+            if gw.kind == kind:
+                return gw.backend
+        return None
+
+    def available(self):
+        """ Return the gateways which can be used now. A lone gateway is
+            never paused, there is nothing else to fall back to.
+        """
+        now = clock.monotonic()
+        return [gw for gw in self.gateways
+                if not gw.rebooting and (len(self.gateways) == 1 or gw.available(now))]
+
+    def _pool(self, workers):
+        """ Return an executor with enough workers, called with _pool_lock held """
+        if self._executor is None or self._workers < workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=workers,
+                                                thread_name_prefix='gateway')
+            self._workers = workers
+        return self._executor
+
+    def fan_out(self, func, gateways=None):
+        """ Run func(gateway) on the available gateways, in parallel if there
+            are more of them. Return {name: result} of those which succeeded.
+            A failing gateway is logged and paused, the error is raised only
+            when all of them failed.
+        """
+        if gateways is None:
+            gateways = self.available()
+        if not gateways:
+            return {}
+        if len(gateways) == 1:
+            gw = gateways[0]
+            try:
+                result = func(gw)
+            except Exception as ex:
+                gw.failed(ex)
+                raise
+            gw.succeeded()
+            return {gw.name: result}
+
+        with self._pool_lock:
+            # submitted before anyone can replace the executor
+            executor = self._pool(len(gateways))
+            futures = [(gw, executor.submit(func, gw)) for gw in gateways]
+        results = {}
+        errors = []
+        for (gw, future) in futures:
+            try:
+                results[gw.name] = future.result()
+            except Exception as ex:
+                gw.failed(ex)
+                errors.append(ex)
+                _log("%s failed: %r", gw.name, ex, level=logger.WARNING)
+            else:
+                gw.succeeded()
+        if errors and not results:
+            raise errors[0]
+        return results
+
+    def reboot_due(self, now):
+        """ Return the gateway which should be rebooted now, or None.
+            The gateways are rebooted one after another, reboot_stagger minutes
+            apart from reboot_hour on, and never while another one is down.
+            A gateway connected after its time slot waits for the next day.
+        """
+        if any(gw.rebooting for gw in self.gateways):
+            return None
+        start = now.replace(hour=self.reboot_hour, minute=0, second=0, microsecond=0)
+        rebootable = [gw for gw in self.gateways if gw.kind in REBOOT_KINDS]
+        for (i, gw) in enumerate(rebootable):
+            slot = start + timedelta(minutes=i * self.reboot_stagger)
+            last = gw.last_reboot or self.created
+            if slot <= now < slot + timedelta(hours=1) and last < slot:
+                return gw
+        return None
+
+    def reboot(self, gw):
+        """ Reboot a gateway, it is connected again by maintain() when it is back """
+        _log("Time for reboot of %s...", gw.name)
+        gw.rebooting = True
+        gw.last_reboot = clock.now()
+        gw.down_until = clock.monotonic() + gw.REBOOT_TIME
+        try:
+            gw.backend.reboot()
+        except Exception as ex:
+            _log("Reboot of %s failed: %r", gw.name, ex, level=logger.WARNING)
+
+    def maintain(self):
+        """ Connect again to rebooted gateways. To be called periodically. """
+        now = clock.monotonic()
+        for gw in self:
+            if not gw.rebooting or now < gw.down_until:
+                continue
+            try:
+                gw.backend = self.connect(gw)
+            except Exception as ex:
+                _log("%s is not back yet: %r", gw.name, ex, level=logger.WARNING)
+                gw.down_until = now + 10
+                continue
+            gw.rebooting = False
+            gw.succeeded()
+            _log("%s is back", gw.name)
+
+    def status(self):
+        return dict((gw.name, gw.status()) for gw in self.gateways)
+
+    def health(self):
+        return dict((gw.name, gw.health()) for gw in self.gateways)
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                self._workers = 0
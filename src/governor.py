@@ -0,0 +1,97 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Decide when the alarm has to poll the lights for manual changes.
+#
+# Polling every bulb on every gateway is only needed while there is
+# something to react to:
+#   ramp     - the alarm is brightening, poll every "fast" seconds
+#   sound    - the sound is playing, poll every "fast" seconds
+#   standby  - an alarm starts within "standby" seconds, or the ramp or
+#              sound ended less than "cooldown" seconds ago; poll every
+#              "slow" seconds to keep the known state fresh
+#   idle     - nothing to detect; poll every "idle" seconds (the standby
+#              window by default) only so the lights shown by the web
+#              server follow changes made from a switch or another app
+#
+# Configured in the "polling" part of the alarm config:
+#   "polling": {"fast": 1, "slow": 30, "standby": 300, "cooldown": 300, "idle": 300}
+
+__all__ = ["PollingGovernor", "IDLE", "STANDBY", "RAMP", "SOUND"]
+
+# the main loop ticks once a second with some jitter, accept a poll this
+# much sooner than the interval says
+TOLERANCE = 0.5
+
+IDLE = 'idle'
+STANDBY = 'standby'
+RAMP = 'ramp'
+SOUND = 'sound'
+
+class PollingGovernor(object):
+    """ Pick a polling interval based on what the alarm is doing """
+
+    def __init__(self, fast=1, slow=30, standby=300, cooldown=300, idle=None):
+        """ All values are in seconds, idle defaults to standby """
+        self.intervals = {
+            IDLE: standby if idle is None else idle,
+            STANDBY: slow,
+            RAMP: fast,
+            SOUND: fast,
+        }
+        self.standby = standby
+        self.cooldown = cooldown
+        self.phase = IDLE
+        self.last_poll = None
+        self.last_active = None
+        self.polls = 0
+
+    @classmethod
+    def from_config(cls, cnf):
+        """ Create a governor from the "polling" config dict """
+        return cls(**dict((k, cnf[k]) for k in ('fast', 'slow', 'standby', 'cooldown', 'idle')
+                        if k in cnf))
+
+    def update(self, now, ramping, sound, next_alarm=None):
+        """ Set the current phase and return it.
+            now: current time in seconds (any monotonic clock)
+            ramping, sound: whether the ramp runs and the sound plays
+            next_alarm: seconds until the next enabled alarm, None if there is none
+        """
+        if ramping:
+            self.phase = RAMP
+        elif sound:
+            self.phase = SOUND
+        elif (next_alarm is not None and next_alarm <= self.standby) or \
+                (self.last_active is not None and now - self.last_active < self.cooldown):
+            self.phase = STANDBY
+        else:
+            self.phase = IDLE
+        if ramping or sound:
+            self.last_active = now
+        return self.phase
+
+    def should_poll(self, now, ramping, sound, next_alarm=None):
+        """ Update the phase, return True if the lights should be polled now """
+        interval = self.intervals[self.update(now, ramping, sound, next_alarm)]
+        if interval is None:
+            return False
+        if self.last_poll is not None and now - self.last_poll < interval - TOLERANCE:
+            return False
+        self.last_poll = now
+        self.polls += 1
+        return True
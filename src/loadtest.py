@@ -0,0 +1,630 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Load and soak test of the web server.
+#
+#   ./loadtest.py --duration 4h --clients 8 --slow 20
+#
+# starts a WebGUI on a free port with a throwaway state file, next to a
+# stand-in of the hub's main loop (draining commands and publishing state
+# every tick), and runs for the given time:
+#   clients     - threads sending a mix of GET and POST API requests, as
+#                 fast as possible or at --rate requests a second in total
+#   subscribers - /api/events streams, reconnecting every now and then
+#   slow        - slowloris-like clients sending their headers a line at a
+#                 time and never finishing them
+# Every --sample seconds a line with throughput, latency percentiles, the
+# server's open file descriptors, RSS and threads, and the main loop tick
+# lateness is printed; the end report compares the first and last sample
+# and the tick lateness without and with the load.
+#
+# With our own server, the clients run in a separate process: in the thread
+# mode the server shares the GIL with the main loop, as it does in the hub,
+# but not with the clients, so the ticks are late only because of the server.
+#
+# With --port (and optionally --pid) a running hub is tested instead; only
+# read requests are sent then, unless --writes is given, and the tick
+# timing can't be measured from outside (see the diagnostics report).
+
+from collections import Counter
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import tempfile
+import threading
+import time
+
+from src import logger
+from src import telemetry
+from src.timer import AlarmTimer
+from src.webgui import WebGUI
+
+__all__ = ["Histogram", "LoadTest", "READ_MIX", "WRITE_MIX", "free_port",
+           "parse_duration", "process_stats"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("LoadTest", msg, *args, level=level)
+
+# (weight, method, path, body); a body of 'etag' sends If-None-Match
+READ_MIX = [
+    (20, 'GET', '/api/state', None),
+    (20, 'GET', '/api/state', 'etag'),
+    (10, 'GET', '/api/alarm', None),
+    (10, 'GET', '/api/lights', None),
+    (5, 'GET', '/api/gateways', None),
+    (5, 'GET', '/api/telemetry', None),
+    (5, 'GET', '/', None),
+]
+# requests changing the alarm and the lights, sent only to our own server
+# unless asked for
+# (bodies are module functions, so the mix can be sent to the load process)
+def _brightness():
+    return {'brightness': random.randint(0, 254)}
+
+def _alarm():
+    return {'time': '07:{:02d}'.format(random.randint(0, 59))}
+
+def _batch():
+    return [{'path': '/api/lights', 'body': {'action': 'up'}},
+            {'path': '/api/lights', 'body': {'action': 'down'}}]
+
+WRITE_MIX = READ_MIX + [
+    (10, 'POST', '/api/lights', _brightness),
+    (5, 'POST', '/api/alarm', _alarm),
+    (5, 'POST', '/api/batch', _batch),
+]
+
+
+def parse_duration(text):
+    """ Return seconds of "90", "90s", "30m" or "4h" """
+    text = str(text).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def free_port():
+    """ Return a TCP port nobody listens on right now """
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def process_stats(pid=None):
+    """ Return {fds, rss_kb, threads} of a process, None for what can't be read """
+    pid = pid or os.getpid()
+    stats = {'fds': None, 'rss_kb': None, 'threads': None}
+    try:
+        stats['fds'] = len(os.listdir('/proc/{}/fd'.format(pid)))
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+    except OSError:
+        if pid == os.getpid():
+            # no /proc, the peak is the best we have
+            stats['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            stats['threads'] = threading.active_count()
+    return stats
+
+
+class Histogram(object):
+    """ Durations in logarithmic buckets, so hours of samples take a fixed
+        amount of memory. Percentiles are accurate to the bucket width (5 %).
+    """
+
+    LOWEST = 1e-5
+    GROWTH = 1.05
+    SIZE = 400
+
+    def __init__(self):
+        self.buckets = [0] * self.SIZE
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.LOWEST:
+            i = 0
+        else:
+            i = min(self.SIZE - 1, 1 + int(math.log(seconds / self.LOWEST, self.GROWTH)))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for (i, n) in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """ Return the upper bound of the bucket holding the p-th percentile """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.max, self.LOWEST * self.GROWTH ** i)
+        return self.max
+
+    def summary(self):
+        """ Return {count, mean, p50, p90, p99, p999, max} in milliseconds """
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+        return {
+            'count': self.count,
+            'mean': ms(self.total / self.count) if self.count else None,
+            'p50': ms(self.percentile(50)),
+            'p90': ms(self.percentile(90)),
+            'p99': ms(self.percentile(99)),
+            'p999': ms(self.percentile(99.9)),
+            'max': ms(self.max) if self.count else None,
+        }
+
+
+class _Window(object):
+    """ Results since the last sample, collected from all threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latency = Histogram()
+        self.ticks = Histogram()
+        self.codes = Counter()
+        self.errors = Counter()
+        self.events = 0
+
+    def take(self):
+        with self.lock:
+            window = (self.latency, self.ticks, self.codes, self.errors, self.events)
+            self.reset()
+        return window
+
+
+class LoadTest(object):
+    """ Drive a web server with clients, slow clients and event subscribers,
+        and watch it and the main loop ticks while doing so.
+    """
+
+    def __init__(self, host='localhost', port=None, pid=None, mode='thread', clients=8,
+                 rate=None, subscribers=2, slow=10, slow_interval=10, mix=None,
+                 tick=1.0, timeout=10):
+        """
+            port: a running server to test, None to start our own WebGUI
+            pid: the process of the running server, for fds and memory
+            mode: the WebGUI mode of our own server
+            clients: threads sending requests
+            rate: requests a second of all clients together, None for no limit
+            subscribers: /api/events streams kept open
+            slow: slow clients, sending a header line every slow_interval seconds
+            mix: [(weight, method, path, body)], READ_MIX or WRITE_MIX by default
+            tick: seconds between ticks of the main loop stand-in
+            timeout: seconds before a request counts as failed
+        """
+        self.host = host
+        self.port = port
+        self.pid = pid
+        self.mode = mode
+        self.clients = clients
+        self.rate = rate
+        self.subscribers = subscribers
+        self.slow = slow
+        self.slow_interval = slow_interval
+        self.tick = tick
+        self.timeout = timeout
+        if mix is None:
+            mix = READ_MIX if port is not None else WRITE_MIX
+        self.mix = mix
+        self._weights = [weight for (weight, _, _, _) in mix]
+
+        self.webgui = None
+        self.directory = None
+        self.window = _Window()
+        self.latency = Histogram()
+        self.codes = Counter()
+        self.errors = Counter()
+        self.events = 0
+        # tick lateness without and with the load
+        self.baseline = Histogram()
+        self.loaded = Histogram()
+        self.samples = []
+        self.slow_open = 0
+        self.slow_dropped = 0
+        self._loading = False
+        self._stop = threading.Event()
+        self._threads = []
+        self._etags = {}
+        # (process, pipe) sending the load when we run the server too
+        self._load = None
+
+    # -- the server and the main loop --
+
+    def start_server(self):
+        """ Start our own WebGUI and the main loop stand-in, unless testing a running one """
+        if self.port is not None:
+            return
+        self.directory = tempfile.TemporaryDirectory(prefix='hub-loadtest-')
+        state_file = os.path.join(self.directory.name, 'hub_state.json')
+        telemetry_file = os.path.join(self.directory.name, 'telemetry.json')
+        self.port = free_port()
+        self.webgui = WebGUI(state_file, telemetry_file, mode=self.mode, port=self.port,
+                             timer=AlarmTimer(state_file), telemetry=telemetry.TELEMETRY)
+        self.webgui.run()
+        if self.webgui.proc is not None:
+            self.pid = self.webgui.proc.pid
+        self._wait_listening()
+        self._spawn(self._main_loop, 'loadtest-loop')
+
+    def _wait_listening(self, timeout=10):
+        end = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection((self.host, self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > end:
+                    raise
+                time.sleep(0.05)
+
+    def _main_loop(self):
+        """ Do what hub.run() does with the web server every tick and
+            measure how late the ticks are.
+        """
+        brightness = 0
+        lights = [{'backend': 'tradfri', 'light': i, 'brightness': 0} for i in range(4)]
+        deadline = time.monotonic() + self.tick
+        while not self._stop.is_set():
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            late = max(0.0, time.monotonic() - deadline)
+            deadline += self.tick
+            with self.window.lock:
+                (self.loaded if self._loading else self.baseline).add(late)
+                self.window.ticks.add(late)
+            for (command, argument) in self.webgui.pending_commands():
+                if command == 'brightness':
+                    brightness = argument
+            # a light changes now and then, like during a sunrise
+            brightness = (brightness + 1) % 255
+            i = brightness % len(lights)
+            lights[i] = dict(lights[i], brightness=brightness)
+            self.webgui.publish({'lights': list(lights),
+                                 'progress': {'running': False},
+                                 'gateways': {'tradfri': {'state': 'ok'}}})
+            telemetry.record('loadtest.tick_late', late)
+            telemetry.TELEMETRY.save_every(self.webgui.telemetry_file, 10)
+
+    # -- the clients --
+
+    def _spawn(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def request(self, method, path, body=None):
+        """ Send one request, return the HTTP status """
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            headers = {}
+            data = None
+            if body == 'etag':
+                etag = self._etags.get(path)
+                if etag:
+                    headers['If-None-Match'] = etag
+            elif body is not None:
+                data = json.dumps(body() if callable(body) else body)
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+            response.read()
+            etag = response.getheader('ETag')
+            if etag:
+                self._etags[path] = etag
+            return response.status
+        finally:
+            conn.close()
+
+    def _client(self, interval):
+        """ Send requests from the mix, one every interval seconds if given """
+        scheduled = time.monotonic()
+        while not self._stop.is_set():
+            if interval:
+                # latency is counted from when the request should have gone out,
+                # so a stalled server isn't hidden by the client waiting for it
+                scheduled += interval
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    self._stop.wait(delay)
+                start = scheduled
+            else:
+                start = time.monotonic()
+            (_, method, path, body) = random.choices(self.mix, self._weights)[0]
+            try:
+                status = self.request(method, path, body)
+                error = 'HTTP {}'.format(status) if status >= 500 else None
+            except (OSError, http.client.HTTPException) as ex:
+                status = None
+                error = type(ex).__name__
+            elapsed = time.monotonic() - start
+            with self.window.lock:
+                self.window.latency.add(elapsed)
+                if status is not None:
+                    self.window.codes[status] += 1
+                if error is not None:
+                    self.window.errors[error] += 1
+
+    def _subscriber(self, hold):
+        """ Keep an event stream open, reconnect every hold seconds """
+        while not self._stop.is_set():
+            try:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                conn.request('GET', '/api/events')
+                response = conn.getresponse()
+                if response.status != 200:
+                    # over the subscriber limit
+                    with self.window.lock:
+                        self.window.codes[response.status] += 1
+                    conn.close()
+                    self._stop.wait(1)
+                    continue
+                end = time.monotonic() + hold
+                while time.monotonic() < end and not self._stop.is_set():
+                    line = response.fp.readline()
+                    if not line:
+                        break
+                    if line.startswith(b'event:'):
+                        with self.window.lock:
+                            self.window.events += 1
+                conn.close()
+            except (OSError, http.client.HTTPException) as ex:
+                with self.window.lock:
+                    self.window.errors['events ' + type(ex).__name__] += 1
+                self._stop.wait(1)
+
+    def _slow_clients(self):
+        """ Hold self.slow connections with never-ending headers """
+        sockets = []
+        line = 0
+        while not self._stop.is_set():
+            while len(sockets) < self.slow:
+                try:
+                    s = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                    s.sendall(b'GET /api/state HTTP/1.1\r\nHost: loadtest\r\n')
+                    sockets.append(s)
+                except OSError:
+                    self.slow_dropped += 1
+                    break
+            self.slow_open = len(sockets)
+            self._stop.wait(self.slow_interval)
+            line += 1
+            alive = []
+            for s in sockets:
+                try:
+                    s.sendall('X-Slow-{}: 1\r\n'.format(line).encode())
+                    alive.append(s)
+                except OSError:
+                    # the server gave up on it
+                    self.slow_dropped += 1
+                    s.close()
+            sockets = alive
+        for s in sockets:
+            # finish the request, the server would answer into a closed socket
+            try:
+                s.sendall(b'\r\n')
+                while s.recv(4096):
+                    pass
+            except OSError:
+                pass
+            s.close()
+
+    def start_load(self):
+        """ Start the clients, subscribers and slow clients, in another
+            process if the server runs in this one
+        """
+        self._loading = True
+        if self.webgui is not None:
+            options = dict(host=self.host, port=self.port, clients=self.clients,
+                           rate=self.rate, subscribers=self.subscribers, slow=self.slow,
+                           slow_interval=self.slow_interval, mix=self.mix,
+                           timeout=self.timeout)
+            context = multiprocessing.get_context('spawn')
+            (pipe, child) = context.Pipe()
+            process = context.Process(target=_load_process, args=(child, options),
+                                      name='loadtest-clients', daemon=True)
+            process.start()
+            child.close()
+            # wait for the interpreter to start, the load is measured from now
+            pipe.recv()
+            self._load = (process, pipe)
+            return
+        self._start_clients()
+
+    def _start_clients(self):
+        interval = self.clients / self.rate if self.rate else None
+        for i in range(self.clients):
+            self._spawn(self._client, 'loadtest-client-{}'.format(i), interval)
+        for i in range(self.subscribers):
+            self._spawn(self._subscriber, 'loadtest-events-{}'.format(i), 30 + 10 * i)
+        if self.slow:
+            self._spawn(self._slow_clients, 'loadtest-slow')
+
+    # -- measuring --
+
+    def sample(self, elapsed, interval):
+        """ Fold the window into the totals, return a sample of it """
+        (latency, ticks, codes, errors, events) = self._take()
+        self.latency.merge(latency)
+        self.codes.update(codes)
+        self.errors.update(errors)
+        self.events += events
+        lat = latency.summary()
+        tick = ticks.summary()
+        sample = dict(process_stats(self.pid), **{
+            'elapsed': round(elapsed, 1),
+            'rps': round(latency.count / interval, 1) if interval else None,
+            'p50_ms': lat['p50'],
+            'p99_ms': lat['p99'],
+            'max_ms': lat['max'],
+            'errors': sum(errors.values()),
+            'events': events,
+            'slow_open': self.slow_open,
+            'tick_late_p99_ms': tick['p99'],
+            'tick_late_max_ms': tick['max'],
+        })
+        self.samples.append(sample)
+        return sample
+
+    @staticmethod
+    def format_sample(sample):
+        return ('{elapsed:>8}s {rps:>8} req/s  p50 {p50_ms} ms  p99 {p99_ms} ms  '
+                'max {max_ms} ms  errors {errors}  events {events}  slow {slow_open}  '
+                'fds {fds}  rss {rss_kb} kB  threads {threads}  '
+                'tick late p99 {tick_late_p99_ms} ms').format(**sample)
+
+    def run(self, duration, sample=60, baseline=10, warmup=None, out=None):
+        """ Run the test, return the report
+
+            duration: seconds of load
+            sample: seconds between samples
+            baseline: seconds of measuring the ticks before the load starts
+            warmup: seconds of load not counted in the growth, a sample by default
+            out: callable(line) for progress
+        """
+        out = out or (lambda line: None)
+        self.start_server()
+        if self.webgui is not None and baseline:
+            out('Measuring the main loop without load for {:g} s'.format(baseline))
+            time.sleep(baseline)
+        self.window.take()
+        out('Loading http://{}:{} for {:g} s'.format(self.host, self.port, duration))
+        self.start_load()
+        start = last = time.monotonic()
+        end = start + duration
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= end:
+                    break
+                time.sleep(min(sample, end - now))
+                now = time.monotonic()
+                out(self.format_sample(self.sample(now - start, now - last)))
+                last = now
+        finally:
+            self.stop()
+        return self.report(duration, sample if warmup is None else warmup)
+
+    def _take(self):
+        """ Take the window, together with the one of the load process """
+        window = self.window.take()
+        if self._load is None:
+            return window
+        (latency, ticks, codes, errors, events) = window
+        try:
+            self._load[1].send('take')
+            (other, self.slow_open, self.slow_dropped) = self._load[1].recv()
+        except (EOFError, OSError):
+            errors['load process died'] += 1
+            self._load = None
+            return window
+        latency.merge(other[0])
+        codes.update(other[2])
+        errors.update(other[3])
+        return (latency, ticks, codes, errors, events + other[4])
+
+    def stop(self):
+        self._stop.set()
+        if self._load is not None:
+            (process, pipe) = self._load
+            self._load = None
+            try:
+                pipe.send('stop')
+                pipe.recv()
+            except (EOFError, OSError):
+                pass
+            process.join(self.timeout)
+            if process.is_alive():
+                process.terminate()
+        for thread in self._threads:
+            thread.join(self.timeout)
+        if self.webgui is not None and self.webgui.proc is not None:
+            # the server never returns on its own
+            self.webgui.proc.terminate()
+            self.webgui.proc.join(self.timeout)
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+
+    def report(self, duration, warmup):
+        """ Return the totals, growth of the server and the tick lateness """
+        growth = {}
+        counted = [s for s in self.samples if s['elapsed'] >= warmup] or self.samples
+        if len(counted) >= 2:
+            (first, last) = (counted[0], counted[-1])
+            hours = max(last['elapsed'] - first['elapsed'], 1) / 3600.0
+            for key in ('fds', 'rss_kb', 'threads'):
+                if first[key] is not None and last[key] is not None:
+                    growth[key] = {'first': first[key], 'last': last[key],
+                                   'per_hour': round((last[key] - first[key]) / hours, 1)}
+        return {
+            'duration': duration,
+            'requests': self.latency.count,
+            'rps': round(self.latency.count / duration, 1) if duration else None,
+            'latency_ms': self.latency.summary(),
+            'codes': dict((str(code), n) for (code, n) in sorted(self.codes.items())),
+            'errors': dict(self.errors),
+            'events': self.events,
+            'slow': {'open': self.slow_open, 'dropped': self.slow_dropped},
+            # with our own server the clients don't share its GIL
+            'clients': 'separate process' if self.webgui is not None else 'threads',
+            'growth': growth,
+            'tick_late_ms': {'baseline': self.baseline.summary(),
+                             'loaded': self.loaded.summary()},
+        }
+
+
+def _load_process(pipe, options):
+    """ Send the load of a LoadTest(**options) until told to stop, answer
+        every message with the window since the last one
+    """
+    test = LoadTest(**options)
+    test._start_clients()
+    pipe.send('started')
+    while True:
+        message = pipe.recv()
+        if message == 'stop':
+            test._stop.set()
+            for thread in test._threads:
+                thread.join(test.timeout)
+        pipe.send((test.window.take(), test.slow_open, test.slow_dropped))
+        if message == 'stop':
+            return
@@ -0,0 +1,233 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Buffered logging for hot paths.
+#
+# log() only does a level check and appends a tuple to a ring buffer
+# (collections.deque appends are atomic, so no lock is taken by the caller).
+# A background thread drains the buffer and does the actual I/O through
+# huefri's log(), folding repeated messages into a single
+# "last message repeated N times" line. An error wakes the flusher right
+# away. A forked child starts a flusher of its own with an empty buffer.
+#
+# Usage:
+#   from src import logger
+#   def _log(msg, *args, level=logger.INFO):
+#       logger.log("Module", msg, *args, level=level)
+#
+#   _log("RISING %d", pin, level=logger.DEBUG)
+
+from collections import deque
+import atexit
+import os
+import threading
+import time
+
+__all__ = ["DEBUG", "INFO", "WARNING", "ERROR", "Logger",
+           "log", "set_level", "configure", "recent", "flush"]
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+
+def _huefri_sink(module, msg):
+    """ The default output, import huefri only when something is printed """
+    from huefri.common import log as huefri_log
+    huefri_log(module, msg)
+
+
+def print_sink(module, msg):
+    """ An output without huefri, for processes which don't load it """
+    print("{} [{}] {}".format(time.strftime('%Y-%m-%d %H:%M:%S'), module, msg), flush=True)
+
+
+def parse_level(level):
+    """ Accept both a number and a name like 'debug' """
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVEL_NAMES[str(level).lower()]
+    except KeyError:
+        raise ValueError("Unknown log level '{}'".format(level))
+
+
+class Logger(object):
+    """ Ring-buffered logger with a background flusher. """
+
+    def __init__(self, sink=None, size=4096, history=1000,
+                 interval=0.2, repeat_window=10, level=INFO):
+        """
+            sink: callable(module, msg) doing the real output
+            size: how many entries can wait for the flusher, oldest are dropped
+            history: how many entries are kept in memory for debugging
+            interval: how often (in seconds) the flusher wakes up
+            repeat_window: identical messages within this time (in seconds)
+                are printed only once
+        """
+        self.sink = sink or _huefri_sink
+        self.buffer = deque(maxlen=size)
+        self.history = deque(maxlen=history)
+        self.interval = interval
+        self.repeat_window = repeat_window
+        self.level = level
+        self.levels = {}
+        # module -> [message, time of the first print, repeat count]
+        self._repeats = {}
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def log(self, module, msg, *args, level=INFO):
+        """ Queue a message. Formatting with args is done by the flusher. """
+        if level < self.levels.get(module, self.level):
+            return
+        entry = (time.time(), module, level, msg, args)
+        self.buffer.append(entry)
+        self.history.append(entry)
+        if self._thread is None:
+            self.start()
+        if level >= ERROR:
+            self._wake.set()
+
+    def set_level(self, level, module=None):
+        """ Set the level for one module, or the default one if module is None """
+        level = parse_level(level)
+        if module is None:
+            self.level = level
+        else:
+            self.levels[module] = level
+
+    def start(self):
+        """ Start the background flusher (done automatically by the first log) """
+        with self._flush_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="logger", daemon=True)
+            self._thread.start()
+
+    def _after_fork(self):
+        """ In a forked child: the flusher thread and the lock holder are
+            gone, and the parent prints what is buffered
+        """
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.buffer.clear()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # never let a broken sink kill the flusher
+                pass
+
+    @staticmethod
+    def format(entry):
+        """ Return the text of a buffered entry """
+        _, _, level, msg, args = entry
+        text = str(msg)
+        if args:
+            try:
+                text = text % args
+            except (TypeError, ValueError):
+                text = "{} {}".format(text, args)
+        if level >= WARNING:
+            text = "{}: {}".format('ERROR' if level >= ERROR else 'WARNING', text)
+        return text
+
+    def flush(self):
+        """ Write out everything waiting in the buffer """
+        with self._flush_lock:
+            while True:
+                try:
+                    entry = self.buffer.popleft()
+                except IndexError:
+                    break
+                self._emit(entry)
+            self._close_repeats(time.time())
+
+    def _emit(self, entry):
+        stamp, module, _, _, _ = entry
+        text = self.format(entry)
+        last = self._repeats.get(module)
+        if last is not None and last[0] == text and stamp - last[1] < self.repeat_window:
+            last[2] += 1
+            return
+        if last is not None and last[2]:
+            self.sink(module, "last message repeated {} times".format(last[2]))
+        self._repeats[module] = [text, stamp, 0]
+        self.sink(module, text)
+
+    def _close_repeats(self, now):
+        """ Report suppressed repeats once their window is over """
+        for module, last in self._repeats.items():
+            if last[2] and now - last[1] >= self.repeat_window:
+                self.sink(module, "last message repeated {} times".format(last[2]))
+                last[1] = now
+                last[2] = 0
+
+    def recent(self, count=None, module=None):
+        """ Return the last entries as (time, module, level, text) tuples """
+        entries = [e for e in list(self.history) if module is None or e[1] == module]
+        if count is not None:
+            entries = entries[-count:]
+        return [(e[0], e[1], e[2], self.format(e)) for e in entries]
+
+
+LOGGER = Logger()
+atexit.register(LOGGER.flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=LOGGER._after_fork)
+
+
+def log(module, msg, *args, level=INFO):
+    """ Log a message through the shared logger """
+    LOGGER.log(module, msg, *args, level=level)
+
+
+def set_level(level, module=None):
+    LOGGER.set_level(level, module)
+
+
+def configure(cnf):
+    """ Apply the "logging" part of the config file:
+        {"level": "info", "modules": {"Controller": "debug"}}
+    """
+    if 'level' in cnf:
+        LOGGER.set_level(cnf['level'])
+    for module, level in cnf.get('modules', {}).items():
+        LOGGER.set_level(level, module)
+
+
+def recent(count=None, module=None):
+    return LOGGER.recent(count, module)
+
+
+def flush():
+    LOGGER.flush()
@@ -0,0 +1,205 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Reload config.json without restarting the hub.
+#
+# The file is checked (with a stat) every tick, or on request from the web
+# API. A changed file is parsed and validated first; a broken config is
+# reported and the running one is kept. Then only the changed top-level
+# sections are applied, in place:
+#   logging         - levels are set again
+#   alarm           - Alarm.configure(), the sound player is kept unless
+#                     the audio output changed
+#   hue, tradfri    - a changed list of controlled lights is set on the
+#                     running gateway, anything else reconnects only that
+#                     gateway; GPIO is never touched
+#   gateways        - the reboot schedule
+#   webgui, buttons - need a restart, only reported
+#
+# A file which can't be loaded or applied is tried again after 1 s, the
+# delay doubling up to RETRY_MAX; a change of the file or a request from
+# the web API tries it right away.
+
+import json
+import os
+
+from src import clock
+from src import logger
+from src.buttons import ButtonEngine
+from src.gateways import KINDS, ParsedConfig, gateway_sections
+from src.sunrise import Sunrise
+from src.webgui import WebGUI
+
+__all__ = ["HotReload", "validate"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Reload", msg, *args, level=level)
+
+
+def validate(cnf):
+    """ Raise ValueError if the config can't be used """
+    if not isinstance(cnf, dict):
+        raise ValueError("The config has to be an object")
+    try:
+        alarm = cnf['alarm']
+        alarm['gpio']
+        for key in ('path', 'volume_increment', 'volume_initial', 'force_alsa'):
+            alarm['sound'][key]
+        step = float(alarm['brightening']['step'])
+        duration = float(alarm['brightening']['duration'])
+    except (KeyError, TypeError, ValueError) as ex:
+        raise ValueError("Missing or invalid alarm setting: {}".format(ex))
+    if step <= 0 or duration <= 0:
+        raise ValueError("alarm.brightening step and duration have to be positive")
+    if alarm['brightening'].get('lights'):
+        Sunrise(alarm['brightening']['lights'], round(duration / step))
+
+    try:
+        gateways = gateway_sections(cnf)
+    except AttributeError:
+        raise ValueError("Gateways have to be objects")
+    if not gateways:
+        raise ValueError("You have to have at least one hub configured")
+    for (_, name, section) in gateways:
+        if not isinstance(section.get('controlled'), list):
+            raise ValueError("{}.controlled has to be a list".format(name))
+
+    logging = cnf.get('logging', {})
+    for level in [logging.get('level', 'info')] + list(logging.get('modules', {}).values()):
+        logger.parse_level(level)
+
+    buttons = dict(cnf.get('buttons', {}))
+    try:
+        pins = [(int(pin), gestures) for (pin, gestures) in buttons.pop('pins', {}).items()]
+        ButtonEngine(pins, None, **buttons)
+    except (TypeError, AttributeError) as ex:
+        raise ValueError("Invalid buttons setting: {}".format(ex))
+
+    if cnf.get('webgui', {}).get('mode', 'thread') not in WebGUI.MODES:
+        raise ValueError("webgui.mode has to be one of {}".format(', '.join(WebGUI.MODES)))
+
+
+class HotReload(object):
+    """ Watch the config file and apply its changes to the running hub """
+
+    # sections which can't be changed without a restart
+    RESTART = ('webgui', 'buttons')
+    # the longest wait before applying a failed config again, in seconds
+    RETRY_MAX = 300
+
+    def __init__(self, path, base, clock=clock.monotonic):
+        """ path: the config file, base: huefri's Config """
+        self.path = path
+        self.base = base
+        self.clock = clock
+        self.current = None
+        self._stat = None
+        self._requested = False
+        # the signature of a file which couldn't be applied, logged once
+        self._failed = None
+        self._retry_at = None
+        self._retry_delay = 0
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """ Read and validate the file, raise ValueError if it is broken """
+        with open(self.path, 'r') as f:
+            cnf = json.load(f)
+        validate(cnf)
+        return cnf
+
+    def start(self):
+        """ Remember the config the hub was just set up with """
+        self._stat = self._signature()
+        self.current = self.load()
+
+    def request(self):
+        """ Reload on the next check, even if the file looks the same """
+        self._requested = True
+
+    def check(self, controller, alarm):
+        """ Apply the config if it changed. Return the list of changed
+            sections, None if nothing was reloaded. A config which can't be
+            loaded or applied is tried again on the next check.
+        """
+        signature = self._signature()
+        if not self._requested and signature == self._stat:
+            return None
+        if not self._requested and signature == self._failed and \
+                self.clock() < self._retry_at:
+            return None
+        self._requested = False
+        # logged once, but tried again until it works or the file changes
+        level = logger.ERROR if signature != self._failed else logger.DEBUG
+        try:
+            new = self.load()
+        except (OSError, ValueError) as ex:
+            _log("The changed config can't be used, keeping the running one: %s", ex,
+                 level=level)
+            self._retry(signature)
+            return None
+
+        old = self.current
+        changed = sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+        if changed:
+            _log("Config changed: %s", ', '.join(changed), level=min(level, logger.INFO))
+        for section in changed:
+            try:
+                self._apply(section, old, new, controller, alarm)
+            except Exception as ex:
+                _log("Applying '%s' failed, trying again: %r", section, ex, level=level)
+                self._retry(signature)
+                return None
+            # current is what runs, also when a later section fails
+            self.current = dict(self.current)
+            if section in new:
+                self.current[section] = new[section]
+            else:
+                self.current.pop(section, None)
+        self._stat = signature
+        self._failed = None
+        self._retry_delay = 0
+        return changed
+
+    def _retry(self, signature):
+        """ Schedule another try of a config which failed """
+        if signature != self._failed:
+            self._retry_delay = 0
+        self._retry_delay = min(max(1, 2 * self._retry_delay), self.RETRY_MAX)
+        self._retry_at = self.clock() + self._retry_delay
+        self._failed = signature
+
+    def _apply(self, section, old, new, controller, alarm):
+        if section == 'logging':
+            logger.LOGGER.levels = {}
+            logger.LOGGER.set_level(logger.INFO)
+            logger.configure(new.get('logging', {}))
+        elif section == 'alarm':
+            alarm.configure(new['alarm'])
+        elif section in KINDS:
+            controller.reconfigure(section, old.get(section), new.get(section),
+                                   ParsedConfig(new, self.base))
+        elif section == 'gateways':
+            controller.gateways.configure(new.get('gateways', {}))
+        elif section in self.RESTART:
+            _log("Changes in '%s' are used after a restart", section, level=logger.WARNING)
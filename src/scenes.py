@@ -0,0 +1,163 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Saved scenes: a brightness and a color for every light.
+#
+# Scenes live in the "scenes" section of the state store:
+#   {"evening": {"hue:1": {"brightness": 120, "color": 2},
+#                "tradfri:0": {"brightness": 0}}}
+# where color is an index into huefri's COLORS_MAP, and the backend part is
+# a gateway name (see src/gateways.py).
+#
+# Scenes are compiled into per-backend command lists whenever the store
+# changes, so recalling a scene only sends what was precomputed: one
+# command per light, batched per backend (see Controller.apply_states).
+#
+# huefri is imported only by SceneEngine, so the web server can check
+# scenes (check_scene) without loading it.
+
+from src import logger
+
+__all__ = ["Scene", "SceneEngine", "check_scene", "hex_to_xy"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Scenes", msg, *args, level=level)
+
+
+def _entry_hex(entry):
+    """ Return the hex color of a COLORS_MAP entry """
+    if isinstance(entry, dict):
+        return entry['hex']
+    return entry
+
+
+def hex_to_xy(color):
+    """ Convert 'rrggbb' to the CIE xy coordinates used by Hue """
+    def gamma(c):
+        c = c / 255
+        return ((c + 0.055) / 1.055) ** 2.4 if c > 0.04045 else c / 12.92
+
+    r, g, b = (gamma(int(color[i:i+2], 16)) for i in (0, 2, 4))
+    x = r * 0.664511 + g * 0.154324 + b * 0.162028
+    y = r * 0.283881 + g * 0.668433 + b * 0.047685
+    z = r * 0.000088 + g * 0.072310 + b * 0.986039
+    total = x + y + z
+    if not total:
+        return [0.0, 0.0]
+    return [round(x / total, 4), round(y / total, 4)]
+
+
+class Scene(object):
+    """ A scene compiled against the palette: {backend: [(light, brightness, color, None)]} """
+
+    def __init__(self, name, lights, palette):
+        """ lights: {"backend:light": {"brightness": n, "color": index}}
+            palette: list of (hex, xy) tuples, one per COLORS_MAP entry,
+                None to keep the color indexes
+        """
+        self.name = name
+        self.commands = {}
+        for (key, target) in lights.items():
+            try:
+                backend, light = key.split(':', 1)
+                brightness = max(0, min(254, int(target['brightness'])))
+                color = target.get('color')
+                if color is not None:
+                    color = int(color)
+                    if color < 0:
+                        raise IndexError(color)
+                    if palette is not None:
+                        color = palette[color]
+            except (ValueError, KeyError, IndexError, TypeError):
+                raise ValueError("Invalid light '{}' in scene '{}'".format(key, name))
+            if not backend:
+                raise ValueError("Missing gateway in light '{}' of scene '{}'".format(key, name))
+            if light.isdigit():
+                light = int(light)
+            self.commands.setdefault(backend, []).append((light, brightness, color, None))
+
+
+def check_scene(name, lights, colors=None, gateways=None):
+    """ Raise ValueError if a scene can't be applied
+        colors: the hex colors of the palette, None if not known
+        gateways: {name: {"lights": [light, ...]}} as the hub publishes
+            them, None if not known
+    """
+    palette = None if colors is None else [(color, None) for color in colors]
+    scene = Scene(name, lights, palette)
+    if gateways is None:
+        return
+    for (backend, commands) in scene.commands.items():
+        if backend not in gateways:
+            raise ValueError("Unknown gateway '{}' in scene '{}'".format(backend, name))
+        for (light, _, _, _) in commands:
+            if light not in gateways[backend].get('lights', []):
+                raise ValueError("Unknown light '{}:{}' in scene '{}'".format(backend, light, name))
+
+
+class SceneEngine(object):
+    """ Load scenes from the state store and apply them through a controller """
+
+    def __init__(self, controller, store):
+        from huefri.common import COLORS_MAP
+
+        self.controller = controller
+        self.store = store
+        self.palette = [(_entry_hex(e), hex_to_xy(_entry_hex(e))) for e in COLORS_MAP]
+        self.scenes = {}
+        self._version = None
+
+    def load(self):
+        """ Recompile the scenes if the store changed """
+        self.store.refresh()
+        if self.store.version == self._version:
+            return
+        self._version = self.store.version
+        scenes = {}
+        for (name, lights) in self.store.data.get('scenes', {}).items():
+            try:
+                scenes[name] = Scene(name, lights, self.palette)
+            except ValueError as ex:
+                _log(ex, level=logger.WARNING)
+        self.scenes = scenes
+
+    def names(self):
+        self.load()
+        return sorted(self.scenes)
+
+    def save(self, name, lights):
+        """ Store a scene, lights as described in Scene.__init__ """
+        # fail early on a broken scene
+        Scene(name, lights, self.palette)
+        scenes = dict(self.store.get('scenes', {}))
+        scenes[name] = lights
+        self.store.update(scenes=scenes)
+
+    def delete(self, name):
+        scenes = dict(self.store.get('scenes', {}))
+        if scenes.pop(name, None) is not None:
+            self.store.update(scenes=scenes)
+
+    def recall(self, name):
+        """ Apply a scene, one command per light """
+        self.load()
+        try:
+            scene = self.scenes[name]
+        except KeyError:
+            raise ValueError("Unknown scene '{}'".format(name))
+        _log("recalling scene %s", name)
+        self.controller.apply_states(scene.commands)
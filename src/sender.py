@@ -0,0 +1,147 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Outbound light commands of one gateway.
+#
+# Commands are queued per light, a newer command for a light replaces the
+# queued one (last write wins). A step of the alarm ramp setting what the
+# light is already known to have is dropped; commands from a button, the web
+# server or a scene are always sent, the light might have been changed from
+# elsewhere since. The known state comes from what was sent and what was
+# read back, and is trusted only for "state_ttl" seconds.
+#
+# flush() sends as many queued lights as the gateway's rate budget allows
+# right now, in one batch; the rest waits for the next flush. cancel() drops
+# everything queued, so an interrupted alarm ramp doesn't go on.
+#
+# Configured per gateway:
+#   "tradfri": {..., "rate": 10, "burst": 20, "state_ttl": 30}
+
+from collections import OrderedDict
+import threading
+
+from src import clock
+from src import telemetry
+
+__all__ = ["CommandSender"]
+
+class CommandSender(object):
+    """ Rate limited, deduplicated light commands of one gateway """
+
+    def __init__(self, gateway, send, state_ttl=30, clock=clock.monotonic):
+        """
+            gateway: the Gateway the commands are for
+            send: callable(gateway, [(light, brightness, color, ct)]) doing the work
+            state_ttl: how long a known light state is trusted, in seconds
+        """
+        self.gateway = gateway
+        self.send = send
+        self.state_ttl = state_ttl
+        self.clock = clock
+        # light -> (brightness, color, ct), in the order they came
+        self.pending = OrderedDict()
+        # light -> ((brightness, color, ct), time it was known)
+        self.known = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.collapsed = 0
+        self.suppressed = 0
+        self.cancelled = 0
+
+    def _known(self, light, now):
+        try:
+            (state, when) = self.known[light]
+        except KeyError:
+            return None
+        if now - when > self.state_ttl:
+            return None
+        return state
+
+    def queue(self, commands, skip_known=False):
+        """ Queue [(light, brightness, color, ct)] commands
+            skip_known: drop the commands for lights known to have that state
+        """
+        with self.lock:
+            now = self.clock()
+            for (light, brightness, color, ct) in commands:
+                state = (brightness, color, ct)
+                if light in self.pending:
+                    self.collapsed += 1
+                    self.pending[light] = state
+                elif skip_known and self._known(light, now) == state:
+                    self.suppressed += 1
+                else:
+                    self.pending[light] = state
+
+    def flush(self):
+        """ Send what the rate budget allows now, return the number of sent lights """
+        with self.lock:
+            if not self.pending:
+                return 0
+            count = self.gateway.budget.take(len(self.pending))
+            batch = [self.pending.popitem(last=False) for _ in range(count)]
+        if not batch:
+            return 0
+        try:
+            self.send(self.gateway, [(light,) + state for (light, state) in batch])
+        except Exception:
+            with self.lock:
+                # keep the commands, unless a newer one came meanwhile
+                for (light, state) in batch:
+                    self.pending.setdefault(light, state)
+            raise
+        now = self.clock()
+        with self.lock:
+            for (light, state) in batch:
+                self.known[light] = (state, now)
+            self.sent += len(batch)
+        telemetry.record('commands.{}.sent'.format(self.gateway.name), len(batch))
+        return len(batch)
+
+    def cancel(self):
+        """ Drop the queued commands, return how many there were """
+        with self.lock:
+            count = len(self.pending)
+            self.pending.clear()
+            self.cancelled += count
+        return count
+
+    def observe(self, light, brightness):
+        """ A light was read, keep its known state only if it still matches.
+            Return True if the light differs from what it was known to have.
+        """
+        with self.lock:
+            known = self.known.get(light)
+            if known is not None and known[0][0] == brightness:
+                self.known[light] = (known[0], self.clock())
+                return False
+            self.known.pop(light, None)
+            return known is not None
+
+    def forget(self):
+        """ The lights were changed in a way we can't follow, don't trust the known state """
+        with self.lock:
+            self.known.clear()
+
+    def counters(self):
+        return {
+            'sent': self.sent,
+            'collapsed': self.collapsed,
+            'suppressed': self.suppressed,
+            'cancelled': self.cancelled,
+            'pending': len(self.pending),
+        }
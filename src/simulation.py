@@ -0,0 +1,367 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run the hub's main loop in virtual time against fake gateways.
+#
+#   ./hub.py --simulate 3 --alarm 06:30
+#
+# simulates three days with an alarm at 6:30, as fast as possible (or
+# --speed times faster than real time), using the gateways and brightening
+# from config.json. The fake gateways keep the state of their lights and
+# count the commands they get; the sound is "switched off" by the simulated
+# user a while after it starts. The report shows the command counts and
+# how precisely the alarms started and ended.
+
+from collections import Counter
+from datetime import datetime, time, timedelta
+import os
+import tempfile
+
+from src import clock
+from src import logger
+from src.alarm import Alarm, Sound
+from src.controller import Controller, ATTR_LIGHT_STATE, ATTR_LIGHT_DIMMER, \
+        ATTR_LIGHT_COLOR_HEX, ATTR_LIGHT_MIREDS
+from src.gateways import ParsedConfig
+from src.timer import AlarmTimer
+
+__all__ = ["Simulation", "DEFAULT_CONFIG"]
+
+DEFAULT_CONFIG = {
+    'alarm': {
+        'gpio': False,
+        'sound': {'path': 'beep.mp3', 'volume_increment': 10,
+                  'volume_initial': 10, 'force_alsa': False},
+        'brightening': {'duration': 1800, 'step': 5},
+    },
+    'tradfri': {'addr': 'tradfri', 'secret': '', 'controlled': [0, 1], 'main': 0},
+}
+
+
+class FakeLight(object):
+    """ A bulb counting the commands it gets """
+
+    def __init__(self, backend, light):
+        self.backend = backend
+        self.light = light
+        self.dimmer = 0
+        self.on = False
+        self.color = None
+        self.ct = None
+
+    def set(self, **values):
+        """ Change the state, count it as one command of the gateway """
+        for (key, value) in values.items():
+            setattr(self, key, value)
+        self.backend.commands[self.light] += 1
+
+
+class FakeTradfriLight(FakeLight):
+    """ A bulb as pytradfri describes it: light_control.lights[0] and set_* commands """
+
+    def __init__(self, backend, light):
+        super().__init__(backend, light)
+        self.light_control = self
+        self.lights = [self]
+
+    @property
+    def state(self):
+        return self.on
+
+    # the commands are prepared first and executed by api()
+    def set_dimmer(self, dimmer):
+        return lambda: self.set(dimmer=dimmer, on=dimmer > 0)
+
+    def set_state(self, state):
+        return lambda: self.set(on=state)
+
+    def set_hex_color(self, color):
+        return lambda: self.set(color=color)
+
+    def set_color_temp(self, ct):
+        return lambda: self.set(ct=ct)
+
+    def set_values(self, values):
+        names = {ATTR_LIGHT_STATE: 'on', ATTR_LIGHT_DIMMER: 'dimmer',
+                 ATTR_LIGHT_COLOR_HEX: 'color', ATTR_LIGHT_MIREDS: 'ct'}
+        changes = dict((names[key], value) for (key, value) in values.items())
+        if 'on' in changes:
+            changes['on'] = bool(changes['on'])
+        return lambda: self.set(**changes)
+
+
+class FakeHueLight(FakeLight):
+    """ A bulb as the hue bridge describes it: light() reads, light.state() sets """
+
+    def __call__(self):
+        return {'state': {'bri': self.dimmer, 'on': self.on}}
+
+    def state(self, on=True, bri=None, xy=None, ct=None):
+        values = {'on': on}
+        if bri is not None:
+            values['dimmer'] = bri
+        if xy is not None:
+            values['color'] = xy
+        if ct is not None:
+            values['ct'] = ct
+        self.set(**values)
+
+
+class FakeBackend(object):
+    """ The parts of huefri's Hue and Tradfri objects the hub uses """
+
+    def __init__(self, kind, name, section):
+        self.kind = kind
+        self.name = name
+        self.lights_selected = list(section['controlled'])
+        self.commands = Counter()
+        self.reboots = 0
+        light_class = FakeHueLight if kind == 'hue' else FakeTradfriLight
+        self._lights = dict((light, light_class(self, light)) for light in self.lights_selected)
+        # hue reads and sets the lights through bridge.lights
+        self.bridge = self
+        self.lights = self._lights
+
+    def set_hue(self, hue):
+        pass
+
+    def set_tradfri(self, tradfri):
+        pass
+
+    def changed(self):
+        pass
+
+    def api(self, batch):
+        for command in batch:
+            command()
+
+    def reboot(self):
+        self.reboots += 1
+
+    @property
+    def state(self):
+        return any(light.on for light in self._lights.values())
+
+    def set_brightness(self, brightness):
+        for light in self._lights.values():
+            light.set(dimmer=min(254, brightness), on=brightness > 0)
+
+    def _change(self, delta):
+        for light in self._lights.values():
+            light.set(dimmer=max(0, min(254, light.dimmer + delta)))
+
+    def brightness_inc(self):
+        self._change(25)
+
+    def brightness_dec(self):
+        self._change(-25)
+
+    def color_next(self):
+        pass
+
+    def color_prev(self):
+        pass
+
+
+class FakeGPIO(object):
+    """ RPi.GPIO without any buttons """
+    BCM = 'BCM'
+    IN = 'IN'
+    BOTH = 'BOTH'
+    PUD_DOWN = 'PUD_DOWN'
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        pass
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        pass
+
+    def input(self, pin):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+class FakePlayer(object):
+    """ A vlc player stopped by the simulated user after a while """
+
+    def __init__(self, stop_after):
+        self.stop_after = stop_after
+        self.started = None
+        self.played = 0
+
+    def media_new(self, path):
+        return path
+
+    def media_player_new(self):
+        return self
+
+    def set_media(self, media):
+        pass
+
+    def audio_set_volume(self, volume):
+        pass
+
+    def play(self):
+        self.started = clock.monotonic()
+        self.played += 1
+
+    def stop(self):
+        self.started = None
+
+    def is_playing(self):
+        if self.started is not None and clock.monotonic() - self.started >= self.stop_after:
+            self.started = None
+        return self.started is not None
+
+
+class SimulatedGUI(object):
+    """ Takes the place of WebGUI and records the alarm events """
+
+    def __init__(self):
+        self.events = []
+
+    def run(self):
+        pass
+
+    def publish(self, state):
+        pass
+
+    def event(self, name, data):
+        self.events.append((clock.now(), name, data))
+
+    def pending_commands(self):
+        return iter(())
+
+    def queue_depths(self):
+        return {}
+
+
+class Simulation(object):
+    """ Everything needed to run hub.run() in virtual time """
+
+    def __init__(self, days, alarm=time(6, 30), start=None, speed=None,
+                 config=None, base=None, stop_sound_after=300):
+        """
+            days: how long to simulate
+            alarm: the alarm time, every day
+            start: the virtual datetime to start at, the next midnight by default
+            speed: virtual seconds per real second, None for no waiting
+            config: the config dict, DEFAULT_CONFIG if None
+            base: huefri's Config, for anything ParsedConfig doesn't have
+            stop_sound_after: seconds the simulated user lets the sound play
+        """
+        if start is None:
+            start = datetime.combine(datetime.now().date() + timedelta(days=1), time())
+        self.start = start
+        self.alarm_time = alarm
+        self.clock = clock.VirtualClock(start, speed, start + timedelta(days=days))
+        data = dict(config or DEFAULT_CONFIG)
+        data['telemetry'] = {'snapshot': 0}
+        self.config = ParsedConfig(data, base)
+        self.directory = tempfile.TemporaryDirectory(prefix='hub-simulation-')
+        self.state_file = os.path.join(self.directory.name, 'hub_state.json')
+        self.gui = SimulatedGUI()
+        self.backends = []
+        self.stop_sound_after = stop_sound_after
+        self.controller = None
+        self.timer = None
+
+    def install(self):
+        """ Install the virtual clock and set up the alarm. Call before hub.run(). """
+        clock.install(self.clock)
+        self.timer = AlarmTimer(self.state_file)
+        self.timer.set_time(self.alarm_time, True)
+
+    def backend(self, kind, name, section):
+        backend = FakeBackend(kind, name, section)
+        self.backends.append(backend)
+        return backend
+
+    def controller_class(self):
+        sim = self
+
+        class SimulatedController(Controller):
+            gpio = FakeGPIO()
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                sim.controller = self
+
+            def _autoinit(self, kind, name, section, config):
+                return sim.backend(kind, name, section)
+
+        return SimulatedController
+
+    def alarm_class(self):
+        sim = self
+
+        class SimulatedSound(Sound):
+            def __init__(self, cnf):
+                self.path = cnf['path']
+                self.volume_increment = cnf['volume_increment']
+                self.force_alsa = cnf['force_alsa']
+                self.vlc_inst = self.player = FakePlayer(sim.stop_sound_after)
+                self._volume = cnf['volume_initial']
+                self._volume_starting = cnf['volume_initial']
+
+        class SimulatedAlarm(Alarm):
+            sound_class = SimulatedSound
+
+        return SimulatedAlarm
+
+    def report(self):
+        """ Return a text describing what happened """
+        duration = self.config.get()['alarm']['brightening']['duration']
+        lines = ['Simulated {} to {}'.format(self.start, self.clock.now()), '']
+        lines.append('== Alarms ==')
+        started = None
+        for (when, name, data) in self.gui.events:
+            if name == 'started':
+                started = when
+                scheduled = datetime.combine(when.date(), self.alarm_time)
+                lines.append('{} started, {:.1f} s after the set time'.format(
+                    when, (when - scheduled).total_seconds()))
+            elif name in ('ended', 'aborted') and started is not None:
+                lines.append('{} {}, after {:.1f} s (configured {} s)'.format(
+                    when, name, (when - started).total_seconds(), duration))
+                started = None
+        steps = sum(1 for (_, name, _) in self.gui.events if name == 'step')
+        lines.append('{} ramp steps'.format(steps))
+        lines.append('')
+        lines.append('== Gateways ==')
+        # a gateway gets a new backend after every reboot
+        gateways = {}
+        for backend in self.backends:
+            (commands, reboots) = gateways.setdefault(backend.name, (Counter(), [0]))
+            commands.update(backend.commands)
+            reboots[0] += backend.reboots
+        for (name, (commands, reboots)) in sorted(gateways.items()):
+            lines.append('{}: {} commands, {} reboots, per light {}'.format(
+                name, sum(commands.values()), reboots[0], dict(commands)))
+        if self.controller is not None:
+            for (name, health) in sorted(self.controller.gateways.health().items()):
+                lines.append('{}: {}'.format(name, health['commands']))
+        return '\n'.join(lines) + '\n'
+
+    def cleanup(self):
+        logger.flush()
+        self.directory.cleanup()
@@ -0,0 +1,108 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# A small persistent state shared by the hub and the web server.
+#
+# The state is one compact JSON file:
+#   {"version": 12, "alarms": [{"time": "06:40", "enabled": true}],
+#    "lights": [...], "scenes": {...}}
+#
+# Writers take a lock, re-read the file, merge their sections in, bump the
+# version and atomically replace the file, so a reader never sees a half
+# written file. Readers only stat() the file to find out if it changed.
+# Within a process, a store shared by threads is guarded by its own lock.
+
+import fcntl
+import json
+import os
+import threading
+
+__all__ = ["StateStore"]
+
+class StateStore(object):
+    """ A versioned JSON state file, replaced atomically on every write. """
+
+    def __init__(self, path : str):
+        """ Argument path: path to the state file, it doesn't have to exist """
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.data = {}
+        self._stat = None
+        self.lock = threading.RLock()
+        self.refresh()
+
+    @property
+    def version(self):
+        """ A number increased by every write, from any process """
+        return self.data.get('version', 0)
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        """ Return True if the file was changed since we last read it """
+        return self._signature() != self._stat
+
+    def refresh(self):
+        """ Reload the file if it changed. Return True if it was reloaded. """
+        with self.lock:
+            signature = self._signature()
+            if signature == self._stat:
+                return False
+            if signature is None:
+                self.data = {}
+            else:
+                with open(self.path, 'r') as f:
+                    try:
+                        self.data = json.load(f)
+                    except ValueError as ex:
+                        raise SyntaxError("State file {} could not be parsed: {}".format(self.path, ex))
+            self._stat = signature
+            return True
+
+    def get(self, section, default=None):
+        """ Return a section of the state, reloading it first if needed """
+        self.refresh()
+        return self.data.get(section, default)
+
+    def update(self, **sections):
+        """ Replace the given sections and write the file """
+        with self.lock, open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # someone else might have written in the meantime
+                self.refresh()
+                data = dict(self.data)
+                data.update(sections)
+                data['version'] = self.version + 1
+                self._write(data)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, data):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.data = data
+        self._stat = self._signature()
@@ -0,0 +1,123 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# A multi-light sunrise: every light has its own delay, curve and color
+# temperature. The whole ramp is computed at once into a table with a row
+# per step and a column per light, the alarm then only sends the lights
+# whose value differs from what was sent last.
+#
+# Configured in the "brightening" part of the alarm config:
+#   "lights": {
+#       "hue:1":     {"delay": 0,   "curve": 1,   "ct": [454, 250]},
+#       "tradfri:0": {"delay": 0.3, "curve": 2.2, "max": 200}
+#   }
+# delay: fraction of the ramp before the light starts
+# curve: exponent of the brightness curve, 1 is linear, >1 starts slower
+# max: the final brightness
+# ct: color temperature in mireds at the start and the end of the light's ramp
+
+try:
+    import numpy
+except ImportError:
+    # numpy makes the table computation faster, but it is not required
+    numpy = None
+
+__all__ = ["Sunrise"]
+
+class Sunrise(object):
+    """ A precomputed brightness and color temperature ramp for several lights """
+
+    def __init__(self, lights, steps, br_max=254):
+        """ lights: {"backend:light": {...}} as described above
+            steps: the number of steps of the ramp
+        """
+        self.keys = sorted(lights)
+        self.steps = max(1, int(steps))
+        # "backend:light" -> (backend, light)
+        self.targets = {}
+        for key in self.keys:
+            try:
+                backend, light = key.split(':', 1)
+            except ValueError:
+                raise ValueError("Invalid sunrise light '{}', expected backend:light".format(key))
+            self.targets[key] = (backend, int(light) if light.isdigit() else light)
+        delays = [float(lights[k].get('delay', 0)) for k in self.keys]
+        curves = [float(lights[k].get('curve', 1)) for k in self.keys]
+        maxima = [min(br_max, int(lights[k].get('max', br_max))) for k in self.keys]
+        cts = [lights[k].get('ct') for k in self.keys]
+        for (key, delay, curve) in zip(self.keys, delays, curves):
+            if not 0 <= delay < 1 or curve <= 0:
+                raise ValueError("Invalid sunrise settings for light '{}'".format(key))
+        if numpy is not None:
+            self._compute_numpy(delays, curves, maxima, cts)
+        else:
+            self._compute_python(delays, curves, maxima, cts)
+
+    def _compute_numpy(self, delays, curves, maxima, cts):
+        t = numpy.linspace(0.0, 1.0, self.steps + 1)[:, None]
+        delays = numpy.array(delays)[None, :]
+        local = numpy.clip((t - delays) / (1 - delays), 0.0, 1.0)
+        shaped = local ** numpy.array(curves)[None, :]
+        self.brightness = numpy.rint(shaped * numpy.array(maxima)[None, :]).astype(int).tolist()
+        start = numpy.array([ct[0] if ct else 0 for ct in cts])[None, :]
+        end = numpy.array([ct[1] if ct else 0 for ct in cts])[None, :]
+        ct = numpy.rint(start + (end - start) * local).astype(int).tolist()
+        self.ct = [[row[i] if cts[i] else None for i in range(len(cts))] for row in ct]
+
+    def _compute_python(self, delays, curves, maxima, cts):
+        self.brightness = []
+        self.ct = []
+        for step in range(self.steps + 1):
+            t = step / self.steps
+            brightness = []
+            ct = []
+            for (delay, curve, br, light_ct) in zip(delays, curves, maxima, cts):
+                local = min(1.0, max(0.0, (t - delay) / (1 - delay)))
+                brightness.append(int(round(local ** curve * br)))
+                if light_ct:
+                    ct.append(int(round(light_ct[0] + (light_ct[1] - light_ct[0]) * local)))
+                else:
+                    ct.append(None)
+            self.brightness.append(brightness)
+            self.ct.append(ct)
+
+    def at(self, step):
+        """ Return [(key, brightness, ct)] for all lights at the given step """
+        step = min(max(step, 0), self.steps)
+        return list(zip(self.keys, self.brightness[step], self.ct[step]))
+
+    def changes(self, previous, step):
+        """ Return [(key, brightness, ct)] of lights which differ between the
+            step previous (None for nothing sent yet) and step.
+        """
+        current = self.at(step)
+        if previous is None:
+            return [c for c in current if c[1]]
+        old = self.at(previous)
+        return [new for (new, prev) in zip(current, old) if new[1:] != prev[1:]]
+
+    def commands(self, previous, step):
+        """ changes() grouped by backend, as Controller.apply_states() takes them """
+        commands = {}
+        for (key, brightness, ct) in self.changes(previous, step):
+            backend, light = self.targets[key]
+            commands.setdefault(backend, []).append((light, brightness, None, ct))
+        return commands
+
+    def peak(self, step):
+        """ The highest brightness of any light at the given step """
+        return max(br for (_, br, _) in self.at(step))
@@ -0,0 +1,225 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In-memory telemetry: what brightness we sent, what the lights reported,
+# how long the gateways took and when they failed.
+#
+# Every series keeps the last raw samples in fixed size arrays. Samples
+# falling out of the raw ring are folded into per-bucket min/max/mean/count
+# aggregates kept in a second ring, so the memory use is bounded and
+# older data is still available at a lower resolution.
+#
+# Usage:
+#   from src import telemetry
+#   telemetry.record('brightness.set', 120)
+#   telemetry.TELEMETRY.save('telemetry.json')
+#
+# save_every() writes the snapshot from a background thread; the lock is
+# held only while the arrays are copied, never during JSON encoding or I/O.
+
+from array import array
+import json
+import os
+import threading
+
+from src import clock
+from src import logger
+
+__all__ = ["Series", "Telemetry", "TELEMETRY", "record"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Telemetry", msg, *args, level=level)
+
+
+class Series(object):
+    """ A bounded time series of float values """
+
+    def __init__(self, size=1800, bucket=60, buckets=1440):
+        """
+            size: how many raw samples are kept
+            bucket: width of a downsampled bucket, in seconds
+            buckets: how many downsampled buckets are kept
+        """
+        self.size = size
+        self.bucket = bucket
+        self.buckets = buckets
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.pos = 0
+        self.count = 0
+        self.agg_start = array('d', bytes(8 * buckets))
+        self.agg_min = array('d', bytes(8 * buckets))
+        self.agg_max = array('d', bytes(8 * buckets))
+        self.agg_sum = array('d', bytes(8 * buckets))
+        self.agg_count = array('L', bytes(array('L').itemsize * buckets))
+        self.agg_pos = -1
+        self.agg_used = 0
+
+    def add(self, value, when=None):
+        """ Add a sample, when defaults to now """
+        if when is None:
+            when = clock.time()
+        if self.count == self.size:
+            self._fold(self.times[self.pos], self.values[self.pos])
+        else:
+            self.count += 1
+        self.times[self.pos] = when
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+
+    def _fold(self, when, value):
+        """ Move a sample from the raw ring to the aggregates """
+        start = when - when % self.bucket
+        i = self.agg_pos
+        if i < 0 or self.agg_start[i] != start:
+            i = self.agg_pos = (i + 1) % self.buckets
+            self.agg_used = min(self.agg_used + 1, self.buckets)
+            self.agg_start[i] = start
+            self.agg_min[i] = value
+            self.agg_max[i] = value
+            self.agg_sum[i] = 0
+            self.agg_count[i] = 0
+        self.agg_min[i] = min(self.agg_min[i], value)
+        self.agg_max[i] = max(self.agg_max[i], value)
+        self.agg_sum[i] += value
+        self.agg_count[i] += 1
+
+    def copy(self):
+        """ Return an independent copy of the series """
+        other = Series.__new__(Series)
+        other.__dict__.update(self.__dict__)
+        for name in ('times', 'values', 'agg_start', 'agg_min', 'agg_max',
+                     'agg_sum', 'agg_count'):
+            setattr(other, name, array(getattr(self, name).typecode, getattr(self, name)))
+        return other
+
+    def points(self, since=None):
+        """ Return raw samples as a list of (time, value), oldest first """
+        first = (self.pos - self.count) % self.size
+        result = []
+        for n in range(self.count):
+            i = (first + n) % self.size
+            if since is None or self.times[i] >= since:
+                result.append((self.times[i], self.values[i]))
+        return result
+
+    def aggregates(self):
+        """ Return downsampled data as a list of (start, min, max, mean, count) """
+        first = (self.agg_pos - self.agg_used + 1) % self.buckets
+        result = []
+        for n in range(self.agg_used):
+            i = (first + n) % self.buckets
+            result.append((self.agg_start[i], self.agg_min[i], self.agg_max[i],
+                           self.agg_sum[i] / self.agg_count[i], self.agg_count[i]))
+        return result
+
+
+class Telemetry(object):
+    """ A set of named series """
+
+    def __init__(self, **series_args):
+        """ series_args are passed to every new Series """
+        self.series = {}
+        self.series_args = series_args
+        self.lock = threading.Lock()
+        self.last_save = None
+        # the thread running the last save_every() save
+        self.saver = None
+        # the number of samples recorded so far
+        self.recorded = 0
+
+    def record(self, name, value, when=None):
+        """ Add a sample to the series name, creating it if needed """
+        with self.lock:
+            try:
+                series = self.series[name]
+            except KeyError:
+                series = self.series[name] = Series(**self.series_args)
+            series.add(value, when)
+            self.recorded += 1
+
+    def snapshot(self, since=None):
+        """ Return all series as a JSON-friendly dict """
+        with self.lock:
+            now = clock.time()
+            copies = dict((name, series.copy()) for (name, series) in self.series.items())
+        return {
+            'time': now,
+            'series': dict(
+                (name, {
+                    'points': series.points(since),
+                    'aggregates': series.aggregates(),
+                }) for (name, series) in copies.items()),
+        }
+
+    def summary(self, prefix=''):
+        """ Return {name: {count, last, mean}} of raw samples of matching series """
+        with self.lock:
+            result = {}
+            for (name, series) in self.series.items():
+                if not name.startswith(prefix):
+                    continue
+                values = [v for (_, v) in series.points()]
+                if values:
+                    result[name] = {
+                        'count': len(values),
+                        'last': values[-1],
+                        'mean': sum(values) / len(values),
+                    }
+            return result
+
+    def save(self, path):
+        """ Atomically write a snapshot to path """
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.last_save = clock.time()
+
+    def _save_quietly(self, path):
+        try:
+            self.save(path)
+        except (OSError, ValueError) as ex:
+            _log("Saving %s failed: %s", path, ex, level=logger.ERROR)
+
+    def save_every(self, path, interval):
+        """ Start saving a snapshot in the background if the last one is older
+            than interval seconds and no save is running. To be called
+            periodically, an interval of 0 disables saving.
+            Return the started thread, None if no save was started.
+        """
+        if not interval:
+            return None
+        if self.saver is not None and self.saver.is_alive():
+            return None
+        if self.last_save is not None and clock.time() - self.last_save < interval:
+            return None
+        # counted from the start, a failed save waits for the next interval
+        self.last_save = clock.time()
+        self.saver = threading.Thread(target=self._save_quietly, args=(path,),
+                                      name="telemetry-save", daemon=True)
+        self.saver.start()
+        return self.saver
+
+
+TELEMETRY = Telemetry()
+
+def record(name, value, when=None):
+    """ Record a sample into the shared telemetry """
+    TELEMETRY.record(name, value, when)
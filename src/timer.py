@@ -0,0 +1,165 @@
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2017 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The set up alarm times, kept in the shared state store. This module
+# only needs the standard library, so the web server can use it without
+# loading the light and sound bindings.
+
+from datetime import datetime, timedelta, time
+import re
+import threading
+
+from src import clock
+from src import logger
+from src.store import StateStore
+
+__all__ = ["AlarmTimer", "read_legacy_file"]
+
+def _log(msg, *args, level=logger.INFO):
+    logger.log("Alarm", msg, *args, level=level)
+
+
+def read_legacy_file(path : str):
+    """ Return (time, enabled) from the old plain text alarm file,
+        None if the file doesn't exist.
+    """
+    def syntax_error(reason):
+        return SyntaxError("Alarm file {} could not be parsed: {}".format(path, reason))
+
+    line = ''
+    try:
+        with open(path, 'r') as f:
+            # read time
+            line = f.readline().strip()
+            if not re.match('[0-9][0-9]:[0-9][0-9]', line):
+                raise syntax_error("Can't parse the time on line 0: '{}'".format(line))
+            when = datetime.strptime(line, '%H:%M').time()
+
+            # try to read enabled/disabled
+            line = f.readline().strip()
+            if line == "disabled":
+                enabled = False
+            elif line == "enabled" or line == '':
+                enabled = True
+            else:
+                raise syntax_error("There is a garbage on line 1: '{}'".format(line))
+            return (when, enabled)
+
+    except FileNotFoundError:
+        return None
+    except ValueError as ex:
+        raise SyntaxError("Alarm file {} could not be parsed. Error: '{}'\nFile content: '{}'".format(path, ex, line))
+
+
+class AlarmTimer(object):
+    """ An object encapsulating the set up alarm time operations.
+
+        The alarms live in the "alarms" section of the shared state store
+        as a list of {"time": "HH:MM", "enabled": bool}. The time, enabled
+        and index attributes describe one of them, the first enabled alarm
+        or alarm 0 if none is.
+
+        In the thread mode the web server shares the timer with the alarm,
+        everything touching the alarms holds self.lock.
+    """
+
+    def __init__(self, path : str, legacy_path : str = None):
+        """ Argument path: path to the state store
+            Argument legacy_path: the old alarm_time file, imported if the store
+                has no alarms yet
+        """
+        self.path = path
+        self.store = StateStore(path)
+        self.lock = threading.RLock()
+        self.alarms = []
+        self.time = None
+        self.enabled = False
+        self.index = 0
+        self._version = None
+        if legacy_path and not self.store.get('alarms'):
+            legacy = read_legacy_file(legacy_path)
+            if legacy is not None:
+                _log("Importing the alarm from {}".format(legacy_path))
+                self.set_time(*legacy)
+        self.load_file()
+        if self.time is None:
+            _log("No alarm is set up yet. ({})".format(self.path))
+
+    def get_time(self):
+        """ Get the time the alarm is set to """
+        with self.lock:
+            return self.time
+
+    def load_file(self):
+        """ Load the set up alarms, if the store changed since the last time """
+        with self.lock:
+            self.store.refresh()
+            if self.store.version == self._version:
+                return
+            self._version = self.store.version
+            alarms = []
+            for alarm in self.store.data.get('alarms', []):
+                try:
+                    when = datetime.strptime(alarm['time'], '%H:%M').time()
+                except (KeyError, TypeError, ValueError):
+                    raise SyntaxError("Alarm {} in {} could not be parsed".format(alarm, self.path))
+                alarms.append((when, bool(alarm.get('enabled', True))))
+            self.alarms = alarms
+            self.index = next((i for (i, (_, enabled)) in enumerate(alarms) if enabled), 0)
+            if alarms:
+                (self.time, self.enabled) = alarms[self.index]
+            else:
+                (self.time, self.enabled) = (None, False)
+
+    def seconds_to_next(self):
+        """ Return seconds until the next enabled alarm, None if there is none """
+        with self.lock:
+            self.load_file()
+            now = clock.now()
+            result = None
+            for (when, enabled) in self.alarms:
+                if not enabled:
+                    continue
+                target = datetime.combine(now.date(), when)
+                if target < now:
+                    target += timedelta(days=1)
+                seconds = (target - now).total_seconds()
+                if result is None or seconds < result:
+                    result = seconds
+            return result
+
+    def check_now(self):
+        """ Check if now is the set up time of any enabled alarm. """
+        with self.lock:
+            self.load_file()
+            now = clock.now().time().replace(second=0, microsecond=0)
+            return any(enabled and when == now for (when, enabled) in self.alarms)
+
+    def set_time(self, when:time, enabled:bool=True, index:int=0):
+        """ Store a new time for the alarm with the given index """
+        with self.lock:
+            alarms = list(self.store.get('alarms', []))
+            alarm = {
+                'time': when.strftime('%H:%M'),
+                'enabled': bool(enabled),
+            }
+            if index < len(alarms):
+                alarms[index] = alarm
+            else:
+                alarms.append(alarm)
+            self.store.update(alarms=alarms)
+            self.load_file()
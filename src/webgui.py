@@ -18,39 +18,119 @@
 # An example of usage:
 # g = WebGUI(os.path.join(
 #                     os.path.dirname(os.path.realpath(__file__)), '..',
-#                     "alarm_time"))
-# g.run() # will fork into background
+#                     "hub_state.json"))
+# g.run() # will start serving in a background thread
 #
 # while True:
 #     _log('foo')
 #     time.sleep(3)
+#
+# This module must not import the light or sound bindings, so the "spawn"
+# mode can start a small process with only the web server in it.
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
 import os
 import re
+import json
+import queue
+import threading
 import datetime as dt
 import urllib.parse
-from multiprocessing import Process
-from src.alarm import AlarmTimer
-from huefri.common import log
+import multiprocessing
+from src.timer import AlarmTimer
+from src.scenes import check_scene
+from src import logger
 
 __all__ = ["WebGUI"]
 
-def _log(msg):
-    log("WebGUI", msg)
+def _log(msg, *args, level=logger.INFO):
+    logger.log("WebGUI", msg, *args, level=level)
 
 THISDIR = os.path.dirname(os.path.realpath(__file__))
 
+# the brightening starts this long before the waking time shown to the user
+WAKE_DELAY = dt.timedelta(seconds=60*20)
+# refuse bodies larger than this
+MAX_BODY = 64 * 1024
+# actions that can be sent to the lights through the API
+LIGHT_ACTIONS = ('on', 'off', 'onoff', 'up', 'down', 'left', 'right')
+
+class APIError(Exception):
+    """ An error reported to the API client with the given HTTP code """
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+# how often an idle event stream gets a keepalive comment, in seconds
+KEEPALIVE = 15
+# an entity tag in If-None-Match, weak or strong, or *
+ETAG_RE = re.compile(r'\*|(?:W/)?"[^"]*"')
+# every event stream holds a server thread, more subscribers get a 503
+MAX_SUBSCRIBERS = 16
+
 def addtime(time, delta):
     return (dt.datetime.combine(dt.date(1,1,1),time) + delta).time()
 
+
+class EventStream(object):
+    """ A ring of recent events shared by all Server-Sent Events subscribers.
+
+        Every event is serialized once when published, subscribers only
+        wait on a condition and copy out whatever is newer than their last id.
+        A subscriber too far behind for the ring gets None instead, and has
+        to start over from the full state.
+    """
+
+    def __init__(self, size=256, max_subscribers=MAX_SUBSCRIBERS):
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.cond = threading.Condition()
+        self.subscribers = 0
+        self.max_subscribers = max_subscribers
+
+    def subscribe(self):
+        """ Count a new subscriber, return False if there are too many """
+        with self.cond:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+    def publish(self, name, data):
+        """ Add a new event and wake up all subscribers """
+        with self.cond:
+            self.last_id += 1
+            message = 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                self.last_id, name, json.dumps(data))
+            self.events.append((self.last_id, bytes(message, "utf8")))
+            self.cond.notify_all()
+
+    def wait(self, since, timeout=None):
+        """ Return (last id, [messages]) newer than since, wait if there are none.
+            The messages are None if some of them already fell out of the ring.
+        """
+        with self.cond:
+            if self.last_id == since:
+                self.cond.wait(timeout)
+            if since > self.last_id or (self.events and self.events[0][0] > since + 1):
+                return self.last_id, None
+            return self.last_id, [msg for (i, msg) in self.events if i > since]
+
 # HTTPRequestHandler class
 class AlarmHTTPServer_RequestHandler(BaseHTTPRequestHandler):
     """ HTTP request handler modified for alarm """
 
     templater = None
     handler = None
+    api = None
     template_path = os.path.join(THISDIR, 'webgui.html')
+    # (mtime, content) of the template
+    _template = (None, None)
 
     def _send_headers(self, code, content_type):
         self.send_response(code)
@@ -61,8 +141,11 @@ class AlarmHTTPServer_RequestHandler(BaseHTTPRequestHandler):
     def _send_html(self, data={}):
         """ Send html """
         # Send message back to client
-        with open(self.template_path, 'r') as f:
-            message = f.read()
+        mtime = os.stat(self.template_path).st_mtime_ns
+        if self._template[0] != mtime:
+            with open(self.template_path, 'r') as f:
+                AlarmHTTPServer_RequestHandler._template = (mtime, f.read())
+        message = self._template[1]
 
         if self.templater:
             message = self.templater(message, data=data)
@@ -77,24 +160,102 @@ class AlarmHTTPServer_RequestHandler(BaseHTTPRequestHandler):
         self.send_header('Location', target)
         self.end_headers()
 
+    def _send_json(self, code, data, etag=None):
+        """ Send data serialized as JSON """
+        body = bytes(json.dumps(data), "utf8")
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self, etag):
+        """ Return True (and send 304) if the client already has this version """
+        match = self.headers.get('If-None-Match')
+        if not match:
+            return False
+        # the weak comparison, W/"x" matches "x"
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in ETAG_RE.findall(match)]
+        if '*' not in tags and etag not in tags:
+            return False
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return True
+
+    def _send_events(self):
+        """ Stream state changes as Server-Sent Events until the client leaves """
+        stream = self.api.events
+        if not stream.subscribe():
+            self.send_response(503)
+            self.send_header('Retry-After', str(KEEPALIVE))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                # a reconnecting client, resend what it missed
+                since = int(self.headers.get('Last-Event-ID', ''))
+            except ValueError:
+                # a new client, start with the full state and only newer events
+                since = stream.last_id
+                self._send_state('state', since)
+            while True:
+                self.wfile.flush()
+                last, messages = stream.wait(since, KEEPALIVE)
+                if messages is None:
+                    # missed too much, or the hub restarted; replace everything
+                    self._send_state('reset', last)
+                elif messages:
+                    self.wfile.write(b''.join(messages))
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                since = last
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stream.unsubscribe()
+
+    def _send_state(self, event, last_id):
+        """ Send the full state as one event, events after last_id follow it """
+        self.wfile.write(bytes('id: {}\nevent: {}\ndata: {}\n\n'.format(
+            last_id, event, json.dumps(self.api.get('/api/state', {})[1])), "utf8"))
+
     def _send_image(self, filename):
         self._send_headers(200, 'image/x-icon')
         # Send message back to client
         with open(filename, 'rb') as file:
             self.wfile.write(file.read())
 
+    def _read_body(self):
+        """ Return the raw request body as a string """
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise APIError(400, "Invalid Content-Length")
+        if content_length < 0:
+            # rfile.read(-1) would wait for the client to close the connection
+            raise APIError(400, "Invalid Content-Length")
+        if content_length > MAX_BODY:
+            raise APIError(413, "Request body too large")
+        try:
+            return self.rfile.read(content_length).decode("utf-8")
+        except UnicodeDecodeError:
+            raise APIError(400, "The body is not UTF-8")
+
     def get_POST_data(self):
         """ Return a dict with POST data, empty dict if no data present """
         try:
             return self._data_post
         except AttributeError:
-            content_length = int(self.headers['Content-Length'])
-
-            raw_request = self.rfile.read(content_length).decode("utf-8").split('&')
-            data = {}
-            for line in raw_request:
-                key, val = urllib.parse.unquote(line).split('=')
-                data[key] = val
+            data = dict(urllib.parse.parse_qsl(self._read_body(), keep_blank_values=True))
 
             # Disabled checkbox is not part of post data.
             # Detect if some fields are missing and if so, set them to False.
@@ -117,28 +278,77 @@ class AlarmHTTPServer_RequestHandler(BaseHTTPRequestHandler):
             return self._data_get
         except AttributeError:
             url = urllib.parse.urlparse(self.path)
-            if url.query:
-                self._data_get = dict(
-                    (map(urllib.parse.unquote, val.split('=')))
-                    for val in url.query.split('&')
-               )
-            else:
-                self._data_get = dict()
+            self._data_get = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
             return self._data_get
 
+    def get_JSON_data(self):
+        """ Return the body of an API request, either JSON or a form """
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('application/json'):
+            return self.get_POST_data()
+        body = self._read_body()
+        if not body:
+            return {}
+        try:
+            return json.loads(body)
+        except ValueError as ex:
+            raise APIError(400, "Invalid JSON: {}".format(ex))
+
+    def _do_api(self, method):
+        """ Dispatch a request to /api/... """
+        path = urllib.parse.urlparse(self.path).path
+        try:
+            if method == 'GET':
+                etag = self.api.etag(path)
+                if self._not_modified(etag):
+                    return
+                code, data = self.api.get(path, self.get_GET_data())
+                self._send_json(code, data, etag)
+            else:
+                code, data = self.api.post(path, self.get_JSON_data())
+                self._send_json(code, data)
+        except APIError as ex:
+            self._send_json(ex.code, {'error': str(ex)})
+
     def do_POST(self):
         """ Handle a POST request """
-        data = self.get_POST_data()
-        new_time = dt.datetime.strptime(data['time'], '%H:%M').time()
+        if urllib.parse.urlparse(self.path).path.startswith('/api/'):
+            self._do_api('POST')
+            return
+        try:
+            data = self.get_POST_data()
+            new_time = dt.datetime.strptime(data['time'], '%H:%M').time()
+        except APIError as ex:
+            self._send_headers(ex.code, 'text/html')
+            self._send_html({'MESSAGE': 'Error {}: {}'.format(ex.code, ex)})
+            return
+        except (KeyError, ValueError):
+            self._send_headers(400, 'text/html')
+            self._send_html({'MESSAGE': 'Error 400, the time is missing or invalid.'})
+            return
         enabled = data['enabled'] if 'enabled' in data else False
         self.handler(new_time=new_time, enabled=enabled)
 
         self._redirect(urllib.parse.urlparse(self.path).path)
 
+    def do_PUT(self):
+        """ Handle a PUT request, only the API takes them """
+        if urllib.parse.urlparse(self.path).path.startswith('/api/'):
+            self._do_api('PUT')
+            return
+        self.send_response(405)
+        self.send_header('Allow', 'GET, POST')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
     def do_GET(self):
         """ Handle a GET request """
         url = urllib.parse.urlparse(self.path)
-        if url.path == '/favicon.ico':
+        if url.path == '/api/events':
+            self._send_events()
+        elif url.path.startswith('/api/'):
+            self._do_api('GET')
+        elif url.path == '/favicon.ico':
             self._send_image(os.path.join(THISDIR, 'favicon.ico'))
         elif url.path == '/apple-touch-icon.png':
             self._send_image(os.path.join(THISDIR, 'apple-touch-icon.png'))
@@ -155,60 +365,389 @@ class AlarmHTTPServer_RequestHandler(BaseHTTPRequestHandler):
 class WebServer(object):
     """ Encapsulate all things related to webserver """
 
-    def __init__(self, port, alarm_file):
+    def __init__(self, port, state_file, states=None, commands=None, telemetry_file=None,
+                 timer=None, telemetry=None):
+        """ states: a queue with hub states sent by WebGUI.publish()
+            commands: a queue for commands for the main loop
+            telemetry_file: snapshots written by the main loop
+            timer: an AlarmTimer shared with the alarm, when in the same process
+            telemetry: a Telemetry to serve directly, when in the same process
+        """
         self.port = port
-        self.timer = AlarmTimer(alarm_file)
+        self.telemetry_file = telemetry_file
+        self.telemetry = telemetry
+        self.timer = timer if timer is not None else AlarmTimer(state_file)
         self.proc = None
+        self.states = states
+        self.commands = commands
+        self.state = {}
+        self.state_version = 0
+        self.events = EventStream()
+        # shared with the alarm in the thread mode
+        self.timer_lock = self.timer.lock
+
+    def _receive_states(self):
+        """ Keep self.state up to date and turn changes into events, runs in a thread """
+        while True:
+            message = self.states.get()
+            if message[0] == 'event':
+                self.events.publish(message[1], message[2])
+                continue
+            self.update_state(message[1])
+
+    def update_state(self, state):
+        """ Replace the known state, publish an event for every changed light """
+        old = dict(((l['backend'], l['light']), l['brightness'])
+                   for l in self.state.get('lights', []))
+        self.state = state
+        self.state_version += 1
+        for light in state.get('lights', []):
+            if old.get((light['backend'], light['light'])) != light['brightness']:
+                self.events.publish('light', light)
 
     def handler(self, new_time, enabled):
         """ A handler called to set up a new time from server """
-        new_time = addtime(new_time, -dt.timedelta(seconds=60*20))
+        new_time = addtime(new_time, -WAKE_DELAY)
         _log("Setting timer to: {time} ({enabled})".format(
             time = new_time, enabled='enabled' if enabled else 'disabled'
         ))
-        self.timer.set_time(new_time, enabled)
+        with self.timer_lock:
+            # the alarm shown by alarm_info, not always alarm 0
+            self.timer.load_file()
+            self.timer.set_time(new_time, enabled, self.timer.index)
+        self.events.publish('alarm', self.alarm_info())
 
     def templater(self, html, data={}):
         """ Insert data into the template """
-        self.timer.load_file()
-        time = addtime(self.timer.get_time(), dt.timedelta(seconds=60*20))
+        info = self.alarm_info()
 
-        data['CURRENT'] = time.strftime("%H:%M")
-        data['ENABLED'] = 'checked' if self.timer.enabled else ''
+        data['CURRENT'] = info['time'] or ''
+        data['ENABLED'] = 'checked' if info['enabled'] else ''
 
         for key, value in data.items():
             html = html.replace('${}$'.format(key), str(value))
 
         return html
 
+    def alarm_info(self):
+        """ Return the set up alarm as a dict """
+        with self.timer_lock:
+            self.timer.load_file()
+            start = self.timer.get_time()
+            enabled = self.timer.enabled
+        if start is None:
+            return {'time': None, 'start': None, 'enabled': False}
+        return {
+            'time': addtime(start, WAKE_DELAY).strftime('%H:%M'),
+            'start': start.strftime('%H:%M'),
+            'enabled': enabled,
+        }
+
+    def etag(self, path=None):
+        """ Return an ETag changing whenever anything served by the API changes """
+        if path == '/api/telemetry':
+            if self.telemetry is not None:
+                return '"t{}"'.format(self.telemetry.recorded)
+            try:
+                return '"t{}"'.format(os.stat(self.telemetry_file).st_mtime_ns)
+            except (TypeError, FileNotFoundError):
+                return '"t0"'
+        with self.timer_lock:
+            self.timer.store.refresh()
+            return '"{}-{}"'.format(self.state_version, self.timer.store.version)
+
+    def get(self, path, query):
+        """ Handle GET /api/..., return (HTTP code, data) """
+        if path == '/api/state':
+            data = dict(self.state)
+            data['alarm'] = self.alarm_info()
+            return 200, data
+        if path == '/api/alarm':
+            return 200, self.alarm_info()
+        if path == '/api/lights':
+            return 200, self.state.get('lights', [])
+        if path == '/api/progress':
+            return 200, self.state.get('progress', {})
+        if path == '/api/gateways':
+            return 200, self.state.get('gateways', {})
+        if path == '/api/telemetry':
+            return self._get_telemetry(query)
+        if path == '/api/scenes':
+            with self.timer_lock:
+                return 200, self.timer.store.get('scenes', {})
+        raise APIError(404, "Unknown API endpoint {}".format(path))
+
+    def _get_telemetry(self, query):
+        """ Return the last telemetry snapshot, optionally only ?series=prefix """
+        if self.telemetry is not None:
+            data = self.telemetry.snapshot()
+        else:
+            try:
+                with open(self.telemetry_file, 'r') as f:
+                    data = json.load(f)
+            except (TypeError, FileNotFoundError):
+                raise APIError(404, "No telemetry snapshot available")
+        prefix = query.get('series')
+        if prefix:
+            data['series'] = dict((name, series) for (name, series) in data['series'].items()
+                                  if name.startswith(prefix))
+        return 200, data
+
+    def post(self, path, data):
+        """ Handle POST /api/..., return (HTTP code, data) """
+        if path == '/api/alarm':
+            return self._post_alarm(data)
+        if path == '/api/alarm/stop':
+            if self.commands is None:
+                raise APIError(503, "The alarm can't be stopped from this server")
+            self.commands.put(('stop', None))
+            return 202, {'queued': 'stop'}
+        if path == '/api/lights':
+            return self._post_lights(data)
+        if path == '/api/batch':
+            return self._post_batch(data)
+        if path == '/api/scenes':
+            return self._post_scene(data)
+        if path == '/api/scenes/recall':
+            return self._post_recall(data)
+        if path == '/api/diagnostics':
+            if self.commands is None:
+                raise APIError(503, "Diagnostics can't be requested from this server")
+            self.commands.put(('diagnostics', None))
+            return 202, {'queued': 'diagnostics'}
+        if path == '/api/config/reload':
+            if self.commands is None:
+                raise APIError(503, "A reload can't be requested from this server")
+            self.commands.put(('reload', None))
+            return 202, {'queued': 'reload'}
+        raise APIError(404, "Unknown API endpoint {}".format(path))
+
+    def _post_scene(self, data):
+        """ Save a scene: {"name": "evening", "lights": {"tradfri:0": {"brightness": 100, "color": 1}}}
+            Sending "lights": null deletes the scene.
+        """
+        if not isinstance(data, dict) or not data.get('name'):
+            raise APIError(400, "Expected an object with a 'name'")
+        lights = data.get('lights')
+        if lights is not None:
+            if not isinstance(lights, dict) or not all(
+                    isinstance(target, dict) and 'brightness' in target
+                    for target in lights.values()):
+                raise APIError(400, "Expected 'lights' as {\"backend:light\": {\"brightness\": n}}")
+            # checked against the gateways and colors the hub published, if it did
+            try:
+                check_scene(data['name'], lights, self.state.get('colors'),
+                            self.state.get('gateways'))
+            except ValueError as ex:
+                raise APIError(400, str(ex))
+        with self.timer_lock:
+            scenes = dict(self.timer.store.get('scenes', {}))
+            if lights is None:
+                scenes.pop(data['name'], None)
+            else:
+                scenes[data['name']] = lights
+            self.timer.store.update(scenes=scenes)
+        return 200, scenes
+
+    def _post_recall(self, data):
+        """ Recall a saved scene: {"name": "evening"} """
+        if not isinstance(data, dict) or not data.get('name'):
+            raise APIError(400, "Expected an object with a 'name'")
+        if self.commands is None:
+            raise APIError(503, "Lights can't be controlled from this server")
+        with self.timer_lock:
+            if data['name'] not in self.timer.store.get('scenes', {}):
+                raise APIError(404, "Unknown scene '{}'".format(data['name']))
+        self.commands.put(('scene', data['name']))
+        return 202, {'queued': 'scene'}
+
+    def _post_alarm(self, data):
+        """ Set up the alarm: {"time": "07:30", "enabled": true}, both optional """
+        if not isinstance(data, dict):
+            raise APIError(400, "Expected an object")
+        current = self.alarm_info()
+        if 'time' in data:
+            try:
+                new_time = dt.datetime.strptime(str(data['time']), '%H:%M').time()
+            except ValueError:
+                raise APIError(400, "Invalid time '{}', expected HH:MM".format(data['time']))
+        elif current['time'] is not None:
+            new_time = dt.datetime.strptime(current['time'], '%H:%M').time()
+        else:
+            raise APIError(400, "No alarm time set up yet, 'time' is required")
+        # a newly created alarm is enabled unless said otherwise
+        enabled = data.get('enabled', current['enabled'] or current['time'] is None)
+        if isinstance(enabled, str):
+            enabled = enabled.lower() in ('1', 'true', 'on', 'yes', 'enabled')
+        self.handler(new_time=new_time, enabled=bool(enabled))
+        return 200, self.alarm_info()
+
+    def _post_lights(self, data):
+        """ Control lights: {"brightness": 0-254} or {"action": "on"} """
+        if not isinstance(data, dict):
+            raise APIError(400, "Expected an object")
+        if self.commands is None:
+            raise APIError(503, "Lights can't be controlled from this server")
+        if 'brightness' in data:
+            try:
+                brightness = int(data['brightness'])
+            except (TypeError, ValueError):
+                raise APIError(400, "Invalid brightness '{}'".format(data['brightness']))
+            command = ('brightness', max(0, min(254, brightness)))
+        elif data.get('action') in LIGHT_ACTIONS:
+            command = (data['action'], None)
+        else:
+            raise APIError(400, "Expected 'brightness' or 'action' (one of {})".format(
+                ', '.join(LIGHT_ACTIONS)))
+        self.commands.put(command)
+        return 202, {'queued': command[0]}
+
+    def _post_batch(self, data):
+        """ Run several POSTs at once: [{"path": "/api/...", "body": {...}}, ...] """
+        if isinstance(data, dict):
+            data = data.get('requests')
+        if not isinstance(data, list):
+            raise APIError(400, "Expected a list of requests")
+        results = []
+        for request in data:
+            try:
+                if not isinstance(request, dict) or request.get('path') == '/api/batch':
+                    raise APIError(400, "Invalid batch item")
+                code, body = self.post(request.get('path'), request.get('body', {}))
+            except APIError as ex:
+                code, body = ex.code, {'error': str(ex)}
+            results.append({'status': code, 'body': body})
+        return 200, {'results': results}
+
     def run(self):
-        """ Start the server and set up its handlers """
+        """ Start the server and set up its handlers, doesn't return """
         _log('starting server...')
 
+        if self.states is not None:
+            threading.Thread(target=self._receive_states, daemon=True).start()
+
         # Server settings
         server_address = ('', self.port)
         AlarmHTTPServer_RequestHandler.templater = self.templater
         AlarmHTTPServer_RequestHandler.handler = self.handler
-        httpd = HTTPServer(server_address, AlarmHTTPServer_RequestHandler)
+        AlarmHTTPServer_RequestHandler.api = self
+        # threaded, so event stream subscribers don't block other requests
+        httpd = ThreadingHTTPServer(server_address, AlarmHTTPServer_RequestHandler)
+        httpd.daemon_threads = True
         _log('running server...')
         httpd.serve_forever()
 
 
+def _serve(port, state_file, states, commands, telemetry_file):
+    """ To be run in the other process """
+    # don't load huefri just for printing
+    logger.LOGGER.sink = logger.print_sink
+    w = WebServer(port, state_file, states, commands, telemetry_file)
+    w.run()
+
+
 class WebGUI(object):
-    """ A wrapper around WebGUI module """
-    def __init__(self, alarm_file):
-        self.alarm_file = alarm_file
+    """ A wrapper around WebGUI module
+
+        The server runs in one of these modes:
+            thread  - a thread of this process, sharing the state directly
+            process - a forked process, with a copy of everything loaded so far
+            spawn   - a new interpreter, which imports only the web server
+    """
+    MODES = ('thread', 'process', 'spawn')
+    # commands run as soon as they come, not by the main loop
+    URGENT = ('stop', 'diagnostics')
+
+    def __init__(self, state_file, telemetry_file=None, mode='thread', port=8001,
+                 timer=None, telemetry=None):
+        """ timer and telemetry are shared with the server in the thread mode """
+        if mode not in self.MODES:
+            raise ValueError("Unknown web server mode '{}', use one of {}".format(
+                mode, ', '.join(self.MODES)))
+        self.state_file = state_file
+        self.telemetry_file = telemetry_file
+        self.mode = mode
+        self.port = port
+        self.timer = timer
+        self.telemetry = telemetry
         self.proc = None
+        self.server = None
+        self._published = None
+        # If set to a callable, urgent commands are passed to it as
+        # interrupt(command, argument), from a thread of its own
+        self.interrupt = None
+        # commands for the main loop
+        self._pending = queue.Queue()
+        if mode == 'thread':
+            # the state is handed over directly
+            self.states = None
+            self.commands = queue.Queue()
+        else:
+            self._context = multiprocessing.get_context('fork' if mode == 'process' else 'spawn')
+            # main loop -> server
+            self.states = self._context.Queue()
+            # server -> main loop
+            self.commands = self._context.Queue()
 
     def run(self):
         """ Start a http server in the background """
-        self.proc = Process(target=self._new_proc)
+        threading.Thread(target=self._route_commands, name="webgui-commands",
+                         daemon=True).start()
+        if self.mode == 'thread':
+            self.server = WebServer(self.port, self.state_file, commands=self.commands,
+                                    telemetry_file=self.telemetry_file,
+                                    timer=self.timer, telemetry=self.telemetry)
+            threading.Thread(target=self.server.run, name="webgui", daemon=True).start()
+            return
+        self.proc = self._context.Process(target=_serve, args=(
+            self.port, self.state_file, self.states, self.commands, self.telemetry_file))
         self.proc.start()
 
-    def _new_proc(self):
-        """ To be run in the other process """
-        w = WebServer(8001, self.alarm_file)
-        w.run()
+    def publish(self, state):
+        """ Send the current hub state to the server, if it has changed """
+        if state == self._published:
+            return
+        self._published = state
+        if self.server is not None:
+            self.server.update_state(state)
+        else:
+            self.states.put(('state', state))
+
+    def event(self, name, data):
+        """ Send an event to all subscribers of /api/events """
+        if self.server is not None:
+            self.server.events.publish(name, data)
+        else:
+            self.states.put(('event', name, data))
+
+    def _route_commands(self):
+        """ Pass urgent commands to interrupt right away, queue the rest
+            for the main loop. Runs in a thread.
+        """
+        while True:
+            (command, argument) = self.commands.get()
+            if command in self.URGENT and callable(self.interrupt):
+                try:
+                    self.interrupt(command, argument)
+                except Exception as ex:
+                    _log("Command %s failed: %r", command, ex, level=logger.ERROR)
+                continue
+            self._pending.put((command, argument))
+
+    def pending_commands(self):
+        """ Yield (command, argument) tuples received by the server """
+        while True:
+            try:
+                yield self._pending.get_nowait()
+            except queue.Empty:
+                return
+
+    def queue_depths(self):
+        """ Return the number of messages waiting in both directions """
+        return {
+            'web states': self.states.qsize() if self.states is not None else 0,
+            'web commands': self._pending.qsize(),
+        }
 
     def __exit__(self, exc_type, exc_value, traceback):
         """ Clean """
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+import threading
+import unittest
+from unittest import mock
+from src import alarm
+from src import controller
+
+CONFIG = {
+    'alarm': {
+        'gpio': False,
+        'sound': {'path': 'beep.mp3', 'volume_increment': 10,
+                  'volume_initial': 10, 'force_alsa': False},
+        'brightening': {'duration': 100, 'step': 1},
+    },
+}
+
+class FakeSound(object):
+
+    def __init__(self, cnf):
+        self.playing = False
+        self.volume = 0
+
+    def reconfigure(self, cnf):
+        return True
+
+    def volume_update(self):
+        pass
+
+    def is_playing(self):
+        return self.playing
+
+    def play(self):
+        self.playing = True
+
+    def stop(self):
+        self.playing = False
+
+
+class FakeAlarm(alarm.Alarm):
+    sound_class = FakeSound
+
+
+class TestInterrupt(unittest.TestCase):
+
+    def setUp(self):
+        alarm._log = controller._log = lambda *a, **k: None
+        self.controller = mock.Mock(prev_brightness=0, alarm_start=False)
+        self.controller.cancel_pending.return_value = 3
+        self.alarm = FakeAlarm(mock.Mock(get=lambda: CONFIG), self.controller, mock.Mock())
+        self.events = []
+        self.alarm.listener = lambda name, data: self.events.append((name, data))
+
+    def start(self):
+        self.alarm.alarm_started = alarm.clock.now()
+        return self.alarm.alarm_started
+
+    def test_nothing_running(self):
+        self.assertFalse(self.alarm.interrupt('web'))
+        self.assertEqual(self.events, [])
+        self.controller.cancel_pending.assert_not_called()
+
+    def test_ramp(self):
+        self.start()
+        thread = threading.Thread(target=self.alarm.interrupt, args=('web',))
+        thread.start()
+        thread.join()
+        self.assertIsNone(self.alarm.alarm_started)
+        self.controller.cancel_pending.assert_called_once_with()
+        self.assertEqual(self.events, [('aborted', {'source': 'web', 'cancelled': 3})])
+
+    def test_step_after_interrupt(self):
+        self.alarm.sunrise = mock.Mock()
+        started = self.start()
+        self.alarm.interrupt('button')
+        self.alarm.sunrise_update(10, started)
+        self.alarm.sunrise.commands.assert_not_called()
+        self.controller.apply_states.assert_not_called()
+
+    def test_button(self):
+        condition = self.controller.callback_condition
+        # the press stopping the sound does nothing else
+        self.alarm.sound.playing = True
+        self.assertFalse(condition())
+        self.assertFalse(self.alarm.sound.playing)
+        self.assertEqual(self.events, [('sound', {'playing': False})])
+        # as does one stopping the ramp
+        self.start()
+        self.assertFalse(condition())
+        self.assertIsNone(self.alarm.alarm_started)
+        self.assertTrue(condition())
+
+    def test_alarm_button(self):
+        self.alarm.gpio = True
+        self.alarm.timer.check_now.return_value = False
+        self.alarm.timer.enabled = True
+        self.alarm.timer.seconds_to_next.return_value = None
+        self.controller.get_brigtnesses.return_value = []
+        self.start()
+        controller.Controller.dispatch(self.controller, 'alarm', 21)
+        self.assertIsNone(self.alarm.alarm_started)
+        self.assertFalse(self.controller.alarm_start)
+        self.alarm.alarm()
+        self.assertIsNone(self.alarm.alarm_started)
+        self.assertEqual([name for (name, _) in self.events], ['aborted'])
+
+    def test_light_changed(self):
+        listener = self.controller.change_listener
+        self.start()
+        self.alarm.prev_brightness.put(20)
+        listener('tradfri', 0, 20)
+        self.assertIsNotNone(self.alarm.alarm_started)
+        listener('tradfri', 0, 80)
+        self.assertIsNone(self.alarm.alarm_started)
+        self.assertEqual(self.events[0][1]['source'], 'lights')
+
+
+
+class TestIdle(unittest.TestCase):
+
+    def setUp(self):
+        alarm._log = controller._log = lambda *a, **k: None
+        alarm.clock.install(alarm.clock.VirtualClock(datetime(2018, 3, 1, 12, 0)))
+        self.lights = {0: 100}
+        self.controller = mock.Mock(prev_brightness=0, alarm_start=False,
+                                    last_brightnesses=[])
+        self.controller.get_brigtnesses.side_effect = self.read
+        self.alarm = FakeAlarm(mock.Mock(get=lambda: CONFIG), self.controller, mock.Mock())
+        self.alarm.timer.check_now.return_value = False
+        self.alarm.timer.seconds_to_next.return_value = None
+
+    def tearDown(self):
+        alarm.clock.install(alarm.clock.Clock())
+
+    def read(self):
+        self.controller.last_brightnesses = [('tradfri', light, br)
+                                             for (light, br) in self.lights.items()]
+        return list(self.lights.values())
+
+    def states(self):
+        return controller.Controller.light_states(self.controller)
+
+    def test_changed_outside(self):
+        self.alarm.alarm()
+        self.assertEqual(self.states(), [{'backend': 'tradfri', 'light': 0, 'brightness': 100}])
+        # switched off from the wall, seen within the idle interval
+        self.lights[0] = 0
+        for _ in range(self.alarm.governor.intervals['idle']):
+            alarm.clock.sleep(1)
+            self.alarm.alarm()
+        self.assertEqual(self.alarm.governor.phase, 'idle')
+        self.assertEqual(self.states(), [{'backend': 'tradfri', 'light': 0, 'brightness': 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from src import buttons
+
+MS = 10 ** 6
+
+class TestButtonEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.engine = buttons.ButtonEngine([
+            (5, 'up'),
+            (6, {'press': 'on', 'long': 'off'}),
+            (12, {'press': 'onoff', 'double': 'scene:evening'}),
+            (19, {'press': 'down', 'repeat': 'down'}),
+        ], lambda event, pin: self.events.append(event))
+
+    def press(self, pin, at, length):
+        self.engine.edge(pin, True, at * MS)
+        self.engine.check((at + length - 1) * MS)
+        self.engine.edge(pin, False, (at + length) * MS)
+
+    def test_press(self):
+        self.press(5, 1000, 50)
+        self.assertEqual(self.events, ['up'])
+        # too short, bouncing and unknown pins are ignored
+        self.press(5, 2000, 2)
+        self.engine.edge(5, True, 3000 * MS)
+        self.engine.edge(5, False, 3004 * MS)
+        self.engine.edge(7, True, 3000 * MS)
+        self.assertEqual(self.events, ['up'])
+
+    def test_chord(self):
+        self.engine.edge(5, True, 1000 * MS)
+        self.engine.edge(6, True, 1010 * MS)
+        self.engine.edge(5, False, 1100 * MS)
+        self.engine.edge(6, False, 1120 * MS)
+        self.assertEqual(self.events, ['up', 'on'])
+
+    def test_long(self):
+        self.engine.edge(6, True, 1000 * MS)
+        self.engine.check(1700 * MS)
+        self.assertEqual(self.events, [])
+        self.engine.check(1800 * MS)
+        self.assertEqual(self.events, ['off'])
+        self.engine.edge(6, False, 2500 * MS)
+        self.assertEqual(self.events, ['off'])
+
+    def test_double(self):
+        self.press(12, 1000, 50)
+        self.press(12, 1200, 50)
+        self.assertEqual(self.events, ['scene:evening'])
+        self.press(12, 2000, 50)
+        self.engine.check(2100 * MS)
+        self.assertEqual(self.events, ['scene:evening'])
+        self.engine.check(2400 * MS)
+        self.assertEqual(self.events, ['scene:evening', 'onoff'])
+
+    def test_repeat(self):
+        self.engine.edge(19, True, 0)
+        times = []
+        deadline = self.engine.check(0)
+        while deadline is not None and deadline < 3000 * MS:
+            before = len(self.events)
+            now = deadline
+            deadline = self.engine.check(now)
+            if len(self.events) > before:
+                times.append(now)
+        self.engine.edge(19, False, 3000 * MS)
+        intervals = [b - a for (a, b) in zip(times, times[1:])]
+        self.assertEqual(intervals[0], 200 * MS)
+        self.assertEqual(intervals[-1], 50 * MS)
+        self.assertTrue(all(a >= b for (a, b) in zip(intervals, intervals[1:])))
+        # the release doesn't add a press
+        self.assertEqual(len(self.events), len(times))
+
+    def test_short_tap(self):
+        # released sooner than the debounce time, the release still counts
+        self.engine.edge(19, True, 1000 * MS)
+        self.engine.edge(19, False, 1010 * MS)
+        self.assertEqual(self.events, ['down'])
+        self.assertIsNone(self.engine.check(3000 * MS))
+        self.assertEqual(self.events, ['down'])
+        self.press(19, 4000, 50)
+        self.assertEqual(self.events, ['down', 'down'])
+        # bounces don't add presses
+        self.engine.edge(5, True, 5000 * MS)
+        self.engine.edge(5, True, 5002 * MS)
+        self.engine.edge(5, False, 5050 * MS)
+        self.engine.edge(5, False, 5052 * MS)
+        self.assertEqual(self.events, ['down', 'down', 'up'])
+
+    def test_release_bounce(self):
+        self.press(12, 0, 150)
+        self.engine.edge(12, True, 151 * MS)
+        self.engine.edge(12, False, 158 * MS)
+        self.engine.check(1000 * MS)
+        self.assertEqual(self.events, ['onoff'])
+        # a press after the debounce time is a new one
+        self.press(12, 2000, 50)
+        self.press(12, 2080, 50)
+        self.assertEqual(self.events, ['onoff', 'scene:evening'])
+
+    def test_lost_release(self):
+        level = {}
+        engine = buttons.ButtonEngine([(6, {'long': 'off'}), (19, {'repeat': 'down'})],
+                                      lambda event, pin: self.events.append(event),
+                                      read=lambda pin: level.get(pin, False))
+        # the releases never came, the pins read released
+        engine.edge(6, True, 0)
+        engine.edge(19, True, 0)
+        self.assertIsNone(engine.check(1000 * MS))
+        self.assertEqual(self.events, [])
+        # a press after a lost release is read again
+        level[6] = True
+        engine.edge(6, True, 2000 * MS)
+        engine.check(2900 * MS)
+        self.assertEqual(self.events, ['off'])
+        engine.edge(6, True, 4000 * MS)
+        level[6] = False
+        engine.edge(6, True, 5000 * MS)
+        self.assertFalse(engine.held[6])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            buttons.ButtonEngine([(5, {'triple': 'up'})], None)
+        with self.assertRaises(ValueError):
+            buttons.ButtonEngine([], None, hold=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime, time
+import os
+import tempfile
+import unittest
+from src import clock
+from src import timer
+
+class TestVirtualClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(datetime(2018, 3, 1, 6, 0), end=datetime(2018, 3, 2))
+        clock.install(self.clock)
+
+    def tearDown(self):
+        clock.install(clock.Clock())
+
+    def test_sleep(self):
+        start = clock.monotonic()
+        clock.sleep(90)
+        self.assertEqual(clock.now(), datetime(2018, 3, 1, 6, 1, 30))
+        self.assertEqual(clock.monotonic() - start, 90)
+        self.assertEqual(clock.monotonic_ns(), 90 * 10 ** 9)
+
+    def test_end(self):
+        clock.sleep(3600)
+        with self.assertRaises(clock.SimulationEnd):
+            clock.sleep(24 * 3600)
+
+    def test_timer(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            t = timer.AlarmTimer(os.path.join(tmpdir, 'state.json'))
+            t.set_time(time(6, 30))
+            self.assertEqual(t.seconds_to_next(), 30 * 60)
+            self.assertFalse(t.check_now())
+            clock.sleep(30 * 60)
+            self.assertTrue(t.check_now())
+
+
+if __name__ == '__main__':
+    unittest.main()
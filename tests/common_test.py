@@ -17,9 +17,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
+import os
+import tempfile
+import threading
 import unittest
 from unittest import mock
 from src import alarm
+from src import timer
 from datetime import datetime, time
 
 class TestQueue(unittest.TestCase):
@@ -53,75 +58,132 @@ class AlarmTestCase(unittest.TestCase):
             raise AssertionError("{} != {}".format(a, b))
 
 
-class TestAlarmTimer(AlarmTestCase):
+class TestLegacyFile(AlarmTestCase):
 
     def setUp(self):
-        alarm._log = lambda x: None
+        timer._log = lambda *a, **k: None
 
     def tearDown(self):
         pass
 
-    def test_init_invalid_format(self):
+    def test_invalid_format(self):
         with self.assertRaises(SyntaxError):
-            with mock.patch('src.alarm.open', mock.mock_open(read_data='bad input')) as m:
-                alarm.AlarmTimer("foobar")
+            with mock.patch('src.timer.open', mock.mock_open(read_data='bad input')) as m:
+                timer.read_legacy_file("foobar")
 
         with self.assertRaises(SyntaxError):
-            with mock.patch('src.alarm.open', mock.mock_open(read_data='3:5')) as m:
-                alarm.AlarmTimer("foobar")
+            with mock.patch('src.timer.open', mock.mock_open(read_data='3:5')) as m:
+                timer.read_legacy_file("foobar")
 
-    def test_init_no_file(self):
-        alarm.AlarmTimer("foobar")
+    def test_no_file(self):
+        self.assertIsNone(timer.read_legacy_file("foobar"))
+
+    def test_valid_format(self):
+        with mock.patch('src.timer.open', mock.mock_open(read_data='13:25')) as m:
+            self.assertEqual(timer.read_legacy_file("foobar"), (time(13, 25), True))
+
+        with mock.patch('src.timer.open', mock.mock_open(read_data='03:05')) as m:
+            self.assertEqual(timer.read_legacy_file("foobar"), (time(3, 5), True))
+
+        with mock.patch('src.timer.open', mock.mock_open(read_data='13:25\ndisabled')) as m:
+            self.assertEqual(timer.read_legacy_file("foobar"), (time(13, 25), False))
 
-    def test_init_valid_format(self):
-        with mock.patch('src.alarm.open', mock.mock_open(read_data='13:25')) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, time(13, 25))
+        with mock.patch('src.timer.open', mock.mock_open(read_data='13:25\n')) as m:
+            self.assertEqual(timer.read_legacy_file("foobar"), (time(13, 25), True))
 
-        with mock.patch('src.alarm.open', mock.mock_open(read_data='03:05')) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, time(3, 5))
+        with mock.patch('src.timer.open', mock.mock_open(read_data='13:25\nenabled')) as m:
+            self.assertEqual(timer.read_legacy_file("foobar"), (time(13, 25), True))
 
-        with mock.patch('src.alarm.open', mock.mock_open(read_data='13:25\ndisabled')) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, time(13, 25))
-            self.assertFalse(t.enabled)
 
-        with mock.patch('src.alarm.open', mock.mock_open(read_data='13:25\n')) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, time(13, 25))
-            self.assertTrue(t.enabled)
+class TestAlarmTimer(AlarmTestCase):
+
+    def setUp(self):
+        timer._log = lambda *a, **k: None
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state.json')
 
-        with mock.patch('src.alarm.open', mock.mock_open(read_data='13:25\nenabled')) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, time(13, 25))
-            self.assertTrue(t.enabled)
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_init_no_file(self):
+        t = timer.AlarmTimer(self.path)
+        self.assertIsNone(t.time)
+        self.assertFalse(t.enabled)
+        self.assertFalse(t.check_now())
+
+    def test_legacy_import(self):
+        legacy = os.path.join(self.dir.name, 'alarm_time')
+        with open(legacy, 'w') as f:
+            f.write('13:25\ndisabled\n')
+        t = timer.AlarmTimer(self.path, legacy)
+        self.assertTimeEqual(t.time, time(13, 25))
+        self.assertFalse(t.enabled)
+        # once imported, the store wins
+        t.set_time(time(8, 0))
+        t = timer.AlarmTimer(self.path, legacy)
+        self.assertTimeEqual(t.time, time(8, 0))
 
     def test_now(self):
         now = datetime.now().time().replace(second=0, microsecond=0)
-        with mock.patch('src.alarm.open', mock.mock_open(read_data=now.strftime('%H:%M'))) as m:
-            t = alarm.AlarmTimer("foobar")
-            self.assertTimeEqual(t.time, now)
-            self.assertTrue(t.check_now())
-            t.time = t.time.replace(hour=(t.time.hour+2)%24)
-            self.assertFalse(t.check_now())
+        t = timer.AlarmTimer(self.path)
+        t.set_time(now)
+        self.assertTimeEqual(t.time, now)
+        self.assertTrue(t.check_now())
+        t.set_time(now, enabled=False)
+        self.assertFalse(t.check_now())
+        t.set_time(now.replace(hour=(now.hour+2)%24))
+        self.assertFalse(t.check_now())
 
     def test_set_enable(self):
-        m = mock.mock_open(read_data="13:25")
         new_time = time(8, 35)
-        with mock.patch('src.alarm.open', m, create=True):
-            t = alarm.AlarmTimer("foobar")
-            t.set_time(new_time)
-            self.assertTimeEqual(t.time, new_time)
-        handle = m()
-        handle.write.assert_called_once_with(new_time.strftime('%H:%M\nenabled'))
+        t = timer.AlarmTimer(self.path)
+        t.set_time(new_time)
+        self.assertTimeEqual(t.time, new_time)
+        self.assertTrue(t.enabled)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['alarms'], [{'time': '08:35', 'enabled': True}])
 
     def test_set_disable(self):
-        m = mock.mock_open(read_data="13:25")
         new_time = time(8, 35)
-        with mock.patch('src.alarm.open', m, create=True):
-            t = alarm.AlarmTimer("foobar")
-            t.set_time(new_time, enabled=False)
-            self.assertTimeEqual(t.time, new_time)
-        handle = m()
-        handle.write.assert_called_once_with(new_time.strftime('%H:%M\ndisabled'))
\ No newline at end of file
+        t = timer.AlarmTimer(self.path)
+        t.set_time(new_time, enabled=False)
+        self.assertTimeEqual(t.time, new_time)
+        self.assertFalse(t.enabled)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)['alarms'], [{'time': '08:35', 'enabled': False}])
+
+    def test_other_process(self):
+        t = timer.AlarmTimer(self.path)
+        other = timer.AlarmTimer(self.path)
+        other.set_time(time(6, 0))
+        other.set_time(time(7, 0), index=1)
+        t.load_file()
+        self.assertEqual(t.alarms, [(time(6, 0), True), (time(7, 0), True)])
+
+    def test_threads(self):
+        t = timer.AlarmTimer(self.path)
+        t.set_time(time(6, 0))
+        settings = [(time(6, 0), True), (time(7, 0), False)]
+        def write():
+            for i in range(100):
+                t.set_time(*settings[i % 2])
+        writer = threading.Thread(target=write)
+        writer.start()
+        seen = set()
+        while writer.is_alive():
+            with t.lock:
+                t.load_file()
+                seen.add((t.time, t.enabled))
+            t.seconds_to_next()
+        writer.join()
+        self.assertLessEqual(seen, set(settings))
+
+    def test_shown_alarm(self):
+        t = timer.AlarmTimer(self.path)
+        t.set_time(time(6, 0), enabled=False)
+        t.set_time(time(7, 0), index=1)
+        # time and enabled come from the same alarm
+        self.assertEqual((t.index, t.time, t.enabled), (1, time(7, 0), True))
+        t.set_time(time(7, 30), False, t.index)
+        self.assertEqual(t.alarms, [(time(6, 0), False), (time(7, 30), False)])
+        self.assertEqual((t.index, t.time, t.enabled), (0, time(6, 0), False))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import time
+import unittest
+from src import diagnostics
+
+class TestDiagnostics(unittest.TestCase):
+
+    def setUp(self):
+        diagnostics._log = lambda *a, **k: None
+        self.dir = tempfile.TemporaryDirectory()
+        self.diag = diagnostics.Diagnostics(self.dir.name, profile_time=10)
+
+    def tearDown(self):
+        self.diag.profiler.stop()
+        self.diag.profiler._thread.join()
+        self.dir.cleanup()
+
+    def test_request(self):
+        self.diag.add_source('queues', lambda: {'depth': 42})
+        self.diag.add_source('broken', lambda: 1 / 0)
+        for tick in (0.001, 0.002, 0.003):
+            self.diag.tick(tick)
+        self.assertIsNone(self.diag.check())
+
+        self.diag.request()
+        path = self.diag.check()
+        with open(path) as f:
+            report = f.read()
+        self.assertIn("{'depth': 42}", report)
+        self.assertIn("failed: ZeroDivisionError", report)
+        self.assertIn("'max': 3.0", report)
+        self.assertIn("test_request", report)
+        self.assertTrue(self.diag.profiler.running())
+
+        # the second request stops the profiler and writes the profile
+        self.diag.request()
+        self.assertIsNone(self.diag.check())
+        self.diag.profiler._thread.join()
+        self.assertEqual(len(os.listdir(self.dir.name)), 2)
+
+    def test_watcher(self):
+        self.diag.tick(0.001)
+        self.diag.start()
+        self.diag.request()
+        # the main thread is busy and never calls check()
+        end = time.monotonic() + 5
+        while not self.diag.profiler.running() and time.monotonic() < end:
+            time.sleep(0.01)
+        (name,) = os.listdir(self.dir.name)
+        with open(os.path.join(self.dir.name, name)) as f:
+            report = f.read()
+        main = report.split('== Threads ==\n')[1].split('\n-- ')[0]
+        self.assertTrue(main.startswith('-- MainThread'))
+        self.assertIn("test_watcher", main)
+        self.assertIn("the last tick ended", report)
+
+    def test_signal(self):
+        # the handler interrupting request() on the same thread
+        def handler():
+            self.diag.signal(10, None)
+            self.assertFalse(self.diag._requested.is_set())
+        with self.diag._requested._cond:
+            handler()
+        self.diag.SIGNAL_POLL = 0.01
+        self.diag.start()
+        end = time.monotonic() + 5
+        while not self.diag.profiler.running() and time.monotonic() < end:
+            time.sleep(0.01)
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
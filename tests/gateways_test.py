@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime, timedelta
+import threading
+import unittest
+from unittest import mock
+from src import gateways
+
+class TestSections(unittest.TestCase):
+
+    def test_names(self):
+        cnf = {
+            'hue': {'addr': 'a'},
+            'tradfri': [{'addr': 'b'}, {'addr': 'c'}, {'addr': 'd', 'name': 'upstairs'}],
+        }
+        self.assertEqual([(kind, name) for (kind, name, _) in gateways.gateway_sections(cnf)],
+                         [('hue', 'hue'), ('tradfri', 'tradfri'),
+                          ('tradfri', 'tradfri2'), ('tradfri', 'upstairs')])
+
+    def test_invalid_names(self):
+        with self.assertRaises(ValueError):
+            gateways.gateway_sections({'tradfri': [{}, {'name': 'tradfri'}]})
+        with self.assertRaises(ValueError):
+            gateways.gateway_sections({'hue': {'name': 'a:b'}})
+
+
+class TestRateBudget(unittest.TestCase):
+
+    def test_budget(self):
+        now = [0.0]
+        budget = gateways.RateBudget(rate=2, burst=4, clock=lambda: now[0])
+        self.assertEqual([budget.delay() for _ in range(4)], [0, 0, 0, 0])
+        self.assertAlmostEqual(budget.delay(), 0.5)
+        now[0] = 10
+        self.assertEqual(budget.delay(3), 0)
+
+    def test_unlimited(self):
+        budget = gateways.RateBudget()
+        self.assertEqual(sum(budget.delay() for _ in range(1000)), 0)
+
+
+def gateway(kind, name):
+    backend = mock.Mock(lights_selected=[0])
+    return gateways.Gateway(kind, name, backend)
+
+
+class TestGatewayPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = gateways.GatewayPool()
+        for (kind, name) in (('hue', 'hue'), ('tradfri', 'tradfri'), ('tradfri', 'upstairs')):
+            self.pool.add(gateway(kind, name))
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_parallel(self):
+        barrier = threading.Barrier(3, timeout=5)
+        results = self.pool.fan_out(lambda gw: (barrier.wait(), gw.name)[1])
+        self.assertEqual(results, {'hue': 'hue', 'tradfri': 'tradfri', 'upstairs': 'upstairs'})
+        self.assertEqual(self.pool.primary('tradfri'), self.pool.get('tradfri').backend)
+
+    def test_failure(self):
+        def func(gw):
+            if gw.name == 'upstairs':
+                raise IOError("timeout")
+            return gw.name
+        self.assertEqual(sorted(self.pool.fan_out(func)), ['hue', 'tradfri'])
+        self.assertEqual(self.pool.status()['upstairs']['state'], 'failing')
+        # paused for a while
+        self.assertEqual([gw.name for gw in self.pool.available()], ['hue', 'tradfri'])
+
+        def fail(gw):
+            raise IOError("down")
+        with self.assertRaises(IOError):
+            self.pool.fan_out(fail)
+
+    def test_threads(self):
+        # fan_out from several threads while the executor is replaced
+        for i in range(3):
+            self.pool.add(gateway('tradfri', 'tradfri{}'.format(i)))
+        errors = []
+        def call(count):
+            try:
+                for _ in range(200):
+                    self.pool.fan_out(lambda gw: gw.name, self.pool.gateways[:count])
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=call, args=(n,)) for n in range(2, 7)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            self.pool.shutdown()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_replace(self):
+        old = self.pool.get('upstairs')
+        old.sender = mock.Mock()
+        self.pool.add(gateway('tradfri', 'upstairs'))
+        old.sender.cancel.assert_called_once_with()
+        old.backend.shutdown.assert_called_once_with()
+        new = self.pool.get('upstairs')
+        self.pool.add(new)
+        self.assertFalse(new.backend.shutdown.called)
+        self.pool.remove('upstairs')
+        new.backend.shutdown.assert_called_once_with()
+
+    def test_reboot_schedule(self):
+        self.pool.created = datetime(2018, 1, 1, 12)
+        day = datetime(2018, 1, 2)
+        self.assertIsNone(self.pool.reboot_due(day.replace(hour=3, minute=59)))
+        first = self.pool.reboot_due(day.replace(hour=4))
+        self.assertEqual(first.name, 'tradfri')
+        self.pool.reboot(first)
+        first.backend.reboot.assert_called_once_with()
+        # never two at once
+        self.assertIsNone(self.pool.reboot_due(day.replace(hour=4, minute=20)))
+        self.assertEqual([gw.name for gw in self.pool.available()], ['hue', 'upstairs'])
+
+        self.pool.connect = lambda gw: mock.Mock(lights_selected=[0])
+        first.down_until = 0
+        self.pool.maintain()
+        self.assertFalse(first.rebooting)
+        first.last_reboot = day.replace(hour=4)
+        self.assertIsNone(self.pool.reboot_due(day.replace(hour=4, minute=10)))
+        self.assertEqual(self.pool.reboot_due(day.replace(hour=4, minute=20)).name, 'upstairs')
+
+
+if __name__ == '__main__':
+    unittest.main()
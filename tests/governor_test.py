@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from src import governor
+
+class TestPollingGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.g = governor.PollingGovernor(fast=1, slow=30, standby=300, cooldown=60)
+
+    def polls(self, start, end, **kwargs):
+        """ Return how many times the governor polled in one second ticks """
+        return sum(self.g.should_poll(t, **kwargs) for t in range(start, end))
+
+    def test_idle(self):
+        # a refresh every standby seconds, starting with the first tick
+        self.assertEqual(self.polls(0, 100, ramping=False, sound=False), 1)
+        self.assertEqual(self.g.phase, governor.IDLE)
+        self.assertEqual(self.polls(100, 600, ramping=False, sound=False, next_alarm=1000), 1)
+        g = governor.PollingGovernor.from_config({'idle': 60})
+        self.assertEqual(sum(g.should_poll(t, False, False) for t in range(600)), 10)
+
+    def test_fast(self):
+        self.assertEqual(self.polls(0, 10, ramping=True, sound=False), 10)
+        self.assertEqual(self.g.phase, governor.RAMP)
+        self.assertEqual(self.polls(10, 20, ramping=False, sound=True), 10)
+        self.assertEqual(self.g.phase, governor.SOUND)
+
+    def test_standby(self):
+        self.assertEqual(self.polls(0, 90, ramping=False, sound=False, next_alarm=200), 3)
+        self.assertEqual(self.g.phase, governor.STANDBY)
+
+    def test_cooldown(self):
+        self.polls(0, 10, ramping=False, sound=True)
+        # one slow poll during the 60 s cooldown, then the idle refresh
+        self.assertEqual(self.polls(10, 300, ramping=False, sound=False), 1)
+        self.assertEqual(self.polls(300, 400, ramping=False, sound=False), 1)
+        self.assertEqual(self.g.phase, governor.IDLE)
+
+    def test_config(self):
+        g = governor.PollingGovernor.from_config({'slow': 5, 'unknown': 1})
+        self.assertEqual(g.intervals[governor.STANDBY], 5)
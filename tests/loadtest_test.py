@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pickle
+import unittest
+from src import loadtest
+from src import timer
+from src import webgui
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = loadtest.Histogram()
+        self.assertIsNone(h.percentile(50))
+        for ms in range(1, 101):
+            h.add(ms / 1000.0)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.percentile(50), 0.050, delta=0.050 * 0.05)
+        self.assertAlmostEqual(h.percentile(99), 0.099, delta=0.099 * 0.05)
+        self.assertEqual(h.percentile(100), 0.1)
+
+        other = loadtest.Histogram()
+        other.add(2.0)
+        h.merge(other)
+        self.assertEqual(h.count, 101)
+        self.assertEqual(h.summary()['max'], 2000.0)
+
+    def test_parse_duration(self):
+        self.assertEqual(loadtest.parse_duration('90'), 90)
+        self.assertEqual(loadtest.parse_duration('30m'), 1800)
+        self.assertEqual(loadtest.parse_duration('1.5h'), 5400)
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_message = webgui.AlarmHTTPServer_RequestHandler.log_message
+        webgui.AlarmHTTPServer_RequestHandler.log_message = lambda *args: None
+        webgui._log = timer._log = lambda *a, **k: None
+
+    def tearDown(self):
+        webgui.AlarmHTTPServer_RequestHandler.log_message = self.log_message
+
+    def test_run(self):
+        test = loadtest.LoadTest(clients=2, rate=100, subscribers=1, slow=2,
+                                 slow_interval=0.2, tick=0.1)
+        report = test.run(1, sample=0.5, baseline=0.3)
+        self.assertGreater(report['requests'], 50)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['slow']['open'], 2)
+        self.assertGreater(report['events'], 0)
+        self.assertGreater(report['tick_late_ms']['baseline']['count'], 0)
+        self.assertGreater(report['tick_late_ms']['loaded']['count'], 0)
+        self.assertEqual(len(test.samples), 2)
+        self.assertIsNotNone(test.samples[0]['fds'])
+        self.assertEqual(report['clients'], 'separate process')
+        self.assertIsNone(test._load)
+
+    def test_mix_pickles(self):
+        self.assertEqual(pickle.loads(pickle.dumps(loadtest.WRITE_MIX)), loadtest.WRITE_MIX)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import threading
+import unittest
+from src import logger
+
+class TestLogger(unittest.TestCase):
+
+    def setUp(self):
+        self.out = []
+        self.log = logger.Logger(sink=lambda module, msg: self.out.append((module, msg)))
+        # do not let the background thread race with the test
+        self.log._thread = True
+
+    def test_buffered(self):
+        self.log.log("A", "value %d", 5)
+        self.assertEqual(self.out, [])
+        self.log.flush()
+        self.assertEqual(self.out, [("A", "value 5")])
+
+    def test_levels(self):
+        self.log.set_level('warning')
+        self.log.set_level('debug', module="B")
+        self.log.log("A", "skipped")
+        self.log.log("A", "kept", level=logger.ERROR)
+        self.log.log("B", "debug", level=logger.DEBUG)
+        self.log.flush()
+        self.assertEqual(self.out, [("A", "ERROR: kept"), ("B", "debug")])
+
+    def test_repeats(self):
+        for i in range(5):
+            self.log.log("A", "same")
+        self.log.log("A", "other")
+        self.log.flush()
+        self.assertEqual(self.out, [
+            ("A", "same"),
+            ("A", "last message repeated 4 times"),
+            ("A", "other"),
+        ])
+
+    def test_history(self):
+        self.log.history = logger.deque(maxlen=3)
+        for i in range(5):
+            self.log.log("A", "msg %d", i)
+        self.log.log("B", "b")
+        self.assertEqual([e[3] for e in self.log.recent()], ["msg 3", "msg 4", "b"])
+        self.assertEqual([e[3] for e in self.log.recent(module="A")], ["msg 3", "msg 4"])
+        self.assertEqual([e[3] for e in self.log.recent(1)], ["b"])
+
+    def test_error_wakes(self):
+        self.log._thread = None
+        self.log.interval = 60
+        self.log.log("A", "info")
+        self.log.log("A", "broken", level=logger.ERROR)
+        for _ in range(100):
+            if self.out:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.out, [("A", "info"), ("A", "ERROR: broken")])
+
+
+class TestFork(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "no fork")
+    def test_child_flushes(self):
+        sink = logger.LOGGER.sink
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            def to_file(module, msg):
+                with open(path, 'a') as f:
+                    f.write('{} {} {}\n'.format(os.getpid(), module, msg))
+            logger.LOGGER.sink = to_file
+            try:
+                logger.log("Parent", "before the fork")
+                logger.flush()
+                pid = os.fork()
+                if pid == 0:
+                    logger.log("Child", "after the fork", level=logger.ERROR)
+                    threading.Event().wait(1)
+                    os._exit(0)
+                os.waitpid(pid, 0)
+            finally:
+                logger.LOGGER.sink = sink
+            with open(path) as f:
+                lines = [line.split(' ', 1) for line in f.read().splitlines()]
+        self.assertEqual(lines, [[str(os.getpid()), "Parent before the fork"],
+                                 [str(pid), "Child ERROR: after the fork"]])
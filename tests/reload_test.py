@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import copy
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from src import reload
+
+CONFIG = {
+    'alarm': {
+        'gpio': False,
+        'sound': {'path': 'beep.mp3', 'volume_increment': 10,
+                  'volume_initial': 10, 'force_alsa': True},
+        'brightening': {'duration': 60, 'step': 1},
+    },
+    'tradfri': {'addr': 'tradfri', 'secret': 'X', 'controlled': [0], 'main': 0},
+}
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid(self):
+        reload.validate(CONFIG)
+
+    def test_invalid(self):
+        for change in (
+                lambda c: c.pop('alarm'),
+                lambda c: c['alarm']['sound'].pop('path'),
+                lambda c: c['alarm']['brightening'].update(step=0),
+                lambda c: c['alarm']['brightening'].update(lights={'tradfri:0': {'curve': 0}}),
+                lambda c: c.pop('tradfri'),
+                lambda c: c['tradfri'].update(controlled=0),
+                lambda c: c.update(logging={'level': 'loud'}),
+                lambda c: c.update(webgui={'mode': 'fork'}),
+                ):
+            cnf = copy.deepcopy(CONFIG)
+            change(cnf)
+            with self.assertRaises(ValueError):
+                reload.validate(cnf)
+
+
+class TestHotReload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'config.json')
+        self.write(CONFIG)
+        self.now = 0
+        self.r = reload.HotReload(self.path, mock.Mock(), clock=lambda: self.now)
+        self.r.start()
+        self.controller = mock.Mock()
+        self.alarm = mock.Mock()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, cnf):
+        with open(self.path, 'w') as f:
+            json.dump(cnf, f)
+        # make sure the change is seen even on filesystems with coarse mtime
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    def check(self):
+        return self.r.check(self.controller, self.alarm)
+
+    def test_unchanged(self):
+        self.assertIsNone(self.check())
+        self.r.request()
+        self.assertEqual(self.check(), [])
+        self.assertFalse(self.alarm.configure.called)
+        self.assertFalse(self.controller.reconfigure.called)
+
+    def test_alarm(self):
+        cnf = copy.deepcopy(CONFIG)
+        cnf['alarm']['sound']['volume_initial'] = 30
+        self.write(cnf)
+        self.assertEqual(self.check(), ['alarm'])
+        self.alarm.configure.assert_called_once_with(cnf['alarm'])
+        self.assertFalse(self.controller.reconfigure.called)
+        self.assertIsNone(self.check())
+
+    def test_backend(self):
+        cnf = copy.deepcopy(CONFIG)
+        cnf['tradfri']['controlled'] = [0, 1]
+        self.write(cnf)
+        self.assertEqual(self.check(), ['tradfri'])
+        (name, old, new, config), _ = self.controller.reconfigure.call_args
+        self.assertEqual((name, old, new), ('tradfri', CONFIG['tradfri'], cnf['tradfri']))
+        self.assertEqual(config.get(), cnf)
+        self.assertFalse(self.alarm.configure.called)
+
+    def test_broken(self):
+        with open(self.path, 'w') as f:
+            f.write('{"alarm": ')
+        self.r.request()
+        self.assertIsNone(self.check())
+        self.assertEqual(self.r.current, CONFIG)
+        self.assertFalse(self.alarm.configure.called)
+        # the same broken file is tried again, and used once it's fixed
+        self.assertIsNone(self.check())
+        cnf = copy.deepcopy(CONFIG)
+        cnf['alarm']['sound']['volume_initial'] = 30
+        self.write(cnf)
+        self.assertEqual(self.check(), ['alarm'])
+
+    def test_apply_failed(self):
+        cnf = copy.deepcopy(CONFIG)
+        cnf['alarm']['sound']['volume_initial'] = 30
+        cnf['tradfri']['controlled'] = [0, 1]
+        self.write(cnf)
+        self.controller.reconfigure.side_effect = OSError('gateway unreachable')
+        self.assertIsNone(self.check())
+        # alarm is applied and stays applied, tradfri is tried again
+        self.assertEqual(self.r.current['alarm'], cnf['alarm'])
+        self.assertEqual(self.r.current['tradfri'], CONFIG['tradfri'])
+        self.controller.reconfigure.side_effect = None
+        self.now += 1
+        self.assertEqual(self.check(), ['tradfri'])
+        self.assertEqual(self.alarm.configure.call_count, 1)
+        self.assertEqual(self.r.current, cnf)
+        self.assertIsNone(self.check())
+
+    def test_backoff(self):
+        cnf = copy.deepcopy(CONFIG)
+        cnf['tradfri']['controlled'] = [0, 1]
+        self.write(cnf)
+        self.controller.reconfigure.side_effect = OSError('gateway unreachable')
+        for self.now in range(600):
+            self.check()
+        # after 0, 1, 3, 7, ... 127, 255 and 555 s
+        self.assertEqual(self.controller.reconfigure.call_count, 10)
+        # a request doesn't wait
+        self.r.request()
+        self.check()
+        self.assertEqual(self.controller.reconfigure.call_count, 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
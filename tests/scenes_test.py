@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+from src import scenes
+from src.store import StateStore
+
+PALETTE = [('ffffff', [0.3227, 0.329]), ('ff0000', [0.7006, 0.2993])]
+
+class TestScene(unittest.TestCase):
+
+    def test_hex_to_xy(self):
+        self.assertEqual(scenes.hex_to_xy('ffffff'), [0.3227, 0.329])
+        self.assertEqual(scenes.hex_to_xy('000000'), [0.0, 0.0])
+
+    def test_compile(self):
+        s = scenes.Scene('a', {
+            'hue:1': {'brightness': 300, 'color': 1},
+            'tradfri:0': {'brightness': 0},
+        }, PALETTE)
+        self.assertEqual(s.commands, {
+            'hue': [(1, 254, PALETTE[1], None)],
+            'tradfri': [(0, 0, None, None)],
+        })
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            scenes.Scene('a', {'hue:1': {'brightness': 10, 'color': 5}}, PALETTE)
+        with self.assertRaises(ValueError):
+            scenes.Scene('a', {':1': {'brightness': 10}}, PALETTE)
+        with self.assertRaises(ValueError):
+            scenes.Scene('a', {'hue': {'brightness': 10}}, PALETTE)
+        with self.assertRaises(ValueError):
+            scenes.Scene('a', {'hue:1': {'brightness': 10, 'color': -1}}, PALETTE)
+
+    def test_check(self):
+        gateways = {'tradfri': {'lights': [0, 1]}}
+        scenes.check_scene('a', {'tradfri:1': {'brightness': 10, 'color': 1}}, ['ff', 'ee'], gateways)
+        # nothing known about the hub yet
+        scenes.check_scene('a', {'hue:7': {'brightness': 10, 'color': 9}})
+        for lights in ({'hue:1': {'brightness': 10}},
+                       {'tradfri:2': {'brightness': 10}},
+                       {'tradfri:1': {'brightness': 10, 'color': 2}}):
+            with self.assertRaises(ValueError):
+                scenes.check_scene('a', lights, ['ff', 'ee'], gateways)
+
+
+class TestSceneEngine(unittest.TestCase):
+
+    def setUp(self):
+        scenes._log = lambda *a, **k: None
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = StateStore(os.path.join(self.dir.name, 'state.json'))
+        self.controller = mock.MagicMock()
+        self.engine = scenes.SceneEngine(self.controller, self.store)
+        self.engine.palette = PALETTE
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_recall(self):
+        self.engine.save('evening', {
+            'hue:1': {'brightness': 100, 'color': 0},
+            'tradfri:0': {'brightness': 50, 'color': 1},
+            'tradfri:1': {'brightness': 0},
+        })
+        self.assertEqual(self.engine.names(), ['evening'])
+        self.engine.recall('evening')
+
+        self.controller.apply_states.assert_called_once_with({
+            'hue': [(1, 100, PALETTE[0], None)],
+            'tradfri': [(0, 50, PALETTE[1], None), (1, 0, None, None)],
+        })
+
+        with self.assertRaises(ValueError):
+            self.engine.recall('morning')
+
+    def test_delete(self):
+        self.engine.save('evening', {'hue:1': {'brightness': 100}})
+        self.engine.delete('evening')
+        self.assertEqual(self.engine.names(), [])
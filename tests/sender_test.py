@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock
+from src import gateways
+from src import sender
+
+class TestCommandSender(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sent = []
+        self.gw = gateways.Gateway('tradfri', 'tradfri', mock.Mock(lights_selected=[0, 1, 2]))
+        self.s = sender.CommandSender(self.gw, lambda gw, batch: self.sent.append(batch),
+                                      state_ttl=30, clock=lambda: self.now)
+
+    def test_collapse(self):
+        self.s.queue([(0, 10, None, None), (1, 10, None, None)])
+        self.s.queue([(0, 20, None, None)])
+        self.assertEqual(self.s.flush(), 2)
+        self.assertEqual(self.sent, [[(0, 20, None, None), (1, 10, None, None)]])
+        self.assertEqual(self.s.counters()['collapsed'], 1)
+        self.assertEqual(self.s.flush(), 0)
+
+    def test_suppress(self):
+        self.s.queue([(0, 10, None, None)], skip_known=True)
+        self.s.flush()
+        self.s.queue([(0, 10, None, None), (1, 10, None, None)], skip_known=True)
+        self.s.flush()
+        self.assertEqual(self.sent[1], [(1, 10, None, None)])
+        self.assertEqual(self.s.counters()['suppressed'], 1)
+        # a different reading means the state is not known any more
+        self.s.observe(0, 50)
+        self.s.queue([(0, 10, None, None)], skip_known=True)
+        self.assertEqual(self.s.flush(), 1)
+        # nor is an old one
+        self.now = 100
+        self.s.queue([(0, 10, None, None)], skip_known=True)
+        self.assertEqual(self.s.flush(), 1)
+
+    def test_changed_elsewhere(self):
+        # the hub turned the light off, then a wall switch turned it on
+        # without anyone reading it back; the off button still works
+        self.s.queue([(0, 0, None, None)])
+        self.s.flush()
+        self.now = 5
+        self.s.queue([(0, 0, None, None)])
+        self.assertEqual(self.s.flush(), 1)
+        self.assertEqual(self.sent, [[(0, 0, None, None)], [(0, 0, None, None)]])
+        self.assertEqual(self.s.counters()['suppressed'], 0)
+
+    def test_rate(self):
+        self.gw.budget = gateways.RateBudget(rate=1, burst=2, clock=lambda: self.now)
+        self.s.queue([(0, 10, None, None), (1, 10, None, None), (2, 10, None, None)])
+        self.assertEqual(self.s.flush(), 2)
+        self.assertEqual(self.s.flush(), 0)
+        self.now = 1
+        self.assertEqual(self.s.flush(), 1)
+        self.assertEqual(self.s.counters()['sent'], 3)
+
+    def test_cancel(self):
+        self.s.queue([(0, 10, None, None), (1, 10, None, None)])
+        self.assertEqual(self.s.cancel(), 2)
+        self.assertEqual(self.s.flush(), 0)
+        self.assertEqual(self.s.counters()['cancelled'], 2)
+
+    def test_observe(self):
+        self.assertFalse(self.s.observe(0, 10))
+        self.s.queue([(0, 10, None, None)])
+        self.s.flush()
+        self.assertFalse(self.s.observe(0, 10))
+        self.assertTrue(self.s.observe(0, 50))
+        # nothing known any more
+        self.assertFalse(self.s.observe(0, 60))
+
+    def test_failure(self):
+        def fail(gw, batch):
+            raise IOError("timeout")
+        self.s.send = fail
+        self.s.queue([(0, 10, None, None)])
+        with self.assertRaises(IOError):
+            self.s.flush()
+        self.assertEqual(dict(self.s.pending), {0: (10, None, None)})
+
+
+if __name__ == '__main__':
+    unittest.main()
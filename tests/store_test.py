@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import tempfile
+import unittest
+from src.store import StateStore
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_empty(self):
+        s = StateStore(self.path)
+        self.assertEqual(s.version, 0)
+        self.assertEqual(s.get('alarms', []), [])
+        self.assertFalse(s.changed())
+
+    def test_update(self):
+        a = StateStore(self.path)
+        b = StateStore(self.path)
+        a.update(alarms=[1])
+        self.assertEqual(a.version, 1)
+        self.assertTrue(b.changed())
+        b.update(lights=[2])
+        # b merged into what a wrote
+        self.assertEqual(b.version, 2)
+        self.assertEqual(a.get('alarms'), [1])
+        self.assertEqual(a.get('lights'), [2])
+        self.assertFalse(a.refresh())
+        # no temporary files left behind
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ['state.json', 'state.json.lock'])
+
+    def test_broken(self):
+        with open(self.path, 'w') as f:
+            f.write('{')
+        with self.assertRaises(SyntaxError):
+            StateStore(self.path)
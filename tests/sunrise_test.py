@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock
+from src import sunrise
+
+LIGHTS = {
+    'hue:1': {'delay': 0, 'curve': 1, 'ct': [450, 250]},
+    'tradfri:0': {'delay': 0.5, 'curve': 2, 'max': 100},
+}
+
+class TestSunrise(unittest.TestCase):
+
+    def test_table(self):
+        s = sunrise.Sunrise(LIGHTS, 4, br_max=200)
+        self.assertEqual(s.at(0), [('hue:1', 0, 450), ('tradfri:0', 0, None)])
+        self.assertEqual(s.at(2), [('hue:1', 100, 350), ('tradfri:0', 0, None)])
+        self.assertEqual(s.at(3), [('hue:1', 150, 300), ('tradfri:0', 25, None)])
+        self.assertEqual(s.at(4), [('hue:1', 200, 250), ('tradfri:0', 100, None)])
+        # past the end, stay at the end
+        self.assertEqual(s.at(10), s.at(4))
+        self.assertEqual(s.peak(3), 150)
+
+    def test_without_numpy(self):
+        with mock.patch('src.sunrise.numpy', None):
+            plain = sunrise.Sunrise(LIGHTS, 30)
+        self.assertEqual(plain.brightness, sunrise.Sunrise(LIGHTS, 30).brightness)
+        self.assertEqual(plain.ct, sunrise.Sunrise(LIGHTS, 30).ct)
+
+    def test_changes(self):
+        s = sunrise.Sunrise(LIGHTS, 4, br_max=200)
+        self.assertEqual(s.changes(None, 0), [])
+        self.assertEqual(s.changes(None, 1), [('hue:1', 50, 400)])
+        self.assertEqual(s.changes(1, 2), [('hue:1', 100, 350)])
+        self.assertEqual(s.changes(4, 5), [])
+        self.assertEqual(s.commands(2, 4), {
+            'hue': [(1, 200, None, 250)],
+            'tradfri': [(0, 100, None, None)],
+        })
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            sunrise.Sunrise({'hue:1': {'delay': 1}}, 4)
+        with self.assertRaises(ValueError):
+            sunrise.Sunrise({'hue1': {}}, 4)
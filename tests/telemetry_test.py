@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import tempfile
+import unittest
+from src import telemetry
+
+class TestSeries(unittest.TestCase):
+
+    def test_raw(self):
+        s = telemetry.Series(size=3)
+        s.add(1, when=10)
+        s.add(2, when=11)
+        self.assertEqual(s.points(), [(10, 1), (11, 2)])
+        self.assertEqual(s.points(since=11), [(11, 2)])
+        self.assertEqual(s.aggregates(), [])
+
+    def test_downsample(self):
+        s = telemetry.Series(size=2, bucket=10, buckets=2)
+        for (when, value) in [(0, 1), (5, 3), (12, 4), (25, 6), (26, 7), (27, 0)]:
+            s.add(value, when=when)
+        self.assertEqual(s.points(), [(26, 7), (27, 0)])
+        # bucket 0 (1, 3) fell out of the ring, 10 (4) and 20 (6) remain
+        self.assertEqual(s.aggregates(), [(10, 4, 4, 4, 1), (20, 6, 6, 6, 1)])
+
+    def test_aggregate(self):
+        s = telemetry.Series(size=1, bucket=10)
+        for (when, value) in [(0, 1), (5, 3), (9, 8), (12, 0)]:
+            s.add(value, when=when)
+        self.assertEqual(s.aggregates(), [(0, 1, 8, 4, 3)])
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_snapshot_copy(self):
+        t = telemetry.Telemetry(size=2, bucket=10)
+        for when in range(3):
+            t.record('a', when, when=when)
+        copy = t.series['a'].copy()
+        t.record('a', 9, when=20)
+        self.assertEqual(copy.points(), [(1, 1), (2, 2)])
+        self.assertEqual(copy.aggregates(), [(0, 0, 0, 0, 1)])
+        self.assertEqual(t.snapshot()['series']['a']['points'], [(2, 2), (20, 9)])
+
+    def test_save(self):
+        t = telemetry.Telemetry(size=10)
+        t.record('a', 1, when=5)
+        t.record('b', 2, when=6)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'telemetry.json')
+            self.assertIsNone(t.save_every(path, 0))
+            self.assertFalse(os.path.exists(path))
+            t.save_every(path, 60).join()
+            # too early for another one
+            self.assertIsNone(t.save_every(path, 60))
+            self.assertEqual(os.listdir(d), ['telemetry.json'])
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data['series']['a']['points'], [[5, 1]])
+        self.assertEqual(data['series']['b']['points'], [[6, 2]])
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# vim: set expandtab cindent sw=4 ts=4:
+#
+# (C)2018 Jan Tulak <jan@tulak.me>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import http.client
+import os
+import queue
+import tempfile
+import threading
+import unittest
+from src import alarm
+from src import webgui
+
+class TestWebServerAPI(unittest.TestCase):
+
+    def setUp(self):
+        alarm._log = lambda *a, **k: None
+        webgui._log = lambda *a, **k: None
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'hub_state.json')
+        self.commands = queue.Queue()
+        self.server = webgui.WebServer(0, self.path, commands=self.commands)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_alarm(self):
+        self.assertEqual(self.server.get('/api/alarm', {}),
+                         (200, {'time': None, 'start': None, 'enabled': False}))
+        with self.assertRaises(webgui.APIError):
+            self.server.post('/api/alarm', {'enabled': True})
+
+        code, data = self.server.post('/api/alarm', {'time': '07:30', 'enabled': True})
+        self.assertEqual(code, 200)
+        self.assertEqual(data, {'time': '07:30', 'start': '07:10', 'enabled': True})
+
+        code, data = self.server.post('/api/alarm', {'enabled': 'off'})
+        self.assertEqual(data, {'time': '07:30', 'start': '07:10', 'enabled': False})
+
+        with self.assertRaises(webgui.APIError) as ex:
+            self.server.post('/api/alarm', {'time': '7.30'})
+        self.assertEqual(ex.exception.code, 400)
+
+    def test_second_alarm(self):
+        self.server.timer.set_time(webgui.dt.time(5, 0), False)
+        self.server.timer.set_time(webgui.dt.time(6, 0), True, 1)
+        self.assertEqual(self.server.get('/api/alarm', {})[1]['start'], '06:00')
+        code, data = self.server.post('/api/alarm', {'time': '07:30', 'enabled': True})
+        self.assertEqual(data, {'time': '07:30', 'start': '07:10', 'enabled': True})
+        self.assertEqual(self.server.timer.alarms,
+                         [(webgui.dt.time(5, 0), False), (webgui.dt.time(7, 10), True)])
+
+    def test_shared_timer(self):
+        # in the thread mode the alarm and the server hold the same lock
+        shared = webgui.WebServer(0, self.path, timer=self.server.timer)
+        self.assertIs(shared.timer_lock, self.server.timer.lock)
+
+    def test_stop(self):
+        self.assertEqual(self.server.post('/api/alarm/stop', {}), (202, {'queued': 'stop'}))
+        self.assertEqual(self.commands.get_nowait(), ('stop', None))
+
+    def test_scenes(self):
+        self.server.update_state({'gateways': {'tradfri': {'lights': [0]}}, 'colors': ['ffffff']})
+        scene = {'name': 'evening', 'lights': {'tradfri:0': {'brightness': 100, 'color': 0}}}
+        self.assertEqual(self.server.post('/api/scenes', scene)[0], 200)
+        for lights in ({'tradfri:3': {'brightness': 100}},
+                       {'hue:0': {'brightness': 100}},
+                       {'tradfri:0': {'brightness': 100, 'color': 1}}):
+            with self.assertRaises(webgui.APIError) as ex:
+                self.server.post('/api/scenes', {'name': 'bad', 'lights': lights})
+            self.assertEqual(ex.exception.code, 400)
+        self.assertEqual(list(self.server.get('/api/scenes', {})[1]), ['evening'])
+
+    def test_lights(self):
+        self.assertEqual(self.server.post('/api/lights', {'brightness': '300'})[0], 202)
+        self.assertEqual(self.server.post('/api/lights', {'action': 'off'})[0], 202)
+        self.assertEqual(self.commands.get_nowait(), ('brightness', 254))
+        self.assertEqual(self.commands.get_nowait(), ('off', None))
+        with self.assertRaises(webgui.APIError):
+            self.server.post('/api/lights', {'action': 'explode'})
+
+    def test_batch(self):
+        code, data = self.server.post('/api/batch', [
+            {'path': '/api/alarm', 'body': {'time': '06:00'}},
+            {'path': '/api/nothing'},
+            {'path': '/api/lights', 'body': {'action': 'on'}},
+        ])
+        self.assertEqual(code, 200)
+        self.assertEqual([r['status'] for r in data['results']], [200, 404, 202])
+
+    def test_etag(self):
+        etag = self.server.etag()
+        self.assertEqual(etag, self.server.etag())
+        self.server.state_version += 1
+        self.assertNotEqual(etag, self.server.etag())
+
+    def test_light_events(self):
+        self.server.update_state({'lights': [
+            {'backend': 'hue', 'light': 1, 'brightness': 10},
+            {'backend': 'tradfri', 'light': 0, 'brightness': 20},
+        ]})
+        last, messages = self.server.events.wait(0, 0)
+        self.assertEqual(len(messages), 2)
+        self.server.update_state({'lights': [
+            {'backend': 'hue', 'light': 1, 'brightness': 10},
+            {'backend': 'tradfri', 'light': 0, 'brightness': 30},
+        ]})
+        last, messages = self.server.events.wait(last, 0)
+        self.assertEqual(len(messages), 1)
+        self.assertIn(b'"brightness": 30', messages[0])
+
+
+class TestRequestHandler(unittest.TestCase):
+
+    def setUp(self):
+        webgui._log = lambda *a, **k: None
+        self.dir = tempfile.TemporaryDirectory()
+        api = webgui.WebServer(0, os.path.join(self.dir.name, 'hub_state.json'),
+                               commands=queue.Queue())
+        handler = type('Handler', (webgui.AlarmHTTPServer_RequestHandler,), {
+            'api': api, 'templater': api.templater, 'handler': api.handler,
+            'log_message': lambda *a: None})
+        self.httpd = webgui.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.dir.cleanup()
+
+    def request(self, method, path, body=None, headers={}):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=5)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response.status, response.getheader('ETag'), response.read()
+        finally:
+            conn.close()
+
+    def test_put(self):
+        self.assertEqual(self.request('PUT', '/', 'time=07:30')[0], 405)
+        body = '{"time": "07:30", "enabled": true}'
+        status = self.request('PUT', '/api/alarm', body, {'Content-Type': 'application/json'})[0]
+        self.assertEqual(status, 200)
+
+    def test_not_utf8(self):
+        self.assertEqual(self.request('POST', '/api/alarm', b'{"time": "\xff"}',
+                                      {'Content-Type': 'application/json'})[0], 400)
+        self.assertEqual(self.request('POST', '/', b'time=\xff')[0], 400)
+
+    def test_negative_length(self):
+        conn = http.client.HTTPConnection(*self.httpd.server_address, timeout=5)
+        try:
+            conn.putrequest('POST', '/api/lights')
+            conn.putheader('Content-Type', 'application/json')
+            conn.putheader('Content-Length', '-1')
+            conn.endheaders()
+            self.assertEqual(conn.getresponse().status, 400)
+        finally:
+            conn.close()
+
+    def test_if_none_match(self):
+        (_, etag, _) = self.request('GET', '/api/state')
+        for match in (etag, 'W/' + etag, '"other", W/' + etag, '"a,b", ' + etag, '*'):
+            self.assertEqual(self.request('GET', '/api/state', headers={
+                'If-None-Match': match})[0], 304, match)
+        for match in ('"other"', 'W/"other", "a,b"'):
+            self.assertEqual(self.request('GET', '/api/state', headers={
+                'If-None-Match': match})[0], 200, match)
+
+
+class TestWebGUI(unittest.TestCase):
+
+    def test_urgent_commands(self):
+        webgui._log = lambda *a, **k: None
+        with tempfile.TemporaryDirectory() as directory:
+            gui = webgui.WebGUI(os.path.join(directory, 'hub_state.json'))
+        stopped = threading.Event()
+        gui.interrupt = lambda command, argument: stopped.set()
+        threading.Thread(target=gui._route_commands, daemon=True).start()
+        gui.commands.put(('on', None))
+        gui.commands.put(('stop', None))
+        self.assertTrue(stopped.wait(5))
+        self.assertEqual(list(gui.pending_commands()), [('on', None)])
+
+
+class TestEventStream(unittest.TestCase):
+
+    def test_wait(self):
+        stream = webgui.EventStream(size=2)
+        self.assertEqual(stream.wait(0, 0), (0, []))
+        for i in range(3):
+            stream.publish('step', {'i': i})
+        last, messages = stream.wait(1, 0)
+        self.assertEqual(last, 3)
+        self.assertEqual(messages, [
+            b'id: 2\nevent: step\ndata: {"i": 1}\n\n',
+            b'id: 3\nevent: step\ndata: {"i": 2}\n\n',
+        ])
+        self.assertEqual(stream.wait(3, 0), (3, []))
+
+    def test_gap(self):
+        stream = webgui.EventStream(size=2)
+        for i in range(3):
+            stream.publish('step', {'i': i})
+        # event 1 is gone, and so is everything of an id from before a restart
+        self.assertEqual(stream.wait(0, 0), (3, None))
+        self.assertEqual(stream.wait(7, 10), (3, None))
+
+    def test_subscribers(self):
+        stream = webgui.EventStream(max_subscribers=2)
+        self.assertTrue(stream.subscribe())
+        self.assertTrue(stream.subscribe())
+        self.assertFalse(stream.subscribe())
+        stream.unsubscribe()
+        self.assertTrue(stream.subscribe())